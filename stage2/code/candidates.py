@@ -0,0 +1,68 @@
+'''
+Usage:
+    python candidates.py joined_reviews.json
+
+Candidate spans for inference (see serve.py). At inference time every span of
+up to 6 words is a possible menu item, but most of them can be pruned before
+any features are computed, using the same checks as the rules in debugM.py:
+    a span must not start or end with a stop word (not_bounded_by_stop_word)
+    a span must contain a noun (contains_noun), or a cooking style or food
+        name from the lexicons, which rescues menu items the tagger misses
+Each review is POS tagged once, in context, rather than once per span.
+
+Prints the number of candidate spans in the reviews before and after pruning.
+'''
+
+import json
+from sys import argv
+from nltk import pos_tag_sents
+
+import debugM
+import generate_feature_vectors as gfv
+
+def pruned_candidates(review, raw_review_sentences, parsed_review_sentences, max_length=6):
+    '''
+    Same as generate_feature_vectors.all_candidates(), but only returns the
+    spans that pass the checks at the top of this file.
+    review: A parsed JSON review (a Python dictionary)
+    raw_review_sentences, parsed_review_sentences: as returned by split_review()
+    max_length: the maximum number of words in a span
+    '''
+    tagged_sentences = pos_tag_sents([[word for word, _, _ in parsed_review_sentence] for parsed_review_sentence in parsed_review_sentences])
+    examples = []
+    for sentence_idx, (raw_review_sentence, parsed_review_sentence, tagged_sentence) in enumerate(zip(raw_review_sentences, parsed_review_sentences, tagged_sentences)):
+        # The rules are per-word checks, so evaluate them once per word
+        words = [word for word, _, _ in parsed_review_sentence]
+        is_noun = [debugM.contains_noun([word], [tag]) for word, tag in tagged_sentence]
+        is_boundary = [debugM.not_bounded_by_stop_word([word], None) for word in words]
+        occurrences = [gfv.find_lexicon(gfv.COOKING_STYLES_LEXICON, raw_review_sentence),
+                       gfv.find_lexicon(gfv.FOOD_NAMES_LEXICON, raw_review_sentence)]
+
+        for first_word_idx in xrange(len(words)):
+            if not is_boundary[first_word_idx]:
+                continue
+            start = parsed_review_sentence[first_word_idx][1]
+            has_noun = False
+            for last_word_idx in xrange(first_word_idx, min(first_word_idx + max_length, len(words))):
+                has_noun = has_noun or is_noun[last_word_idx]
+                if not is_boundary[last_word_idx]:
+                    continue
+                end = parsed_review_sentence[last_word_idx][2]
+                if has_noun or any(gfv.contains_lexicon(occ, start, end) for occ in occurrences):
+                    examples.append((sentence_idx, first_word_idx, last_word_idx - first_word_idx + 1, False))
+    return examples
+
+def main():
+    num_all = 0
+    num_pruned = 0
+    with open(argv[1], 'r') as f:
+        for line in f:
+            review = json.loads(line)
+            raw_review_sentences, parsed_review_sentences = gfv.split_review(review['text'])
+            num_all += len(gfv.all_candidates(review, raw_review_sentences, parsed_review_sentences))
+            num_pruned += len(pruned_candidates(review, raw_review_sentences, parsed_review_sentences))
+    print 'all candidates:', num_all
+    print 'after pruning:', num_pruned, '(%.1f%%)' % (100.0 * num_pruned / max(num_all, 1))
+
+if __name__ == "__main__":
+    main()
@@ -1,90 +1,200 @@
 ''' 
 Usage: 
-    python classifiers.py dev_set.json
+    python classifiers.py [--jobs N] [--models DIR] dev_set.json
+    python classifiers.py [--jobs N] [--models DIR] dev_set_store/
 
+dev_set_store/ is a feature store directory (see feature_store.py). Its
+features are memory-mapped, so no JSON is parsed. The classifiers still need
+the training rows of each fold in memory, so each fit copies them, while the
+test rows are predicted PREDICT_CHUNK_ROWS at a time. If one fit would not fit
+in the available memory, the script stops with a MemoryError before fitting.
+Each classifier is fit once per fold, and precision, recall, and F1 are all
+computed from that fit. All (classifier, fold) fits run in parallel in N
+processes (by default, one per core), where N is reduced so that the fits of
+all processes fit in the available memory. With --models, each (classifier, fold)
+fit is saved to the model store DIR (see model_store.py), and later runs with
+the same features load it instead of refitting.
 '''
 
+import argparse
 import fileinput
 import json
+import multiprocessing
+import os
 import numpy as np
+import feature_store
+import model_store
 from sklearn.tree import DecisionTreeClassifier
 from sklearn.ensemble import RandomForestClassifier
 from sklearn.svm import SVC
 from sklearn import linear_model
-from sklearn.model_selection import cross_val_score
+from sklearn.model_selection import StratifiedKFold
 from sklearn.model_selection import KFold
 from sklearn.metrics import precision_score
 from sklearn.metrics import recall_score
 from sklearn.metrics import f1_score
+try:
+    from joblib import Parallel, delayed
+except ImportError:
+    from sklearn.externals.joblib import Parallel, delayed
 
+# Number of test rows of a fold that are copied into memory and predicted at a time
+PREDICT_CHUNK_ROWS = 100000
 
-def get_reviews():
-    reviews = [json.loads(line) for line in fileinput.input()]
+def get_reviews(files):
+    reviews = [json.loads(line) for line in fileinput.input(files)]
     return reviews
     
-def get_fvs():  
-    reviews = get_reviews()               
+def get_fvs(files):  
+    '''
+    Returns (fvs, labels, names of the feature columns)
+    '''
+    if len(files) == 1 and os.path.isdir(files[0]):
+        # memory-mapped, without parsing any JSON
+        store = feature_store.read_store(files[0])
+        return store['features'], store['labels'], list(store['feature_names'])
+    reviews = get_reviews(files)               
     fvs = []
     labels = []
+    feature_names = []
     for rev in reviews:
         for fv in rev['fvs']:
+            feature_names = [str(feat) for feat in fv if feat != 'is_positive' and feat != 'text']
             fvs.append([fv[feat] for feat in fv if feat != 'is_positive' and feat != 'text'])
             labels.append(fv['is_positive'])
     # 661 positive examples, 1741 negative examples
     # labels.count(0), labels.count(1)
-    return np.array(fvs), np.array(labels)
+    return np.array(fvs), np.array(labels), feature_names
+
+def available_memory():
+    '''
+    Returns the number of bytes of memory available to new processes, or None
+    if the OS does not say (Linux does).
+    '''
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    return None
+
+def fit_memory(fvs, n_train, n_test):
+    '''
+    Returns the number of bytes that fit_and_score() needs for a fold with
+    n_train training rows and n_test test rows of fvs: the copy of the
+    training rows, another copy that a classifier may make of them, and one
+    chunk of test rows.
+    '''
+    row_bytes = fvs.dtype.itemsize * int(np.prod(fvs.shape[1:]))
+    return (2 * n_train + min(n_test, PREDICT_CHUNK_ROWS)) * row_bytes
+
+def cap_jobs(n_jobs, job_bytes):
+    '''
+    Returns the number of processes to fit in: n_jobs (-1 for one per core),
+    reduced so that each process fits in the available memory.
+    job_bytes: number of bytes that one process needs (see fit_memory())
+    Raises MemoryError if not even one process fits, rather than letting the
+    fits run into swap or the OOM killer.
+    '''
+    if n_jobs < 0:
+        n_jobs = multiprocessing.cpu_count() + 1 + n_jobs
+    memory = available_memory()
+    if memory is None:
+        return n_jobs
+    if job_bytes > memory:
+        raise MemoryError('one fit needs about %.1f MB for the training rows of its fold, but only %.1f MB of memory are available; '
+                          'use fewer examples or features' % (job_bytes / 2.0 ** 20, memory / 2.0 ** 20))
+    return max(1, min(n_jobs, memory // max(job_bytes, 1)))
+
+def round_predictions(predicted):
+    '''
+    Converts the output of a regression model to labels: 0 if the output is
+    closer to 0, and 1 otherwise.
+    '''
+    return np.where(np.abs(predicted - 0) < np.abs(predicted - 1), 0, 1)
+
+def fit_and_score(clf, fvs, labels, train_i, test_i, is_regression, models_dir=None, model_name=None, feature_names=()):
+    '''
+    Fits clf on one fold, and returns the (precision, recall, f1) of its
+    predictions on the fold's test set. If models_dir is not None, the fit is
+    loaded from, or saved to, that model store as model_name.
+    The training rows of the fold are copied into memory, even if fvs is
+    memory-mapped, and the test rows are copied PREDICT_CHUNK_ROWS at a time
+    (see fit_memory()).
+    '''
+    train_fvs = fvs[train_i]
+    train_labels = labels[train_i]
+    data_hash = model_store.training_hash(train_fvs, train_labels, repr(clf)) if models_dir is not None else None
+    clf = model_store.fit_or_load(models_dir, model_name, clf, feature_names, data_hash,
+                                  lambda clf: clf.fit(train_fvs, train_labels))
+    test_pred_labels = np.concatenate([clf.predict(fvs[test_i[start:start + PREDICT_CHUNK_ROWS]])
+                                       for start in xrange(0, len(test_i), PREDICT_CHUNK_ROWS)])
+    if is_regression:
+        test_pred_labels = round_predictions(test_pred_labels)
+    test_labels = labels[test_i]
+    return (precision_score(test_labels, test_pred_labels),
+            recall_score(test_labels, test_pred_labels),
+            f1_score(test_labels, test_pred_labels))
+
+def evaluate(models, fvs, labels, n_jobs, models_dir=None, feature_names=()):
+    '''
+    Cross-validates every model, fitting each model once per fold.
+    models: list of (name, classifier, folds, True if the classifier is a
+        regression model), where folds is a cross-validator
+    n_jobs: number of processes, which is reduced by cap_jobs()
+    models_dir, feature_names: model store to load and save the fits in, and
+        the names of the columns of fvs
+    Returns a dictionary from each name to a dictionary from each metric
+    ('precision', 'recall', 'f1') to the array of scores of the folds.
+    '''
+    tasks = []
+    for name, clf, cv, is_regression in models:
+        for fold, (train_i, test_i) in enumerate(cv.split(fvs, labels)):
+            tasks.append((name, clf, train_i, test_i, is_regression, '%s-fold%d' % (name, fold)))
+    # Fails before any fit if the largest fold does not fit in memory
+    n_jobs = cap_jobs(n_jobs, max(fit_memory(fvs, len(train_i), len(test_i)) for _, _, train_i, test_i, _, _ in tasks))
+    # fit_and_score() fits a copy of clf in each process. joblib passes a
+    # memory-mapped feature store to the processes by file name; other arrays
+    # are only memory-mapped if they are larger than its max_nbytes (1 MB by
+    # default), and are pickled to each process otherwise
+    scores = Parallel(n_jobs=n_jobs)(
+        delayed(fit_and_score)(clf, fvs, labels, train_i, test_i, is_regression, models_dir, model_name, feature_names)
+        for name, clf, train_i, test_i, is_regression, model_name in tasks)
+    pr_scores = {}
+    for (name, _, _, _, _, _), (p, r, f1) in zip(tasks, scores):
+        model_scores = pr_scores.setdefault(name, {'precision': [], 'recall': [], 'f1': []})
+        model_scores['precision'].append(p)
+        model_scores['recall'].append(r)
+        model_scores['f1'].append(f1)
+    for model_scores in pr_scores.values():
+        for metric in model_scores:
+            model_scores[metric] = np.array(model_scores[metric])
+    return pr_scores
 
 def main():
-    fvs, labels = get_fvs()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--jobs', type=int, default=-1, help='number of processes (default: one per core)')
+    parser.add_argument('--models', help='model store directory in which to save and load the fits')
+    parser.add_argument('files', nargs='*')
+    args = parser.parse_args()
+
+    fvs, labels, feature_names = get_fvs(args.files)
     classifiers = ['DT', 'RF', 'SVM', 'LogR', 'LinR']
-    pr_scores = {c: {'precision': None, 'recall': None}  for c in classifiers}
     folds = 4    
 
-    dt = DecisionTreeClassifier()
-    pr_scores['DT']['precision'] = cross_val_score(dt, fvs, labels, cv=folds, scoring='precision')
-    pr_scores['DT']['recall'] = cross_val_score(dt, fvs, labels, cv=folds, scoring='recall')
-    pr_scores['DT']['f1'] = cross_val_score(dt, fvs, labels, cv=folds, scoring='f1')
-    
-    rf = RandomForestClassifier()
-    pr_scores['RF']['precision'] = cross_val_score(rf, fvs, labels, cv=folds, scoring='precision')
-    pr_scores['RF']['recall'] = cross_val_score(rf, fvs, labels, cv=folds, scoring='recall')
-    pr_scores['RF']['f1'] = cross_val_score(rf, fvs, labels, cv=folds, scoring='f1')
-    
-    svmclf = SVC()
-    pr_scores['SVM']['precision'] = cross_val_score(svmclf, fvs, labels, cv=folds, scoring='precision')
-    pr_scores['SVM']['recall'] = cross_val_score(svmclf, fvs, labels, cv=folds, scoring='recall')
-    pr_scores['SVM']['f1'] = cross_val_score(svmclf, fvs, labels, cv=folds, scoring='f1')
-    
-    logr = linear_model.LogisticRegression()
-    pr_scores['LogR']['precision'] = cross_val_score(logr, fvs, labels, cv=folds, scoring='precision')
-    pr_scores['LogR']['recall'] = cross_val_score(logr, fvs, labels, cv=folds, scoring='recall')
-    pr_scores['LogR']['f1'] = cross_val_score(logr, fvs, labels, cv=folds, scoring='f1')
-    
-    linr = linear_model.LinearRegression()
+    # Same folds as cross_val_score(cv=folds) for the classifiers
+    skf = StratifiedKFold(n_splits=folds)
     kf = KFold(n_splits=folds, shuffle = True, random_state=42)
-    linrp = []
-    linrr = []
-    linrf = []
-    for train_i, test_i in kf.split(fvs):
-        train_fvs = [fvs[i] for i in train_i]
-        train_labels = [labels[i] for i in train_i]
-        test_fvs = [fvs[i] for i in test_i]
-        test_labels = [labels[i] for i in test_i]
-        linr.fit(train_fvs, train_labels)
-        test_predicted = linr.predict(test_fvs)
-        test_pred_labels = []
-        for v in test_predicted:
-            if abs(v - 0) < abs(v - 1):
-                test_pred_labels.append(0)
-            else:
-                test_pred_labels.append(1)
-        test_pred_labels = np.array(test_pred_labels)
-        linrp.append(precision_score(test_labels, test_pred_labels))
-        linrr.append(recall_score(test_labels, test_pred_labels))
-        linrf.append(f1_score(test_labels, test_pred_labels))
-    pr_scores['LinR']['precision'] = np.array(linrp)
-    pr_scores['LinR']['recall'] = np.array(linrr)
-    pr_scores['LinR']['f1'] = np.array(linrf)
+    models = [
+        ('DT', DecisionTreeClassifier(), skf, False),
+        ('RF', RandomForestClassifier(), skf, False),
+        ('SVM', SVC(), skf, False),
+        ('LogR', linear_model.LogisticRegression(), skf, False),
+        ('LinR', linear_model.LinearRegression(), kf, True),
+    ]
+    pr_scores = evaluate(models, fvs, labels, args.jobs, args.models, feature_names)
     
     for c in classifiers:
         print c
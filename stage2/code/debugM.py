@@ -1,15 +1,27 @@
 ''' 
 Usage: 
-    python debugM.py dev_set.json test_set.json
+    python debugM.py dev_set.json test_set.json [models/]
+    python debugM.py dev_set_store/ test_set_store/ [models/]
 
+*_store/ are feature store directories (see feature_store.py).
+If models/ is given, the classifier trained on the dev set is saved to that
+model store (see model_store.py) for use by serve.py, and later runs with the
+same dev set load it instead of retraining. The POS tags of the predicted menu
+items are also saved, in models/tags.sqlite, and later runs only tag new texts.
 '''
 
+import hashlib
 import json
+import os
 import numpy as np
 import random
+import sqlite3
+import feature_store
+import model_store
 from sys import argv
+from collections import OrderedDict
 from sklearn.svm import SVC
-from nltk import word_tokenize, pos_tag
+from nltk import word_tokenize, pos_tag_sents
 from nltk.corpus import stopwords
 from sklearn.model_selection import KFold
 from sklearn.metrics import precision_score
@@ -19,6 +31,8 @@ from sklearn.metrics import f1_score
 
 
 def get_reviews(filename):
+    if os.path.isdir(filename):
+        return feature_store.read_reviews(filename)
     with open(filename) as f:
         reviews = [json.loads(line) for line in f]
     return reviews
@@ -38,6 +52,8 @@ def get_fvs(reviews):
     '''
     from reviews, pull feature vectors, labels, and text
     '''        
+    if len(reviews) > 0 and 'store' in reviews[0]:
+        return feature_store.get_rows(reviews)
     fvs = []
     labels = []
     text = []
@@ -48,6 +64,20 @@ def get_fvs(reviews):
             text.append(fv['text'])
     return np.array(fvs), np.array(labels), np.array(text)
     
+def get_feature_names(reviews):
+    '''
+    names of the columns returned by get_fvs(reviews)
+    '''
+    if len(reviews) > 0 and 'store' in reviews[0]:
+        return list(reviews[0]['store']['feature_names'])
+    for rev in reviews:
+        for fv in rev['fvs']:
+            return [str(feat) for feat in fv if feat != 'is_positive' and feat != 'text']
+    return []
+
+# name of the classifier trained by main() in the model store
+MODEL_NAME = 'debugM-SVC'
+
 def false_pos_neg(test_fvs, test_labels, test_text, predicted_labels):
     '''
     Find and display false positives and false negatives for debugging
@@ -73,6 +103,90 @@ def false_pos_neg(test_fvs, test_labels, test_text, predicted_labels):
         print falsenegativestext[i], list(fv)
         
     
+# Maximum number of texts in TAG_CACHE
+TAG_CACHE_SIZE = 100000
+
+# Memoized (tokens, tags) of the most recently used texts, shared by all folds
+# and calls, from least to most recently used
+TAG_CACHE = OrderedDict()
+
+# SQLite connection of the on-disk tag cache, or None (see open_tag_cache())
+TAG_DB = None
+
+def open_tag_cache(filename):
+    '''
+    Saves the (tokens, tags) of every text tagged from now on in the SQLite
+    file filename, keyed by a hash of the text, and looks texts up there
+    before tagging them, so that they are tagged once across runs.
+    '''
+    global TAG_DB
+    TAG_DB = sqlite3.connect(filename)
+    TAG_DB.execute('CREATE TABLE IF NOT EXISTS tags (text_hash TEXT PRIMARY KEY, tagged TEXT)')
+
+def text_hash(text):
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    return hashlib.sha1(text).hexdigest()
+
+def tag_texts(texts):
+    '''
+    Returns a list of (tokens, POS tags) for each text.
+    Only the unique texts that are in neither TAG_CACHE nor the on-disk tag
+    cache are tagged, in a single batch, so the tagger is loaded once and each
+    text is tagged once.
+    '''
+    tagged_texts = {}
+    for t in set(texts):
+        if t in TAG_CACHE:
+            tagged_texts[t] = TAG_CACHE.pop(t)
+    if TAG_DB is not None:
+        for t in set(texts):
+            if t not in tagged_texts:
+                row = TAG_DB.execute('SELECT tagged FROM tags WHERE text_hash = ?', (text_hash(t),)).fetchone()
+                if row is not None:
+                    tagged_texts[t] = tuple(json.loads(row[0]))
+    new_texts = [t for t in set(texts) if t not in tagged_texts]
+    new_tokens = [word_tokenize(t) for t in new_texts]
+    for t, tokens, tagged in zip(new_texts, new_tokens, pos_tag_sents(new_tokens)):
+        tagged_texts[t] = (tokens, [tag for _, tag in tagged])
+    if TAG_DB is not None and len(new_texts) > 0:
+        TAG_DB.executemany('INSERT OR REPLACE INTO tags VALUES (?, ?)',
+                           [(text_hash(t), json.dumps(tagged_texts[t])) for t in new_texts])
+        TAG_DB.commit()
+    # (Re)insert the texts as the most recently used, and evict the least recently used
+    for t, tagged in tagged_texts.iteritems():
+        TAG_CACHE[t] = tagged
+    while len(TAG_CACHE) > TAG_CACHE_SIZE:
+        TAG_CACHE.popitem(last=False)
+    return [tagged_texts[t] for t in texts]
+
+STOP_WORDS = None
+
+def get_stop_words():
+    '''
+    Loads the English stop words the first time it is called.
+    '''
+    global STOP_WORDS
+    if STOP_WORDS is None:
+        STOP_WORDS = set(stopwords.words('english'))
+    return STOP_WORDS
+
+'''
+Rules are predicates over the (tokens, tags) of a predicted menu item. A
+positive prediction is changed to negative if any rule returns False.
+'''
+
+def contains_noun(tokens, tags):
+    ''' rule: menu items must contain a noun '''
+    return any(tag == 'NN' or tag == 'NNS' for tag in tags)
+
+def not_bounded_by_stop_word(tokens, tags):
+    ''' rule: menu items must not start or end with a stop word '''
+    stop_words = get_stop_words()
+    return tokens[0] not in stop_words and tokens[-1] not in stop_words
+
+RULES = [contains_noun, not_bounded_by_stop_word]
+
 def debug():
     '''
     Split dev set I into sets P, Q, each containing 100 docs
@@ -91,43 +205,21 @@ def debug():
     # display false positives/negatives before rules
     false_pos_neg(fvsQ, labelsQ, textQ, predicted_before_rule)
     
-    predicted = []
-    # rule: menu items must contain a noun
-    for i, pmi in enumerate(textQ):
-        tokens = word_tokenize(pmi)
-        tags = pos_tag(tokens)
-        has_noun = False
-        for t in tags:
-            if t[-1] == 'NN' or t[-1] == 'NNS':
-                has_noun = True
-                break
-        if predicted_before_rule[i] == 1 and has_noun == False:
-            # manually change predicted label
-            predicted.append(0)
-        else:
-            predicted.append(predicted_before_rule[i])
+    predicted = apply_rules(textQ, predicted_before_rule, [contains_noun])
     
     # display false positives/negatives after rules
     print
     false_pos_neg(fvsQ, labelsQ, textQ, predicted)
 
-def apply_rules(test_text, test_pred_labels):
+def apply_rules(test_text, test_pred_labels, rules=RULES):
+    '''
+    Changes each positive prediction to negative if any rule fails on its text
+    '''
     predicted = []
-    stopWords = set(stopwords.words('english'))
-    # rule: menu items must contain a noun
-    for i, pmi in enumerate(test_text):
-        tokens = word_tokenize(pmi)
-        tags = pos_tag(tokens)
-        has_noun = False
-        for t in tags:
-            if t[-1] == 'NN' or t[-1] == 'NNS':
-                has_noun = True
-                break
-        if test_pred_labels[i] == 1 and has_noun == False:
+    for i, (tokens, tags) in enumerate(tag_texts(test_text)):
+        if test_pred_labels[i] == 1 and not all(rule(tokens, tags) for rule in rules):
             # manually change predicted label
             predicted.append(0)
-        elif tokens[0] in stopWords or tokens[-1] in stopWords:
-            predicted.append(0)
         else:
             predicted.append(test_pred_labels[i])
     # see what false positives/negatives we have left
@@ -145,6 +237,9 @@ def train_metrics():
     
     svmclf = SVC()
     
+    # tag every text once, rather than once per fold
+    tag_texts(text)
+    
     # cross-valiation
     folds = 10
     kf = KFold(n_splits=folds, shuffle = True, random_state=36)
@@ -187,7 +282,15 @@ def main():
     
     # train classifier with dev set
     clf = SVC()
-    clf.fit(train_fvs, train_labels)
+    models_dir = argv[3] if len(argv) > 3 else None
+    if models_dir is not None:
+        if not os.path.exists(models_dir):
+            os.makedirs(models_dir)
+        open_tag_cache(os.path.join(models_dir, 'tags.sqlite'))
+    # Hashing the training data is only needed to look up a saved model
+    data_hash = model_store.training_hash(train_fvs, train_labels, repr(clf)) if models_dir is not None else None
+    clf = model_store.fit_or_load(models_dir, MODEL_NAME, clf, get_feature_names(train_reviews), data_hash,
+                                  lambda clf: clf.fit(train_fvs, train_labels))
     
     # get test set
     test_reviews = get_reviews(argv[2])
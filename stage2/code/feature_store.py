@@ -0,0 +1,187 @@
+'''
+Usage:
+    python feature_store.py feature_vectors.json feature_store_dir
+
+Converts reviews with feature vectors (the output of
+generate_feature_vectors.py) to a feature store, which is a directory of .npy
+files that can be memory-mapped:
+    feature_names.npy: names of the feature columns
+    features.npy: float matrix with one row per example
+    labels.npy: 1 for positive examples, 0 for negative examples
+    texts.npy: UTF-8 text of each example
+    examples.npy: int matrix with one row (index of review, index of sentence,
+        index of first word in sentence, number of words, character index of
+        first character in review text, character index of last character in
+        review text) per example, or -1 where unknown
+    review_ids.npy: review_id of each review
+    review_offsets.npy: the examples of review i are the rows
+        review_offsets[i]:review_offsets[i + 1]
+
+The classifiers accept a feature store directory in place of a JSON file, so
+they never parse the review text.
+'''
+
+import json
+import os
+import shutil
+import numpy as np
+from sys import argv
+
+from collections import OrderedDict
+
+FILE_NAMES = ('feature_names', 'features', 'labels', 'texts', 'examples', 'review_ids', 'review_offsets')
+
+def write_store(directory, feature_names, fvs, labels, texts, examples, review_ids, review_offsets):
+    '''
+    Writes a feature store to directory, creating the directory if necessary.
+    texts and review_ids are lists of UTF-8 strings; the other arguments are
+    described at the top of this file.
+    '''
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    assert len(fvs) == len(labels) == len(texts) == len(examples) == review_offsets[-1]
+    assert len(review_ids) + 1 == len(review_offsets)
+    arrays = {
+        'feature_names': np.array(feature_names, dtype=str),
+        'features': np.asarray(fvs, dtype=np.float64).reshape(-1, len(feature_names)),
+        'labels': np.asarray(labels, dtype=np.int64),
+        'texts': np.array(texts, dtype=str),
+        'examples': np.asarray(examples, dtype=np.int64).reshape(-1, 6),
+        'review_ids': np.array(review_ids, dtype=str),
+        'review_offsets': np.asarray(review_offsets, dtype=np.int64),
+    }
+    for name in FILE_NAMES:
+        np.save(os.path.join(directory, name + '.npy'), arrays[name])
+
+# Columns written by write_chunk(), in its argument order
+CHUNK_FILE_NAMES = ('features', 'labels', 'texts', 'examples', 'review_ids')
+
+def chunk_file(directory, index, name):
+    ''' Returns the file name of column name of chunk index of the store in directory '''
+    return os.path.join(directory, 'chunks', '%d_%s.npy' % (index, name))
+
+def write_chunk(directory, index, fvs, labels, texts, examples, review_ids):
+    '''
+    Writes chunk index of a feature store that is written one chunk at a
+    time, so that only one chunk has to be in memory. The chunks are joined
+    by join_chunks(). The arguments are as in write_store(), for the
+    examples and reviews of the chunk; the review indexes in examples are
+    those of the whole store.
+    '''
+    if not os.path.exists(os.path.join(directory, 'chunks')):
+        os.makedirs(os.path.join(directory, 'chunks'))
+    arrays = (np.asarray(fvs, dtype=np.float64), np.asarray(labels, dtype=np.int64), np.array(texts, dtype=str),
+              np.asarray(examples, dtype=np.int64).reshape(-1, 6), np.array(review_ids, dtype=str))
+    for name, a in zip(CHUNK_FILE_NAMES, arrays):
+        np.save(chunk_file(directory, index, name), a)
+
+def read_header(filename):
+    ''' Returns (shape, dtype) of the array in a .npy file, without reading the array '''
+    with open(filename, 'rb') as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, _, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, _, dtype = np.lib.format.read_array_header_2_0(f)
+    return shape, dtype
+
+def join_chunks(directory, feature_names, num_chunks, review_offsets):
+    '''
+    Writes the feature store in directory from the chunks 0 to num_chunks - 1
+    written by write_chunk(), and deletes the chunks. Each column is written
+    to a memory-mapped file, one chunk at a time. Strings are padded to the
+    longest string of any chunk, as np.array() would pad them.
+    review_offsets: as described at the top of this file, for the whole store
+    '''
+    if num_chunks == 0:
+        write_store(directory, feature_names, np.zeros((0, len(feature_names))), [], [], np.zeros((0, 6)), [], review_offsets)
+        return
+    np.save(os.path.join(directory, 'feature_names.npy'), np.array(feature_names, dtype=str))
+    np.save(os.path.join(directory, 'review_offsets.npy'), np.asarray(review_offsets, dtype=np.int64))
+    for name in CHUNK_FILE_NAMES:
+        headers = [read_header(chunk_file(directory, i, name)) for i in xrange(num_chunks)]
+        shape = (sum(chunk_shape[0] for chunk_shape, _ in headers),) + headers[0][0][1:]
+        dtype = headers[0][1]
+        if dtype.kind == 'S':
+            dtype = np.dtype((str, max(max(chunk_dtype.itemsize for _, chunk_dtype in headers), 1)))
+        if shape[0] == 0:
+            np.save(os.path.join(directory, name + '.npy'), np.zeros(shape, dtype=dtype))
+            continue
+        column = np.lib.format.open_memmap(os.path.join(directory, name + '.npy'), mode='w+', dtype=dtype, shape=shape)
+        start = 0
+        for i in xrange(num_chunks):
+            a = np.load(chunk_file(directory, i, name))
+            column[start:start + len(a)] = a
+            start += len(a)
+        column.flush()
+        del column
+    assert np.load(os.path.join(directory, 'labels.npy'), mmap_mode='r').shape[0] == review_offsets[-1]
+    shutil.rmtree(os.path.join(directory, 'chunks'))
+
+def read_store(directory, mmap_mode='r'):
+    '''
+    Returns a dictionary from each file name (without .npy) in the feature
+    store to its array. By default the arrays are read-only memory maps, so
+    nothing is read from disk until it is used.
+    '''
+    return dict((name, np.load(os.path.join(directory, name + '.npy'), mmap_mode=mmap_mode)) for name in FILE_NAMES)
+
+def read_reviews(directory):
+    '''
+    Returns a list with one dictionary per review in the feature store, in the
+    original order. Each dictionary has the review_id and the range of rows
+    of the review's examples, so lists of reviews can be shuffled and split
+    the same way as lists of JSON reviews, and then passed to get_rows().
+    '''
+    store = read_store(directory)
+    offsets = store['review_offsets']
+    return [{'review_id': review_id, 'rows': (offsets[i], offsets[i + 1]), 'store': store}
+            for i, review_id in enumerate(store['review_ids'])]
+
+def get_rows(reviews):
+    '''
+    Returns (fvs, labels, texts) for the examples of the reviews returned by
+    read_reviews(), in the order of reviews. texts are decoded to unicode.
+    '''
+    if len(reviews) == 0:
+        return np.zeros((0, 0)), np.zeros(0, dtype=np.int64), np.array([], dtype=unicode)
+    store = reviews[0]['store']
+    assert all(review['store'] is store for review in reviews)
+    rows = np.concatenate([np.arange(start, end) for start, end in (review['rows'] for review in reviews)])
+    rows = rows.astype(np.int64)
+    return store['features'][rows], store['labels'][rows], np.char.decode(store['texts'][rows], 'utf-8')
+
+def json_to_store(lines, directory):
+    '''
+    Converts reviews with feature vectors, one JSON object per line, to a
+    feature store. The span locations are not in the JSON, so examples.npy is
+    filled with -1.
+    '''
+    feature_names = None
+    fvs = []
+    labels = []
+    texts = []
+    review_ids = []
+    review_offsets = [0]
+    for line in lines:
+        review = json.loads(line, object_pairs_hook=OrderedDict)
+        for fv in review['fvs']:
+            names = tuple(feat for feat in fv if feat != 'is_positive' and feat != 'text')
+            if feature_names is None:
+                feature_names = names
+            assert names == feature_names
+            fvs.append([fv[feat] for feat in feature_names])
+            labels.append(fv['is_positive'])
+            texts.append(fv['text'].encode('utf-8'))
+        review_ids.append(review['review_id'].encode('utf-8'))
+        review_offsets.append(len(labels))
+    assert feature_names is not None
+    examples = np.full((len(labels), 6), -1, dtype=np.int64)
+    write_store(directory, feature_names, fvs, labels, texts, examples, review_ids, review_offsets)
+
+def main():
+    with open(argv[1], 'r') as f:
+        json_to_store(f, argv[2])
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,67 @@
 #!/bin/python
 
 """
-Usage: python generate_feature_vectors.py < joined_reviews.json > feature_vectors.json
+Usage: python generate_feature_vectors.py [--workers N] [--store DIR] [--cache cache.sqlite] [--profile] < joined_reviews.json > feature_vectors.json
 
 Prints each review, with an additional key "fvs", to stdout.
 Note that this can be combined with the pipeline for join_reviews.py.
+With --workers N, reviews are processed by N processes, and the output is
+identical to the output of a serial run.
+With --store DIR, nothing is printed, and the same feature vectors are written
+to a feature store in DIR instead (see feature_store.py).
+With --cache, the feature vectors of each review are saved in an SQLite cache,
+and a later run only processes the reviews whose text, restaurant name or
+features have changed. The output is identical to a run without
+--cache.
+With --profile, the time spent on each enabled feature (including the token
+table entries that it needs), and the number of examples per second, are
+printed to stderr.
+Features are declared, and enabled or disabled, in FEATURES. The token table
+entries (TOKEN_TABLE_ENTRIES) that they read are only built when an enabled
+feature needs them, and only over the words of each example.
 """
 
+import argparse
+import bisect
+import collections
+import hashlib
+import itertools
 import json
 import fileinput
+import multiprocessing
+import os
 import random
 import re
+import sqlite3
+import sys
+import timeit
+import numpy as np
+
+import feature_store
 
 from collections import OrderedDict
 
+# Directory of the keyword lexicons, which have one keyword per line
+LEXICON_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "lexicons")
+
+# Must be incremented whenever a change to this file changes the feature vectors, so that cached feature vectors are not reused
+FEATURE_SET_VERSION = 2
+
+# Seeds of the two random number generators that choose the negative examples (see review_random_generators())
+RANDOM_SEEDS = (314, 42)
+
+# Number of reviews passed to build_feature_matrix() at a time when writing a feature store
+STORE_CHUNK_SIZE = 1000
+
+# Number of reviews sent to a worker at a time with --workers
+LINE_CHUNK_SIZE = 16
+
+# Maximum number of chunks per worker that have been read but whose results have not been consumed yet
+MAX_PENDING_CHUNKS_PER_WORKER = 4
+
+# Key in the --profile output for the time spent building each Example
+EXAMPLE_PROFILE_KEY = "(example)"
+
 def get_negative_example_bool(rgen):
     """
     Helper function that returns True if a new negative example should be started, or False otherwise.
@@ -28,6 +76,16 @@ def get_negative_example_length(rgen):
     """
     return rgen.randint(1, 6)
 
+def review_random_generators(review):
+    """
+    Returns (rgen1, rgen2) for choosing the negative examples of a review, seeded from RANDOM_SEEDS and the review_id.
+    The negative examples of a review therefore do not depend on any other review, so inserting or editing
+    a review does not change the examples of the reviews after it.
+    review: A parsed JSON review (a Python dictionary)
+    """
+    review_id = review["review_id"].encode("utf-8")
+    return tuple(random.Random(int(hashlib.sha1("%d:%s" % (seed, review_id)).hexdigest(), 16)) for seed in RANDOM_SEEDS)
+
 def bool_to_int(b):
     """
     Helper function that converts True to 1 and False to 0, and crashes on any other value
@@ -36,169 +94,490 @@ def bool_to_int(b):
     assert isinstance(b, bool)
     return 1 if b else 0
 
-def build_feature_vector(review, raw_review_sentences, parsed_review_sentences, sentence_idx, example_first_word_idx, example_word_length, is_positive):
+def load_lexicon(filename):
     """
-    This function is called for each positive or negative example.
-    An example is part of a sentence. A sentence is part of the review text.
-    Returns a feature vector as a Python dictionary.
-    Arguments are ordered from most general to most specific.
+    Returns a tuple of the keywords in a lexicon file, skipping blank lines and lines starting with "#".
+    filename: the name of the file in LEXICON_DIR
+    """
+    with open(os.path.join(LEXICON_DIR, filename), "r") as f:
+        lines = [line.decode("utf-8").strip() for line in f]
+    return tuple(line for line in lines if line != "" and not line.startswith("#"))
 
-    review: dict containing all information about the review
-    raw_review_sentences: list of the sentences in the review text
-    parsed_review_sentences: list of (word in raw sentence, index of first character in word from start of raw sentence, index of last character in word from start of raw sentence)
-    sentence_idx: the index (in raw_review_sentences and parsed_review_sentences) of the sentence containing the example
-    example_first_word_idx: index (within the parsed sentence) of the first word of the example
-    example_word_length: number of words in the example
-    is_positive: True if the example is positive, or False otherwise
+def trie_pattern(trie):
+    """
+    Helper function for compile_lexicon() that returns the regular expression of a trie node.
+    An empty alternative comes first at a node that ends a keyword, so the shortest keyword at a position is matched.
+    trie: dictionary from each next character to its trie node, where the key None marks the end of a keyword
+    """
+    alternatives = [re.escape(c) + trie_pattern(trie[c]) for c in sorted(k for k in trie if k is not None)]
+    if len(alternatives) == 0:
+        return ""
+    if None in trie:
+        alternatives.insert(0, "")
+    return "(?:" + "|".join(alternatives) + ")"
+
+def compile_lexicon(keywords):
+    """
+    Compiles the keywords into one regular expression, whose matches are the positions where a keyword starts.
+    Group 1 of each match is the shortest keyword that starts there, so that overlapping keywords are all found,
+    and a text contains a keyword if and only if it contains the group 1 of some match.
+    Returns None if there are no keywords.
+    The keywords are stored in a trie, so the regular expression does not try each keyword separately.
+    keywords: iterable of strings
+    """
+    trie = {}
+    for keyword in set(keywords):
+        node = trie
+        for c in keyword:
+            node = node.setdefault(c, {})
+        node[None] = {}
+    if len(trie) == 0:
+        return None
+    return re.compile("(?=(" + trie_pattern(trie) + "))", flags=re.UNICODE)
+
+def find_lexicon(lexicon, text):
+    """
+    Returns (starts, ends) of the occurrences of the lexicon in the text, sorted by start,
+    where at each start only the shortest keyword is included.
+    lexicon: a regular expression returned by compile_lexicon(), or None
+    text: the text to search
+    """
+    starts = []
+    ends = []
+    if lexicon is not None:
+        for match in lexicon.finditer(text):
+            starts.append(match.start(1))
+            ends.append(match.end(1))
+    return starts, ends
+
+def contains_lexicon(occurrences, start, end):
+    """
+    Returns True if text[start:end] contains a keyword, where occurrences is find_lexicon(lexicon, text).
+    occurrences: (starts, ends) returned by find_lexicon()
+    start, end: character indexes of the first and last characters of the range
     """
-    common_cooking_styles = ["baked", "fried", "oven-roasted", "grilled", "roasted"]
-    restaurant_name_splits = review["restaurant"]["name"].split(" ")
-    common_food_names = ["pizza", "burger", "sauce", "cheese", "bread"]
-    common_food_adjectives = ["tasty", "delicious", "spicy", "acidic", "sweet"]
+    starts, ends = occurrences
+    i = bisect.bisect_left(starts, start)
+    while i < len(starts) and starts[i] <= end:
+        if ends[i] <= end:
+            return True
+        i += 1
+    return False
+
+COMMON_COOKING_STYLES = load_lexicon("cooking_styles.txt")
+COMMON_FOOD_NAMES = load_lexicon("food_names.txt")
+COMMON_FOOD_ADJECTIVES = load_lexicon("food_adjectives.txt")
+COOKING_STYLES_LEXICON = compile_lexicon(COMMON_COOKING_STYLES)
+FOOD_NAMES_LEXICON = compile_lexicon(COMMON_FOOD_NAMES)
+FOOD_ADJECTIVES_LEXICON = compile_lexicon(COMMON_FOOD_ADJECTIVES)
 
-    raw_review_sentence = raw_review_sentences[sentence_idx]
-    parsed_review_sentence = parsed_review_sentences[sentence_idx]
+def find_keywords(keywords, text):
+    """
+    Returns (starts, ends) of all occurrences of the keywords in the text, sorted by start, like find_lexicon().
+    This is used instead of a compiled lexicon for the few keywords of a single review, which take longer to compile
+    (and re.compile() only caches 100 patterns) than to search for one at a time.
+    keywords: iterable of strings
+    text: the text to search
+    """
+    occurrences = []
+    for keyword in set(keywords):
+        start = text.find(keyword)
+        while start != -1:
+            occurrences.append((start, start + len(keyword)))
+            start = text.find(keyword, start + 1)
+    occurrences.sort()
+    return [start for start, _ in occurrences], [end for _, end in occurrences]
 
-    text = " ".join(parsed_review_sentence[i][0] for i in xrange(example_first_word_idx, example_first_word_idx + example_word_length)).replace("<", "").replace(">", "").strip().encode("utf-8")
-    raw_text = raw_review_sentence[parsed_review_sentence[example_first_word_idx][1]:parsed_review_sentence[example_first_word_idx + example_word_length - 1][2]]
+def restaurant_name_keywords(review):
+    """
+    Returns the words in the name of the review's restaurant, which are searched for as substrings rather than compiled.
+    review: A parsed JSON review (a Python dictionary)
+    """
+    return review["restaurant"]["name"].split(" ")
 
-    #f1
-    example_len = len(raw_text)
+def clean_word(word):
+    """
+    Helper function that removes the "<" and ">" markers from a word and converts it to lowercase.
+    word: a word in a parsed sentence
+    """
+    return word.replace("<", "").replace(">", "").lower()
 
-    #f2
-    ends_with_s = parsed_review_sentence[example_first_word_idx + example_word_length - 1][0].endswith("s")
+# Registry of the entries of the token table of an example, in the order that they are registered.
+# Maps the name of each entry to (entry function, names of the entries that it needs, True if the entry is per sentence).
+# Entries are built lazily, the first time that a feature reads them with Example.entry(), so only the entries that enabled
+# features need are built, and only over the words of each example rather than over every word of the review.
+TOKEN_TABLE_ENTRIES = OrderedDict()
 
-    #f3
-    is_title = all(parsed_review_sentence[i][0].istitle() for i in xrange(example_first_word_idx, example_first_word_idx + example_word_length))
+def token_table_entry(needs=(), per_sentence=False):
+    """
+    Decorator that adds an entry function to TOKEN_TABLE_ENTRIES. The name of the entry is the name of the function.
+    An entry function takes an Example and returns the entry.
+    needs: names of the entries, registered earlier, that the entry function reads with Example.entry()
+    per_sentence: True if the entry only depends on the sentence, in which case it is built once and shared by all examples in the sentence
+    """
+    def register(function):
+        assert function.__name__ not in TOKEN_TABLE_ENTRIES
+        assert all(name in TOKEN_TABLE_ENTRIES for name in needs)
+        TOKEN_TABLE_ENTRIES[function.__name__] = (function, tuple(needs), per_sentence)
+        return function
+    return register
 
-    #f4
-    has_cooking_style = any(s in raw_text for s in common_cooking_styles)
+@token_table_entry()
+def cleaned_words(example):
+    return [clean_word(word) for word, _, _ in example.words]
 
-    #f5
-    ends_with_common_food_names = any(s in raw_text for s in common_food_names)
+@token_table_entry()
+def num_title(example):
+    return sum(1 for word, _, _ in example.words if word.istitle())
 
-    #f6
-    has_restaurant_name = False
-    if (len(text.split(' ')) > 0):
-        if any(s in raw_text for s in restaurant_name_splits):
-            has_restaurant_name = True
-        else:
-            has_restaurant_name = False
-    
-    #f7
-    relative_position_of_word_in_sentence = float(parsed_review_sentence[example_first_word_idx][1])/len(raw_review_sentence)
-    
-    #f8
-    sentence_contains_adjective_words = any(s in raw_review_sentence for s in common_food_adjectives)
-
-    #f9
-    if example_first_word_idx == 0:
-        is_prev_word_a_definite_artice = False
-    else:
-        prev_word = parsed_review_sentence[example_first_word_idx-1][0]
-        assert isinstance(prev_word, unicode)
-        is_prev_word_a_definite_artice = (prev_word.replace("<", "").replace(">", "").lower() == u"the")
+@token_table_entry(needs=("cleaned_words",))
+def num_the(example):
+    return example.entry("cleaned_words").count(u"the")
 
-    #f10
-    contains_the = any(parsed_review_sentence[i][0].replace("<", "").replace(">", "").lower() == u"the" for i in xrange(example_first_word_idx, example_first_word_idx + example_word_length))
+@token_table_entry(needs=("cleaned_words",))
+def num_indefinite_article(example):
+    return sum(1 for word in example.entry("cleaned_words") if word in (u"a", u"an"))
 
-    #f11
-    num_commas = raw_review_sentence.count(",")
+@token_table_entry(needs=("cleaned_words",))
+def num_ing(example):
+    return sum(1 for word in example.entry("cleaned_words") if word.endswith("ing"))
 
-    #f12
-    sentence_word_length = len(parsed_review_sentence)
+@token_table_entry(needs=("cleaned_words",))
+def num_ed(example):
+    return sum(1 for word in example.entry("cleaned_words") if word.endswith("ed"))
 
-    #f13: example_word_length
-    
-    #f14
-    capital = text[0].isupper()
+@token_table_entry()
+def prev_cleaned_word(example):
+    # None if the example starts the sentence
+    if example.first_word_idx == 0:
+        return None
+    return clean_word(example.parsed_review_sentence[example.first_word_idx - 1][0])
 
-    #f15
-    word_ends_with_ing = any(parsed_review_sentence[i][0].replace("<", "").replace(">", "").lower().endswith("ing") for i in xrange(example_first_word_idx, example_first_word_idx + example_word_length))
+@token_table_entry(per_sentence=True)
+def contains_adjective_words(example):
+    return FOOD_ADJECTIVES_LEXICON is not None and FOOD_ADJECTIVES_LEXICON.search(example.raw_review_sentence) is not None
 
-    #f16
-    word_ends_with_ed = any(parsed_review_sentence[i][0].replace("<", "").replace(">", "").lower().endswith("ed") for i in xrange(example_first_word_idx, example_first_word_idx + example_word_length))
+@token_table_entry(per_sentence=True)
+def num_commas(example):
+    return example.raw_review_sentence.count(",")
 
-    #f17
-    ends_with_es = parsed_review_sentence[example_first_word_idx + example_word_length - 1][0].endswith("es")
+# The lookahead of a compiled lexicon cannot see past the end of raw_text, so a match is a keyword inside the example
 
-    #f18
-    if example_first_word_idx == 0:
-        is_prev_word_an_indefinite_artice = False
-    else:
-        prev_word = parsed_review_sentence[example_first_word_idx-1][0]
-        assert isinstance(prev_word, unicode)
-        is_prev_word_an_indefinite_artice = (prev_word.replace("<", "").replace(">", "").lower() in (u"a", u"an"))
+@token_table_entry()
+def cooking_styles(example):
+    return COOKING_STYLES_LEXICON is not None and COOKING_STYLES_LEXICON.search(example.raw_text) is not None
 
-    #f19
-    contains_indefinite_article = any(parsed_review_sentence[i][0].replace("<", "").replace(">", "").lower() in (u"a", u"an") for i in xrange(example_first_word_idx, example_first_word_idx + example_word_length))
+@token_table_entry()
+def food_names(example):
+    return FOOD_NAMES_LEXICON is not None and FOOD_NAMES_LEXICON.search(example.raw_text) is not None
 
-    #f20
-    word_fraction_capitalized = sum(1 if parsed_review_sentence[i][0].istitle() else 0 for i in xrange(example_first_word_idx, example_first_word_idx + example_word_length)) / example_word_length
+@token_table_entry()
+def restaurant_name(example):
+    return any(keyword in example.raw_text for keyword in restaurant_name_keywords(example.review))
 
-    #f21
-    word_position = example_first_word_idx / len(parsed_review_sentence)
+def required_entries(needs):
+    """
+    Returns the names of the entries in needs and of all entries that they need, in the order of TOKEN_TABLE_ENTRIES.
+    needs: iterable of entry names
+    """
+    required = set()
+    pending = list(needs)
+    while len(pending) > 0:
+        name = pending.pop()
+        if name not in required:
+            required.add(name)
+            pending.extend(TOKEN_TABLE_ENTRIES[name][1])
+    return tuple(name for name in TOKEN_TABLE_ENTRIES if name in required)
+
+def entry_profile_key(name):
+    """
+    Returns the key in the profile dictionary (see build_feature_vector()) of the seconds spent building a token table entry.
+    """
+    return "(token table) " + name
+
+# Registry of all features, in the order of the columns returned by build_feature_matrix().
+# Maps the name of each feature to (feature function, True if enabled, names of the token table entries that it needs).
+# Only the enabled features, and the token table entries that they need, are computed by process_review().
+FEATURES = OrderedDict()
+
+def feature(enabled=True, needs=()):
+    """
+    Decorator that adds a feature function to FEATURES. The name of the feature is the name of the function.
+    A feature function takes an Example and returns a bool, int or float.
+    enabled: True if the feature is part of the feature vectors returned by build_feature_vector(), or False otherwise
+    needs: names of the entries of TOKEN_TABLE_ENTRIES that the feature function reads with Example.entry()
+    """
+    def register(function):
+        assert function.__name__ not in FEATURES
+        assert all(name in TOKEN_TABLE_ENTRIES for name in needs)
+        FEATURES[function.__name__] = (function, enabled, tuple(needs))
+        return function
+    return register
+
+class Example(object):
+    """
+    Everything that the feature functions know about a positive or negative example.
+    An example is part of a sentence. A sentence is part of the review text.
+    """
+    __slots__ = ("review", "raw_review_sentence", "parsed_review_sentence", "sentence_table", "token_table", "profile", "first_word_idx", "end_word_idx", "word_length", "words", "text", "raw_text")
+
+    def __init__(self, review, raw_review_sentence, parsed_review_sentence, sentence_table, example_first_word_idx, example_word_length, profile=None):
+        """
+        review: dict containing all information about the review
+        raw_review_sentence: the sentence containing the example
+        parsed_review_sentence: list of word tuples in the sentence, as in process_review()
+        sentence_table: dictionary of the per-sentence entries that have been built so far, shared by all examples in the sentence
+        example_first_word_idx: index (within the parsed sentence) of the first word of the example
+        example_word_length: number of words in the example
+        profile: see build_feature_vector()
+        """
+        self.review = review
+        self.raw_review_sentence = raw_review_sentence
+        self.parsed_review_sentence = parsed_review_sentence
+        self.sentence_table = sentence_table
+        # The entries of the example that have been built so far
+        self.token_table = {}
+        self.profile = profile
+        # The example consists of the words in [first_word_idx, end_word_idx)
+        self.first_word_idx = example_first_word_idx
+        self.end_word_idx = example_first_word_idx + example_word_length
+        self.word_length = example_word_length
+        self.words = parsed_review_sentence[self.first_word_idx:self.end_word_idx]
+        self.text = " ".join(word for word, _, _ in self.words).replace("<", "").replace(">", "").strip().encode("utf-8")
+        self.raw_text = raw_review_sentence[self.words[0][1]:self.words[-1][2]]
+
+    def entry(self, name):
+        """
+        Returns the entry of TOKEN_TABLE_ENTRIES with the given name, building it (and the entries that it needs) if it has not been built yet.
+        """
+        function, needs, per_sentence = TOKEN_TABLE_ENTRIES[name]
+        table = self.sentence_table if per_sentence else self.token_table
+        if name not in table:
+            if self.profile is None:
+                table[name] = function(self)
+            else:
+                # Build the entries that it needs first, so that each entry is only timed once
+                for need in needs:
+                    self.entry(need)
+                start_time = timeit.default_timer()
+                table[name] = function(self)
+                key = entry_profile_key(name)
+                self.profile[key] = self.profile.get(key, 0.0) + timeit.default_timer() - start_time
+        return table[name]
+
+#f1
+@feature()
+def length(example):
+    return len(example.raw_text)
+
+#f2
+@feature()
+def ends_with_s(example):
+    return example.parsed_review_sentence[example.end_word_idx - 1][0].endswith("s")
+
+#f3
+@feature(enabled=False, needs=("num_title",))
+def all_words_capitalized(example):
+    return example.entry("num_title") == example.word_length
+
+#f4
+@feature(needs=("cooking_styles",))
+def has_cooking_style(example):
+    return example.entry("cooking_styles")
+
+#f5
+@feature(needs=("food_names",))
+def ends_with_common_food_names(example):
+    return example.entry("food_names")
+
+#f6
+@feature(needs=("restaurant_name",))
+def has_restaurant_name(example):
+    return example.entry("restaurant_name")
+
+#f7
+@feature(enabled=False)
+def relative_position_of_word_in_sentence(example):
+    return float(example.parsed_review_sentence[example.first_word_idx][1])/len(example.raw_review_sentence)
+
+#f8
+@feature(needs=("contains_adjective_words",))
+def sentence_contains_adjective_words(example):
+    return example.entry("contains_adjective_words")
+
+#f9
+@feature(needs=("prev_cleaned_word",))
+def is_prev_word_a_definite_artice(example):
+    return example.entry("prev_cleaned_word") == u"the"
+
+#f10
+@feature(needs=("num_the",))
+def contains_the(example):
+    return example.entry("num_the") > 0
+
+#f11
+@feature(enabled=False, needs=("num_commas",))
+def num_commas(example):
+    return example.entry("num_commas")
+
+#f12
+@feature(enabled=False)
+def sentence_word_length(example):
+    return len(example.parsed_review_sentence)
+
+#f13
+@feature()
+def example_word_length(example):
+    return example.word_length
+
+#f14
+@feature()
+def capital(example):
+    return example.text[0].isupper()
+
+#f15
+@feature(enabled=False, needs=("num_ing",))
+def word_ends_with_ing(example):
+    return example.entry("num_ing") > 0
+
+#f16
+@feature(enabled=False, needs=("num_ed",))
+def word_ends_with_ed(example):
+    return example.entry("num_ed") > 0
+
+#f17
+@feature(enabled=False)
+def ends_with_es(example):
+    return example.parsed_review_sentence[example.end_word_idx - 1][0].endswith("es")
+
+#f18
+@feature(enabled=False, needs=("prev_cleaned_word",))
+def is_prev_word_an_indefinite_artice(example):
+    return example.entry("prev_cleaned_word") in (u"a", u"an")
+
+#f19
+@feature(enabled=False, needs=("num_indefinite_article",))
+def contains_indefinite_article(example):
+    return example.entry("num_indefinite_article") > 0
+
+#f20
+@feature(needs=("num_title",))
+def word_fraction_capitalized(example):
+    return example.entry("num_title") / example.word_length
+
+#f21
+@feature(enabled=False)
+def word_position(example):
+    return example.first_word_idx / len(example.parsed_review_sentence)
+
+#f22
+@feature(enabled=False)
+def contains_number(example):
+    return any(str(i) in example.text for i in xrange(0, 10))
+
+# Names of all features, in the order of the columns returned by build_feature_matrix()
+FEATURE_NAMES = tuple(FEATURES)
+
+# Names of the features in the feature vectors returned by build_feature_vector(), in order
+ENABLED_FEATURE_NAMES = tuple(name for name, (_, enabled, _) in FEATURES.iteritems() if enabled)
+
+def build_feature_vector(review, raw_review_sentences, parsed_review_sentences, sentence_tables, sentence_idx, example_first_word_idx, example_word_length, is_positive, profile=None):
+    """
+    This function is called for each positive or negative example.
+    An example is part of a sentence. A sentence is part of the review text.
+    Returns a feature vector as a Python dictionary, with the enabled features in FEATURES.
+    Arguments are ordered from most general to most specific.
+
+    review: dict containing all information about the review
+    raw_review_sentences: list of the sentences in the review text
+    parsed_review_sentences: list of (word in raw sentence, index of first character in word from start of raw sentence, index of last character in word from start of raw sentence)
+    sentence_tables: list of the dictionaries of the per-sentence entries (see Example) of the sentences in the review text
+    sentence_idx: the index (in raw_review_sentences, parsed_review_sentences and sentence_tables) of the sentence containing the example
+    example_first_word_idx: index (within the parsed sentence) of the first word of the example
+    example_word_length: number of words in the example
+    is_positive: True if the example is positive, or False otherwise
+    profile: if not None, a dictionary to which the seconds spent on each feature (and on building the Example) are added,
+    and the seconds spent building each token table entry (see Example.entry())
+    """
+    if profile is not None:
+        start_time = timeit.default_timer()
+    example = Example(review, raw_review_sentences[sentence_idx], parsed_review_sentences[sentence_idx], sentence_tables[sentence_idx], example_first_word_idx, example_word_length, profile)
+    if profile is not None:
+        profile[EXAMPLE_PROFILE_KEY] = profile.get(EXAMPLE_PROFILE_KEY, 0.0) + timeit.default_timer() - start_time
 
-    #f22
-    contains_number = any(str(i) in text for i in xrange(0, 10))
-   
     # Construct the feature vector
-    fv = OrderedDict([
-        ("length", example_len),                                                                #f1
-        ("ends_with_s", bool_to_int(ends_with_s)),                                              #f2
-        #("all_words_capitalized", bool_to_int(is_title)),                                       #f3
-        ("has_cooking_style", bool_to_int(has_cooking_style)),                                  #f4
-        ("ends_with_common_food_names", bool_to_int(ends_with_common_food_names)),              #f5
-        ("has_restaurant_name", bool_to_int(has_restaurant_name)),                              #f6
-        #("relative_position_of_word_in_sentence", relative_position_of_word_in_sentence),       #f7
-        ("sentence_contains_adjective_words", bool_to_int(sentence_contains_adjective_words)),  #f8
-        ("is_prev_word_a_definite_artice", bool_to_int(is_prev_word_a_definite_artice)),        #f9
-        ("contains_the", bool_to_int(contains_the)),                                            #f10
-        #("num_commas", num_commas),                                                             #f11
-        #("sentence_word_length", sentence_word_length),                                         #f12
-        ("example_word_length", example_word_length),                                           #f13
-        ("capital", bool_to_int(capital)),                                                      #f14
-        #("word_ends_with_ing", bool_to_int(word_ends_with_ing)),                                #f15
-        #("word_ends_with_ed", bool_to_int(word_ends_with_ed)),                                  #f16
-        #("ends_with_es", bool_to_int(ends_with_es)),                                            #f17
-        #("is_prev_word_an_indefinite_artice", bool_to_int(is_prev_word_an_indefinite_artice)),  #f18
-        #("contains_indefinite_article", bool_to_int(contains_indefinite_article)),              #f19
-        ("word_fraction_capitalized", word_fraction_capitalized),                               #f20
-        #("word_position", word_position),                                                       #f21
-        #("contains_number", bool_to_int(contains_number)),                                      #f22
-        ("is_positive", bool_to_int(is_positive)),  
-        ("text", text),                                       
-    ])
+    fv = OrderedDict()
+    for name in ENABLED_FEATURE_NAMES:
+        function = FEATURES[name][0]
+        if profile is not None:
+            # Build the entries that the feature needs first, so that their time is not counted as lookups
+            for need in FEATURES[name][2]:
+                example.entry(need)
+            start_time = timeit.default_timer()
+        value = function(example)
+        if profile is not None:
+            profile[name] = profile.get(name, 0.0) + timeit.default_timer() - start_time
+        fv[name] = bool_to_int(value) if isinstance(value, bool) else value
+    fv["is_positive"] = bool_to_int(is_positive)
+    fv["text"] = example.text
 
     # Sanity checks before returning fv
     assert all(isinstance(k, str) for k in fv)
     assert all(type(v) in (int, long, float) for _, v in fv.items()[:-1])
-    assert isinstance(text, str)
+    assert isinstance(example.text, str)
 
     return fv
 
-def process_review(review, rgen1, rgen2):
+def print_profile(profile, num_examples, seconds):
     """
-    Returns a Python list of feature vectors.
-    review: A parsed JSON review (a Python dictionary)
-    rgen*: Random number generators
+    Prints the time spent on each enabled feature, and the number of examples per second, to stderr.
+    The time of a feature is the time of its lookups plus the time of the token table entries that it needs,
+    where the time of an entry that several enabled features need is split evenly between them.
+    profile: dictionary filled in by build_feature_vector() and Example.entry()
+    num_examples: the number of examples
+    seconds: the total running time
+    """
+    num_users = {}
+    for name in ENABLED_FEATURE_NAMES:
+        for entry in required_entries(FEATURES[name][2]):
+            num_users[entry] = num_users.get(entry, 0) + 1
+    rows = [(EXAMPLE_PROFILE_KEY, profile.get(EXAMPLE_PROFILE_KEY, 0.0), 0.0)]
+    for name in ENABLED_FEATURE_NAMES:
+        table_seconds = sum(profile.get(entry_profile_key(entry), 0.0) / num_users[entry] for entry in required_entries(FEATURES[name][2]))
+        rows.append((name, profile.get(name, 0.0), table_seconds))
+    print >> sys.stderr, "%-40s %12s %16s %12s %18s" % ("feature", "lookups (s)", "token table (s)", "total (s)", "per example (us)")
+    for name, lookup_seconds, table_seconds in rows:
+        total = lookup_seconds + table_seconds
+        print >> sys.stderr, "%-40s %12.3f %16.3f %12.3f %18.3f" % (name, lookup_seconds, table_seconds, total, 1e6 * total / max(num_examples, 1))
+    print >> sys.stderr, "%d examples in %.3f s (%.1f examples per second)" % (num_examples, seconds, num_examples / seconds if seconds > 0 else 0.0)
+
+def split_review(review_text):
+    """
+    Splits the review text into sentences,
+    where each sentence is split into word tuples,
+    where each word tuple is (word, character index of first character, character index of last character).
+    Returns (list of raw sentences, list of parsed sentences).
+    review_text: the review text
     """
-    # Create a list of feature vectors, because a review may have multiple feature vectors
-    fvs = []
-    
-    # Split the review text into sentences,
-    # where each sentence is split into word tuples,
-    # where each word tuple is (word, character index of first character, character index of last character)
     raw_review_sentences = []
     parsed_review_sentences = []
-    for raw_review_sentence in review["text"].split("."):
+    for raw_review_sentence in review_text.split("."):
         raw_review_sentences.append(raw_review_sentence)
         parsed_review_sentence = []
         # Must call re.finditer(), not re.findall(), because we want all match information
         for word_match in re.finditer(r"[\w<>][\w<>]*", raw_review_sentence, flags=re.UNICODE):
             parsed_review_sentence.append((word_match.group(0), word_match.start(0), word_match.end(0)))
         parsed_review_sentences.append(parsed_review_sentence)
-    
+    return raw_review_sentences, parsed_review_sentences
+
+def find_examples(parsed_review_sentences, rgen1, rgen2):
+    """
+    Returns a Python list of the positive and negative examples in the review, in the order that their feature vectors are output.
+    Each example is (sentence index, index of first word in sentence, number of words, True if positive or False if negative).
+    parsed_review_sentences: list of parsed sentences, as returned by split_review()
+    rgen*: Random number generators
+    """
+    examples = []
     for sentence_idx, parsed_review_sentence in enumerate(parsed_review_sentences):
         positive_example = []
         negative_example = []
@@ -234,15 +613,16 @@ def process_review(review, rgen1, rgen2):
                 assert positive_example[0][0][0] == "<"
                 assert positive_example[-1][0][-1] == ">"
                 assert all(len(i) == 3 for i in positive_example)
-                fvs.append(build_feature_vector(review, raw_review_sentences, parsed_review_sentences, sentence_idx, word_idx - len(positive_example) + 1, len(positive_example), True))
+                examples.append((sentence_idx, word_idx - len(positive_example) + 1, len(positive_example), True))
                 positive_example = []
      
             # If the current word ends a negative sample
             if negative_example_length == 0:
                 assert len(negative_example) > 0
                 assert all(len(i) == 3 for i in negative_example)
-                if not (negative_example[0][0][0] == "<" and negative_example[-1][0][-1] == ">"):
-                    fvs.append(build_feature_vector(review, raw_review_sentences, parsed_review_sentences, sentence_idx, word_idx - len(negative_example) + 1, len(negative_example), False))
+                # Skip negative examples that are a positive example, or that only consist of "<" and ">" markers and have no text
+                if not (negative_example[0][0][0] == "<" and negative_example[-1][0][-1] == ">") and any(clean_word(word) != "" for word, _, _ in negative_example):
+                    examples.append((sentence_idx, word_idx - len(negative_example) + 1, len(negative_example), False))
                 negative_example = []
                 negative_example_length = None
 
@@ -250,22 +630,415 @@ def process_review(review, rgen1, rgen2):
         assert (len(negative_example) == 0 and negative_example_length is None) or (len(negative_example) > 0 and negative_example_length > 0)
         # negative_example may be non-empty here, but we simply ignore it
 
+    return examples
+
+def all_candidates(review, raw_review_sentences, parsed_review_sentences, max_length=6):
+    """
+    Returns every span of 1 to max_length words in each sentence, as negative examples in the format of find_examples().
+    This is used instead of find_examples() at inference time, when the review text has no "<" or ">" markers.
+    review: A parsed JSON review (a Python dictionary)
+    raw_review_sentences, parsed_review_sentences: as returned by split_review()
+    max_length: the maximum number of words in a span
+    """
+    return [(sentence_idx, first_word_idx, word_length, False)
+            for sentence_idx, parsed_review_sentence in enumerate(parsed_review_sentences)
+            for first_word_idx in xrange(len(parsed_review_sentence))
+            for word_length in xrange(1, min(max_length, len(parsed_review_sentence) - first_word_idx) + 1)]
+
+def process_review(review, profile=None):
+    """
+    Returns a Python list of feature vectors.
+    review: A parsed JSON review (a Python dictionary)
+    profile: see build_feature_vector()
+    """
+    raw_review_sentences, parsed_review_sentences = split_review(review["text"])
+
+    # The per-sentence entries are built the first time that an example in the sentence needs them, and shared by the later examples
+    sentence_tables = [{} for _ in raw_review_sentences]
+
+    # Create a list of feature vectors, because a review may have multiple feature vectors
+    fvs = []
+    rgen1, rgen2 = review_random_generators(review)
+    for sentence_idx, example_first_word_idx, example_word_length, is_positive in find_examples(parsed_review_sentences, rgen1, rgen2):
+        fvs.append(build_feature_vector(review, raw_review_sentences, parsed_review_sentences, sentence_tables, sentence_idx, example_first_word_idx, example_word_length, is_positive, profile))
+    return fvs
+
+def contains_occurrence(occurrences, num_chars, example_starts, example_ends):
+    """
+    Helper function for build_feature_matrix().
+    Returns a boolean vector that is True for each example that contains an entire occurrence.
+    For each character index, computes the smallest end of an occurrence that starts at or after the index,
+    so that each example needs a single lookup.
+    occurrences: list of (start, end) of keyword occurrences
+    num_chars: upper bound on all character indexes
+    example_starts, example_ends: vectors of the character indexes of the first and last characters of each example
+    """
+    min_ends = np.full(num_chars + 1, num_chars + 1, dtype=np.int64)
+    if len(occurrences) > 0:
+        occurrences = np.array(occurrences, dtype=np.int64)
+        np.minimum.at(min_ends, occurrences[:, 0], occurrences[:, 1])
+    min_ends = np.minimum.accumulate(min_ends[::-1])[::-1]
+    return min_ends[example_starts] <= example_ends
+
+def build_feature_matrix(reviews, feature_names=FEATURE_NAMES, candidates=None):
+    """
+    Batch version of process_review(), which is called for a chunk of reviews.
+    Computes the features in feature_names (by default, all features in FEATURES) of every example at once, with NumPy operations over arrays of all words in the chunk,
+    instead of building a feature vector dictionary for each example. Only the per-word arrays that these features need are computed.
+    The examples, and their order, are the same as when calling process_review() on each review in turn.
+    Returns (fvs, labels, examples), where
+    fvs is a float matrix with one row per example and one column per feature in feature_names,
+    labels is an int vector, which is 1 for positive examples and 0 for negative examples,
+    examples is an int matrix with one row (index of review, index of sentence, index of first word in sentence, number of words,
+    character index of first character in review text, character index of last character in review text) per example.
+
+    reviews: list of parsed JSON reviews
+    feature_names: names of the features to compute, in order
+    candidates: if not None, a function such as all_candidates() that is called instead of find_examples() on each review
+    with (review, raw_review_sentences, parsed_review_sentences), in which case the reviews need no review_id
+    """
+    # Character indexes are global: review i starts at review_char_offsets[i], and reviews are separated by one character
+    review_char_offsets = []
+    num_chars = 0
+
+    # All words in the chunk
+    words = []
+
+    # Per-sentence lists, over all sentences in the chunk
+    raw_sentences = []
+    sentence_first_words = []
+    sentence_char_offsets = []
+    sentence_word_lengths = []
+
+    # Per-example rows: (review index, sentence index, first word index, word length, start, end, global sentence index, is_positive)
+    example_rows = []
+
+    cooking_style_occurrences = []
+    food_name_occurrences = []
+    restaurant_name_occurrences = []
+
+    for review_idx, review in enumerate(reviews):
+        review_text = review["text"]
+        review_char_offsets.append(num_chars)
+        raw_review_sentences, parsed_review_sentences = split_review(review_text)
+
+        first_sentence_idx = len(sentence_first_words)
+        sentence_char_offset = 0
+        for raw_review_sentence, parsed_review_sentence in zip(raw_review_sentences, parsed_review_sentences):
+            # Character index of the start of the sentence in the review text
+            sentence_char_offsets.append(sentence_char_offset)
+            sentence_char_offset += len(raw_review_sentence) + 1
+            raw_sentences.append(raw_review_sentence)
+            sentence_first_words.append(len(words))
+            sentence_word_lengths.append(len(parsed_review_sentence))
+            words.extend(word for word, _, _ in parsed_review_sentence)
+
+        if candidates is None:
+            examples = find_examples(parsed_review_sentences, *review_random_generators(review))
+        else:
+            examples = candidates(review, raw_review_sentences, parsed_review_sentences)
+        for sentence_idx, example_first_word_idx, example_word_length, is_positive in examples:
+            parsed_review_sentence = parsed_review_sentences[sentence_idx]
+            sentence_char_offset = sentence_char_offsets[first_sentence_idx + sentence_idx]
+            example_start = sentence_char_offset + parsed_review_sentence[example_first_word_idx][1]
+            example_end = sentence_char_offset + parsed_review_sentence[example_first_word_idx + example_word_length - 1][2]
+            example_rows.append((review_idx, sentence_idx, example_first_word_idx, example_word_length, example_start, example_end, first_sentence_idx + sentence_idx, bool_to_int(is_positive)))
+
+        # The lexicons can be matched against the whole review text, because an occurrence is only counted if it is inside an example
+        for feature_name, find, occurrences in (
+                ("has_cooking_style", lambda: find_lexicon(COOKING_STYLES_LEXICON, review_text), cooking_style_occurrences),
+                ("ends_with_common_food_names", lambda: find_lexicon(FOOD_NAMES_LEXICON, review_text), food_name_occurrences),
+                ("has_restaurant_name", lambda: find_keywords(restaurant_name_keywords(review), review_text), restaurant_name_occurrences)):
+            if feature_name in feature_names:
+                starts, ends = find()
+                occurrences.extend((num_chars + start, num_chars + end) for start, end in zip(starts, ends))
+        num_chars += len(review_text) + 1
+
+    example_rows = np.array(example_rows, dtype=np.int64).reshape(-1, 8)
+    sentence_idxs = example_rows[:, 6]
+    word_lengths = example_rows[:, 3]
+    first_words = np.array(sentence_first_words, dtype=np.int64)[sentence_idxs] + example_rows[:, 2]
+    end_words = first_words + word_lengths
+    starts = np.array(review_char_offsets, dtype=np.int64)[example_rows[:, 0]] + example_rows[:, 4]
+    ends = np.array(review_char_offsets, dtype=np.int64)[example_rows[:, 0]] + example_rows[:, 5]
+    has_prev_word = example_rows[:, 2] > 0
+
+    # Per-word arrays, over all words in the chunk. Each one is computed with NumPy string operations,
+    # the first time that a requested feature needs it, so the other features cost nothing.
+    all_words = np.array(words, dtype=unicode)
+    word_arrays = {}
+
+    def capitals():
+        # f14 looks at the first character of the example text, which skips words consisting only of "<" and ">",
+        # so such a word takes the flag of the next word in its sentence that has a character (or False if there is none)
+        stripped_words = word_array("stripped")
+        first_chars = stripped_words.astype("<U1")
+        is_upper = (first_chars >= u"A") & (first_chars <= u"Z")
+        has_chars = np.char.str_len(stripped_words) > 0
+        sentence_ends = np.repeat(np.array(sentence_first_words, dtype=np.int64) + sentence_word_lengths, sentence_word_lengths)
+        next_with_chars = np.minimum.accumulate(np.where(has_chars, np.arange(len(all_words)), len(all_words))[::-1])[::-1]
+        return (next_with_chars < sentence_ends) & is_upper[np.minimum(next_with_chars, len(all_words) - 1)]
+
+    def split_words(text):
+        # Words have no spaces, and removing the markers or converting to lowercase neither adds nor removes spaces,
+        # so all words are transformed at once by joining them with spaces, transforming the text, and splitting it again
+        return np.array(text.split(u" ") if len(words) > 0 else [], dtype=unicode)
+
+    word_functions = {
+        "stripped_text": lambda: u" ".join(words).replace(u"<", u"").replace(u">", u""),
+        "stripped": lambda: split_words(word_array("stripped_text")),
+        "cleaned": lambda: split_words(word_array("stripped_text").lower()),
+        "title": lambda: np.char.istitle(all_words),
+        "the": lambda: word_array("cleaned") == u"the",
+        "indefinite_article": lambda: (word_array("cleaned") == u"a") | (word_array("cleaned") == u"an"),
+        "ing": lambda: np.char.endswith(word_array("cleaned"), u"ing"),
+        "ed": lambda: np.char.endswith(word_array("cleaned"), u"ed"),
+        # A word contains a digit if deleting the digits makes it shorter
+        "number": lambda: np.char.str_len(np.char.translate(all_words, dict.fromkeys(map(ord, u"0123456789")))) < np.char.str_len(all_words),
+        "ends_with_s": lambda: np.char.endswith(all_words, u"s"),
+        "ends_with_es": lambda: np.char.endswith(all_words, u"es"),
+        "capital": capitals,
+    }
+
+    def word_array(key):
+        if key not in word_arrays:
+            word_arrays[key] = word_functions[key]()
+        return word_arrays[key]
+
+    def count_in_examples(key):
+        sums = np.concatenate(([0], np.cumsum(word_array(key), dtype=np.int64)))
+        return sums[end_words] - sums[first_words]
+
+    def prev_word(key):
+        return has_prev_word & word_array(key)[np.maximum(first_words - 1, 0)]
+
+    sentence_word_length = np.array(sentence_word_lengths, dtype=np.int64)[sentence_idxs]
+    starts_in_sentence = example_rows[:, 4] - np.array(sentence_char_offsets, dtype=np.int64)[sentence_idxs]
+
+    columns = OrderedDict([
+        ("length", lambda: ends - starts),                                                                  #f1
+        ("ends_with_s", lambda: word_array("ends_with_s")[end_words - 1]),                                  #f2
+        ("all_words_capitalized", lambda: count_in_examples("title") == word_lengths),                       #f3
+        ("has_cooking_style", lambda: contains_occurrence(cooking_style_occurrences, num_chars, starts, ends)), #f4
+        ("ends_with_common_food_names", lambda: contains_occurrence(food_name_occurrences, num_chars, starts, ends)), #f5
+        ("has_restaurant_name", lambda: contains_occurrence(restaurant_name_occurrences, num_chars, starts, ends)), #f6
+        ("relative_position_of_word_in_sentence", lambda: starts_in_sentence / np.array([len(s) for s in raw_sentences], dtype=np.float64)[sentence_idxs]), #f7
+        ("sentence_contains_adjective_words", lambda: np.array([FOOD_ADJECTIVES_LEXICON is not None and FOOD_ADJECTIVES_LEXICON.search(s) is not None for s in raw_sentences], dtype=bool)[sentence_idxs]), #f8
+        ("is_prev_word_a_definite_artice", lambda: prev_word("the")),                                       #f9
+        ("contains_the", lambda: count_in_examples("the") > 0),                                             #f10
+        ("num_commas", lambda: np.array([s.count(",") for s in raw_sentences], dtype=np.int64)[sentence_idxs]), #f11
+        ("sentence_word_length", lambda: sentence_word_length),                                             #f12
+        ("example_word_length", lambda: word_lengths),                                                      #f13
+        ("capital", lambda: word_array("capital")[first_words]),                                            #f14
+        ("word_ends_with_ing", lambda: count_in_examples("ing") > 0),                                       #f15
+        ("word_ends_with_ed", lambda: count_in_examples("ed") > 0),                                         #f16
+        ("ends_with_es", lambda: word_array("ends_with_es")[end_words - 1]),                                #f17
+        ("is_prev_word_an_indefinite_artice", lambda: prev_word("indefinite_article")),                     #f18
+        ("contains_indefinite_article", lambda: count_in_examples("indefinite_article") > 0),               #f19
+        ("word_fraction_capitalized", lambda: count_in_examples("title") // word_lengths),                   #f20
+        ("word_position", lambda: example_rows[:, 2] // sentence_word_length),                              #f21
+        ("contains_number", lambda: count_in_examples("number") > 0),                                       #f22
+    ])
+    assert tuple(columns) == FEATURE_NAMES
+
+    # Only the requested columns, and the per-word arrays that they need, are computed
+    fvs = np.empty((len(example_rows), len(feature_names)), dtype=np.float64)
+    for i, name in enumerate(feature_names):
+        fvs[:, i] = columns[name]()
+    return fvs, example_rows[:, 7], example_rows[:, :6]
+
+def process_lines(lines):
+    """
+    Worker function for the parallel mode. Returns the output lines for a chunk of reviews.
+    Each line is only parsed here, in the worker.
+    lines: list of JSON reviews
+    """
+    output_lines = []
+    for line in lines:
+        review = json.loads(line, object_pairs_hook=OrderedDict)
+        review["fvs"] = process_review(review)
+        output_lines.append(json.dumps(review, separators=(",", ":")))
+    return output_lines
+
+def chunk_lines(lines, chunk_size):
+    """
+    Yields lists of chunk_size lines (the last one may be shorter).
+    lines: iterable of JSON reviews
+    chunk_size: maximum number of reviews in a chunk
+    """
+    lines = iter(lines)
+    while True:
+        chunk = list(itertools.islice(lines, chunk_size))
+        if len(chunk) == 0:
+            return
+        yield chunk
+
+def imap_bounded(pool, function, tasks, max_pending):
+    """
+    Same as pool.imap(function, tasks), which yields the results in input order, but reads the next task only when fewer than
+    max_pending tasks are waiting for their results to be consumed. pool.imap() reads all tasks as fast as it can, so with a
+    large input, or a slow consumer, the pending lines and results would fill the memory.
+    pool: a multiprocessing.Pool
+    function: the worker function
+    tasks: iterable of the arguments of function
+    max_pending: maximum number of tasks that have been read but whose results have not been yielded
+    """
+    pending = collections.deque()
+    for task in tasks:
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+        pending.append(pool.apply_async(function, (task,)))
+    while len(pending) > 0:
+        yield pending.popleft().get()
+
+def example_text(review_text, example_start, example_end):
+    """
+    Returns the "text" of an example, as in build_feature_vector().
+    review_text: the review text
+    example_start, example_end: character indexes of the first and last characters of the example, as returned by build_feature_matrix()
+    """
+    # The example is within a sentence and starts and ends with a word, so its words are exactly the words in the slice
+    words = [word_match.group(0) for word_match in re.finditer(r"[\w<>][\w<>]*", review_text[example_start:example_end], flags=re.UNICODE)]
+    return " ".join(words).replace("<", "").replace(">", "").strip().encode("utf-8")
+
+def process_store_chunk(lines):
+    """
+    Worker function for the feature store mode. Returns the feature store columns for a chunk of reviews:
+    (fvs, labels, texts, examples, review ids, number of examples of each review).
+    lines: list of JSON reviews
+    """
+    reviews = [json.loads(line) for line in lines]
+    fvs, labels, examples = build_feature_matrix(reviews, ENABLED_FEATURE_NAMES)
+    texts = [example_text(reviews[row[0]]["text"], row[4], row[5]) for row in examples]
+    review_ids = [review["review_id"].encode("utf-8") for review in reviews]
+    num_examples = np.bincount(examples[:, 0], minlength=len(reviews))
+    return fvs, labels, texts, examples, review_ids, num_examples
+
+def write_feature_store(lines, directory, workers):
+    """
+    Writes the feature vectors of the reviews to a feature store in directory.
+    The feature vectors are the same as those printed in the default mode.
+    Each chunk is written as soon as its results arrive, so only the review offsets, and the chunks in the bounded window of
+    imap_bounded(), are in memory at any time.
+    lines: iterable of JSON reviews
+    workers: number of processes
+    """
+    tasks = chunk_lines(lines, STORE_CHUNK_SIZE)
+    if workers > 1:
+        pool = multiprocessing.Pool(workers)
+        results = imap_bounded(pool, process_store_chunk, tasks, MAX_PENDING_CHUNKS_PER_WORKER * workers)
+    else:
+        pool = None
+        results = itertools.imap(process_store_chunk, tasks)
+
+    num_chunks = 0
+    review_offsets = [0]
+    for fvs, labels, texts, examples, review_ids, num_examples in results:
+        # Make the review index in each example global rather than relative to its chunk
+        examples = examples + np.array([len(review_offsets) - 1, 0, 0, 0, 0, 0])
+        feature_store.write_chunk(directory, num_chunks, fvs, labels, texts, examples, review_ids)
+        review_offsets.extend(review_offsets[-1] + np.cumsum(num_examples))
+        num_chunks += 1
+    if pool is not None:
+        pool.close()
+        pool.join()
+    feature_store.join_chunks(directory, ENABLED_FEATURE_NAMES, num_chunks, review_offsets)
+
+def cache_key(review):
+    """
+    Returns a hash of everything that process_review() depends on: the review text, the restaurant name,
+    the feature set, and the lexicons. The random numbers only depend on the review_id, which is the key of the cache table.
+    review: A parsed JSON review (a Python dictionary)
+    """
+    h = hashlib.sha1()
+    h.update(json.dumps([FEATURE_SET_VERSION, RANDOM_SEEDS, ENABLED_FEATURE_NAMES, COMMON_COOKING_STYLES, COMMON_FOOD_NAMES, COMMON_FOOD_ADJECTIVES, review["text"], review["restaurant"]["name"]]))
+    return h.hexdigest()
+
+def process_review_cached(review, connection):
+    """
+    Same as process_review(), but reuses the feature vectors saved in the cache if the cache key has not changed,
+    and otherwise saves the new feature vectors in the cache.
+    review: A parsed JSON review (a Python dictionary)
+    connection: the SQLite connection of the cache
+    """
+    key = cache_key(review)
+    row = connection.execute("SELECT fvs FROM fvs WHERE review_id = ? AND key = ?", (review["review_id"], key)).fetchone()
+    if row is not None:
+        return json.loads(row[0], object_pairs_hook=OrderedDict)
+    fvs = process_review(review)
+    connection.execute("INSERT OR REPLACE INTO fvs VALUES (?, ?, ?)", (review["review_id"], key, json.dumps(fvs, separators=(",", ":"))))
     return fvs
 
+def open_cache(filename):
+    """
+    Returns an SQLite connection to the cache, creating the cache if necessary.
+    filename: the name of the cache file
+    """
+    connection = sqlite3.connect(filename)
+    connection.execute("CREATE TABLE IF NOT EXISTS fvs (review_id TEXT PRIMARY KEY, key TEXT, fvs TEXT)")
+    return connection
+
 def main():
-    rgen1 = random.Random()
-    rgen2 = random.Random()
-    rgen1.seed(314)
-    rgen2.seed(42)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=1, help="number of processes")
+    parser.add_argument("--store", help="directory of the feature store to write")
+    parser.add_argument("--cache", help="SQLite file in which to cache the feature vectors of each review")
+    parser.add_argument("--profile", action="store_true", help="print the time spent on each feature to stderr")
+    parser.add_argument("files", nargs="*")
+    args = parser.parse_args()
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    # Only the reviews that are not in the cache need to be processed, so the cache is only supported in serial mode
+    if args.cache is not None and args.workers > 1:
+        parser.error("--cache cannot be combined with --workers greater than 1")
+    if args.cache is not None and args.store is not None:
+        parser.error("--cache cannot be combined with --store")
+    # Profiling times build_feature_vector() in this process
+    if args.profile and args.workers > 1:
+        parser.error("--profile cannot be combined with --workers greater than 1")
+    if args.profile and args.store is not None:
+        parser.error("--profile cannot be combined with --store")
+    if args.profile and args.cache is not None:
+        parser.error("--profile cannot be combined with --cache")
+
+    if args.store is not None:
+        write_feature_store(fileinput.input(args.files), args.store, args.workers)
+        return
+
+    if args.workers > 1:
+        # imap_bounded() returns the results in input order
+        pool = multiprocessing.Pool(args.workers)
+        tasks = chunk_lines(fileinput.input(args.files), LINE_CHUNK_SIZE)
+        for output_lines in imap_bounded(pool, process_lines, tasks, MAX_PENDING_CHUNKS_PER_WORKER * args.workers):
+            for output_line in output_lines:
+                print output_line
+        pool.close()
+        pool.join()
+        return
+
+    connection = open_cache(args.cache) if args.cache is not None else None
+    profile = {} if args.profile else None
+    num_examples = 0
+    start_time = timeit.default_timer()
 
     # Read one line from stdin at a time
-    for line in fileinput.input():
+    for line in fileinput.input(args.files):
         review = json.loads(line, object_pairs_hook=OrderedDict)
-        fvs = process_review(review, rgen1, rgen2)
+        if connection is not None:
+            fvs = process_review_cached(review, connection)
+        else:
+            fvs = process_review(review, profile)
+        num_examples += len(fvs)
 
         # Probably printing out more information than necessary...
         review["fvs"] = fvs
         print json.dumps(review, separators=(",", ":"))
 
+    if connection is not None:
+        connection.commit()
+        connection.close()
+    if profile is not None:
+        print_profile(profile, num_examples, timeit.default_timer() - start_time)
+
 if __name__ == "__main__":
     main()
@@ -1,42 +1,127 @@
 #!/bin/python
 
 """
-Usage: python join_reviews.py yelp_restaurants.json yelp_users.json labeled_reviews.json > joined_reviews.json
+Usage: python join_reviews.py [--restaurant-fields F1,F2,...] [--user-fields F1,F2,...] [--index index.sqlite] yelp_restaurants.json yelp_users.json labeled_reviews.json > joined_reviews.json
 
 Prints each review, with additional keys "restaurant" and "user", to stdout.
+With --restaurant-fields or --user-fields, only those attributes of each restaurant or user are kept;
+for example, generate_feature_vectors.py only needs --restaurant-fields name.
+With --index, the restaurants and users are kept in an on-disk SQLite index instead of in memory,
+so memory usage does not grow with the size of the restaurant and user files.
+The index is reused by later runs with the same input files and fields.
 """
 
+import argparse
 import json
 import os
-import sys
+import sqlite3
 
 from collections import OrderedDict
 
-def read_file(filename, key):
+def project(parsed, fields):
     """
-    Converts the file of JSON objects to a Python dictionary, whose keys are the unique attribute of each JSON object.
+    Returns the JSON object with only the attributes in fields, in their original order.
+    parsed: the JSON object
+    fields: collection of attribute names, or None to keep all attributes
+    """
+    if fields is None:
+        return parsed
+    return OrderedDict((k, v) for k, v in parsed.iteritems() if k in fields)
+
+def read_objects(filename, key, fields=None):
+    """
+    Yields (unique attribute, JSON object without the unique attribute) for each JSON object in the file.
     filename: the name of the file
-    key: the JSON attribute that will become a key of the dictionary
+    key: the unique JSON attribute
+    fields: collection of attribute names to keep, or None to keep all attributes
     """
-    d = {}
     with open(filename, "r") as f:
         for line in f:
             parsed = json.loads(line, object_pairs_hook=OrderedDict)
             key_value = parsed.pop(key)
-            assert key_value not in d
-            d[key_value] = parsed
+            yield key_value, project(parsed, fields)
+
+def read_file(filename, key, fields=None):
+    """
+    Converts the file of JSON objects to a Python dictionary, whose keys are the unique attribute of each JSON object.
+    filename: the name of the file
+    key: the JSON attribute that will become a key of the dictionary
+    fields: collection of attribute names to keep, or None to keep all attributes
+    """
+    d = {}
+    for key_value, parsed in read_objects(filename, key, fields):
+        assert key_value not in d
+        d[key_value] = parsed
     return d
 
+class SqliteTable(object):
+    """
+    Read-only dictionary from the unique attribute of each JSON object to the JSON object, stored in an SQLite table.
+    Supports the same lookups as the dictionary returned by read_file().
+    """
+    def __init__(self, connection, table):
+        self.connection = connection
+        self.table = table
+
+    def __getitem__(self, key_value):
+        row = self.connection.execute("SELECT value FROM %s WHERE key = ?" % self.table, (key_value,)).fetchone()
+        if row is None:
+            raise KeyError(key_value)
+        return json.loads(row[0], object_pairs_hook=OrderedDict)
+
+def index_file(connection, table, filename, key, fields=None):
+    """
+    Same as read_file(), but stores the JSON objects in an SQLite table and returns a SqliteTable.
+    The table is only rebuilt if the file or fields have changed since it was built.
+    connection: the SQLite connection
+    table: the name of the table
+    filename, key, fields: see read_file()
+    """
+    stat = os.stat(filename)
+    source = json.dumps([os.path.abspath(filename), stat.st_size, stat.st_mtime, key, sorted(fields) if fields is not None else None])
+    connection.execute("CREATE TABLE IF NOT EXISTS sources (name TEXT PRIMARY KEY, source TEXT)")
+    row = connection.execute("SELECT source FROM sources WHERE name = ?", (table,)).fetchone()
+    if row is None or row[0] != source:
+        connection.execute("DROP TABLE IF EXISTS %s" % table)
+        connection.execute("CREATE TABLE %s (key TEXT PRIMARY KEY, value TEXT)" % table)
+        connection.executemany("INSERT INTO %s VALUES (?, ?)" % table,
+                               ((key_value, json.dumps(parsed, separators=(",", ":"))) for key_value, parsed in read_objects(filename, key, fields)))
+        connection.execute("INSERT OR REPLACE INTO sources VALUES (?, ?)", (table, source))
+        connection.commit()
+    return SqliteTable(connection, table)
+
+def parse_fields(fields):
+    """
+    Converts a comma-separated list of attribute names to a set, or None to None.
+    """
+    if fields is None:
+        return None
+    return set(fields.split(","))
+
 def main():
-    assert len(sys.argv) == 4
-    assert os.path.exists(sys.argv[1])
-    assert os.path.exists(sys.argv[2])
-    assert os.path.exists(sys.argv[3])
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--restaurant-fields", help="comma-separated restaurant attributes to keep")
+    parser.add_argument("--user-fields", help="comma-separated user attributes to keep")
+    parser.add_argument("--index", help="SQLite file in which to index the restaurants and users")
+    parser.add_argument("restaurants")
+    parser.add_argument("users")
+    parser.add_argument("reviews")
+    args = parser.parse_args()
+    assert os.path.exists(args.restaurants)
+    assert os.path.exists(args.users)
+    assert os.path.exists(args.reviews)
+    restaurant_fields = parse_fields(args.restaurant_fields)
+    user_fields = parse_fields(args.user_fields)
 
-    restaurants = read_file(sys.argv[1], "business_id")
-    users = read_file(sys.argv[2], "user_id")
+    if args.index is not None:
+        connection = sqlite3.connect(args.index)
+        restaurants = index_file(connection, "restaurants", args.restaurants, "business_id", restaurant_fields)
+        users = index_file(connection, "users", args.users, "user_id", user_fields)
+    else:
+        restaurants = read_file(args.restaurants, "business_id", restaurant_fields)
+        users = read_file(args.users, "user_id", user_fields)
 
-    with open(sys.argv[3], "r") as reviews_file:
+    with open(args.reviews, "r") as reviews_file:
         for line in reviews_file:
             review = json.loads(line, object_pairs_hook=OrderedDict)
             restaurant_id = review["business_id"]
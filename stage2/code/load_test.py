@@ -0,0 +1,86 @@
+'''
+Usage:
+    python load_test.py joined_reviews.json [--url http://localhost:8838/extract] [--clients 16] [--requests 2000]
+
+Load test for serve.py. Sends the reviews in joined_reviews.json (in the
+format of join_reviews.py), with their <menu item> markers removed, to a
+running serve.py from --clients concurrent clients, one review per request,
+until --requests requests have been answered, and prints the throughput and
+the latency percentiles, in milliseconds.
+'''
+
+import argparse
+import httplib
+import json
+import threading
+import timeit
+import urlparse
+import numpy as np
+
+def unmarked_review(review):
+    '''
+    Returns the part of review that serve.py uses, with the menu item markers
+    removed from its text, as a request body.
+    '''
+    text = review['text'].replace(u'<', u'').replace(u'>', u'')
+    return json.dumps({'text': text, 'restaurant': {'name': review['restaurant']['name']}})
+
+def run_client(url, bodies, first, count, latencies, errors):
+    '''
+    Sends bodies[first], bodies[first + 1], ... (wrapping around) until count
+    requests have been sent, appending the latency of each request, in
+    seconds, to latencies, and the requests that failed to errors.
+    '''
+    for i in xrange(first, first + count):
+        body = bodies[i % len(bodies)]
+        start_time = timeit.default_timer()
+        connection = httplib.HTTPConnection(url.hostname, url.port)
+        try:
+            connection.request('POST', url.path, body, {'Content-Type': 'application/json'})
+            response = connection.getresponse()
+            response.read()
+            status = response.status
+        except (httplib.HTTPException, IOError):
+            status = None
+        finally:
+            connection.close()
+        if status == 200:
+            latencies.append(timeit.default_timer() - start_time)
+        else:
+            errors.append(status)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('reviews', help='joined reviews, one JSON review per line')
+    parser.add_argument('--url', default='http://localhost:8838/extract')
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--requests', type=int, default=2000)
+    args = parser.parse_args()
+
+    with open(args.reviews, 'r') as f:
+        bodies = [unmarked_review(json.loads(line)) for line in f]
+    url = urlparse.urlparse(args.url)
+    latencies = []
+    errors = []
+    threads = []
+    start_time = timeit.default_timer()
+    for client in xrange(args.clients):
+        # Client i sends the requests i * n ... (i + 1) * n - 1, so the clients send different reviews
+        first = client * args.requests // args.clients
+        count = (client + 1) * args.requests // args.clients - first
+        thread = threading.Thread(target=run_client, args=(url, bodies, first, count, latencies, errors))
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    elapsed = timeit.default_timer() - start_time
+
+    print 'clients:', args.clients
+    print 'requests:', len(latencies), 'answered,', len(errors), 'failed'
+    print 'throughput: %.1f requests/s' % (len(latencies) / elapsed)
+    if len(latencies) > 0:
+        p50, p90, p99 = np.percentile(latencies, [50, 90, 99]) * 1000
+        print 'latency (ms): p50 %.1f, p90 %.1f, p99 %.1f, max %.1f' % (p50, p90, p99, max(latencies) * 1000)
+
+if __name__ == '__main__':
+    main()
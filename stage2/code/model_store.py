@@ -0,0 +1,183 @@
+'''
+Model artifact store, shared by debugM.py, classifiers.py, serve.py,
+stage3/CODE/stage3.py and stage4/merge_tables.py, so that a trained model is
+loaded instead of being retrained when its training data has not changed.
+atomic_write() is also used for the other files that later runs reuse.
+
+A store is a directory with one subdirectory per model name, containing
+    CURRENT: the name of the version subdirectory of the saved model
+    a version subdirectory, with
+        model.pkl: the trained model, saved with joblib so that its NumPy
+            arrays are memory-mapped when it is loaded
+        metadata.json: the store format version, the scikit-learn version,
+            the feature schema (the names of the feature columns, in order),
+            and the hash of the training data
+A saved model is only loaded if all of its metadata matches.
+'''
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+import sklearn
+try:
+    import joblib
+except ImportError:
+    from sklearn.externals import joblib
+
+FORMAT_VERSION = 1
+
+# Name of the file, in the subdirectory of a model, with the name of its current version subdirectory
+CURRENT_FILE = 'CURRENT'
+
+def training_hash(*parts):
+    '''
+    Returns a hex digest of the training data and anything else that
+    determines the trained model, such as repr() of the untrained model.
+    parts: NumPy arrays, pandas DataFrames, or other objects, which are hashed
+        by their repr()
+    '''
+    h = hashlib.sha1()
+    for part in parts:
+        if hasattr(part, 'columns'):
+            # pandas DataFrame, which may have object columns
+            import pandas as pd
+            h.update(json.dumps([str(column) for column in part.columns]))
+            part = pd.util.hash_pandas_object(part, index=True).values
+        if isinstance(part, np.ndarray):
+            h.update(str(part.dtype) + str(part.shape))
+            h.update(np.ascontiguousarray(part).tobytes())
+        else:
+            h.update(repr(part))
+        h.update('\0')
+    return h.hexdigest()
+
+def current_version(directory, name):
+    '''
+    Returns the version subdirectory of the saved model, or None if there is
+    no saved model.
+    '''
+    try:
+        with open(os.path.join(directory, name, CURRENT_FILE), 'r') as f:
+            return os.path.join(directory, name, f.read().strip())
+    except IOError:
+        return None
+
+def read_metadata(version_dir):
+    '''
+    Returns the metadata of the saved model in version_dir, or None if there is none.
+    '''
+    try:
+        with open(os.path.join(version_dir, 'metadata.json'), 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+def load_model(directory, name, schema=None, data_hash=None, mmap_mode='r'):
+    '''
+    Returns (model, schema) of the saved model, or None if there is no saved
+    model with the same format and scikit-learn versions, schema and training
+    data hash.
+    directory: the store directory
+    name: the name of the model in the store
+    schema, data_hash: if None, the saved model's schema or training data hash
+        is not checked
+    mmap_mode: passed to joblib.load(); None reads the arrays into memory
+    '''
+    while True:
+        version_dir = current_version(directory, name)
+        if version_dir is None:
+            return None
+        metadata = read_metadata(version_dir)
+        try:
+            if (metadata is None or metadata['format_version'] != FORMAT_VERSION
+                    or metadata['sklearn_version'] != sklearn.__version__
+                    or (schema is not None and metadata['schema'] != list(schema))
+                    or (data_hash is not None and metadata['training_hash'] != data_hash)):
+                if current_version(directory, name) != version_dir:
+                    # Replaced by a concurrent save_model(), which deleted this version
+                    continue
+                return None
+            model = joblib.load(os.path.join(version_dir, 'model.pkl'), mmap_mode=mmap_mode)
+        except (IOError, OSError):
+            if current_version(directory, name) != version_dir:
+                continue
+            raise
+        return model, metadata['schema']
+
+def atomic_write(filename, write):
+    '''
+    Calls write(tmp_filename), which must write the file tmp_filename, and
+    then renames tmp_filename to filename. tmp_filename is a new file in the
+    same directory, and rename() is atomic, so a partially written file is
+    never read as filename, even if write() or the process fails.
+    '''
+    fd, tmp_filename = tempfile.mkstemp(dir=os.path.dirname(filename) or '.', suffix='.tmp')
+    os.close(fd)
+    try:
+        write(tmp_filename)
+        os.rename(tmp_filename, filename)
+    except BaseException:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+        raise
+
+def save_model(model, directory, name, schema, data_hash):
+    '''
+    Saves a trained model to the store, replacing any saved model with the
+    same name. The model is written to a new version subdirectory, and then
+    CURRENT is replaced with atomic_write(), so a concurrent load_model()
+    always finds either the old or the new model, and a partially written
+    model is never loaded. The old versions are deleted afterwards.
+    '''
+    model_dir = os.path.join(directory, name)
+    if not os.path.exists(model_dir):
+        os.makedirs(model_dir)
+    version_dir = tempfile.mkdtemp(dir=model_dir, prefix='v-')
+    try:
+        joblib.dump(model, os.path.join(version_dir, 'model.pkl'))
+        metadata = {
+            'format_version': FORMAT_VERSION,
+            'sklearn_version': sklearn.__version__,
+            'schema': list(schema),
+            'training_hash': data_hash,
+        }
+        with open(os.path.join(version_dir, 'metadata.json'), 'w') as f:
+            json.dump(metadata, f)
+        atomic_write(os.path.join(model_dir, CURRENT_FILE),
+                     lambda filename: write_text(filename, os.path.basename(version_dir)))
+    except BaseException:
+        shutil.rmtree(version_dir, ignore_errors=True)
+        raise
+    for entry in os.listdir(model_dir):
+        path = os.path.join(model_dir, entry)
+        if entry in ('model.pkl', 'metadata.json'):
+            # Saved before models had versions
+            os.remove(path)
+        elif (entry.startswith('v-') and entry != os.path.basename(version_dir)
+                and os.path.exists(os.path.join(path, 'metadata.json'))):
+            # Only complete versions, since another save_model() may still be writing its version
+            shutil.rmtree(path, ignore_errors=True)
+
+def write_text(filename, text):
+    ''' Writes text to the file filename '''
+    with open(filename, 'w') as f:
+        f.write(text)
+
+def fit_or_load(directory, name, model, schema, data_hash, fit):
+    '''
+    Returns the saved model if it matches, and otherwise calls fit(model),
+    saves model, and returns it. If directory is None, nothing is loaded or
+    saved.
+    fit: function that trains model in place
+    '''
+    if directory is not None:
+        loaded = load_model(directory, name, schema, data_hash)
+        if loaded is not None:
+            return loaded[0]
+    fit(model)
+    if directory is not None:
+        save_model(model, directory, name, schema, data_hash)
+    return model
@@ -0,0 +1,188 @@
+'''
+Usage:
+    python serve.py models/ [--port 8838] [--rules] [--all-candidates] [--max-batch-size 64] [--max-wait-ms 2]
+
+Long-running menu item extraction service. models/ is a model store (see
+model_store.py) with the classifier saved by debugM.py, which is loaded once,
+memory-mapped, at startup.
+
+Each request is
+    POST /extract
+with a JSON review in the format of join_reviews.py, of which only "text" and
+"restaurant" ({"name": ...}) are used, and the response is
+    {"menu_items": [{"text": ..., "start": ..., "end": ...}, ...]}
+where start and end are character indexes in the review text.
+
+The candidates are the spans of up to 6 words that pass the pruning in
+candidates.py, or every span with --all-candidates. Requests that arrive within
+max-wait-ms of each other are processed together as one batch, with one call
+to build_feature_matrix() and one call to the classifier. With --rules, the
+rules in debugM.py are also applied to the positive predictions; NLTK is loaded
+once, at startup.
+
+The rules are off by default because they POS tag every positive span on the
+request path, and the pruned candidates already pass the same checks, with
+tags computed in the context of the sentence. The latency goal is a p99 under
+20 ms per review; measure it with load_test.py. The cost is dominated by the
+classifier, which scores every candidate span against every support vector,
+so --all-candidates (several hundred spans per review) is much slower than
+the pruned candidates.
+'''
+
+import argparse
+import BaseHTTPServer
+import json
+import Queue
+import SocketServer
+import threading
+import time
+import numpy as np
+
+import candidates
+import debugM
+import model_store
+import generate_feature_vectors as gfv
+
+def extract_menu_items(reviews, clf, feature_names, use_rules, candidate_fn):
+    '''
+    Returns a list with the list of menu items of each review, where each menu
+    item is a dictionary with the keys text, start and end.
+    '''
+    fvs, _, examples = gfv.build_feature_matrix(reviews, feature_names, candidate_fn)
+    results = [[] for _ in reviews]
+    if len(examples) == 0:
+        return results
+    positive = np.flatnonzero(clf.predict(fvs) == 1)
+    texts = [gfv.example_text(reviews[examples[i, 0]]['text'], examples[i, 4], examples[i, 5]).decode('utf-8') for i in positive]
+    if use_rules:
+        # debugM.TAG_CACHE is bounded, so it does not grow forever in a long-running service
+        labels = debugM.apply_rules(texts, [1] * len(texts))
+    else:
+        labels = [1] * len(texts)
+    for i, text, label in zip(positive, texts, labels):
+        if label == 1:
+            results[examples[i, 0]].append({'text': text, 'start': int(examples[i, 4]), 'end': int(examples[i, 5])})
+    return results
+
+class Batcher(object):
+    '''
+    Collects concurrent requests into batches, which are processed by a single
+    background thread.
+    '''
+    def __init__(self, clf, feature_names, use_rules, candidate_fn, max_batch_size, max_wait):
+        self.clf = clf
+        self.feature_names = feature_names
+        self.use_rules = use_rules
+        self.candidate_fn = candidate_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queue = Queue.Queue()
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+    def extract(self, review):
+        '''
+        Called by each request thread. Blocks until the review's batch has
+        been processed, and returns its menu items, or raises the error that
+        processing the review raised.
+        '''
+        request = {'review': review, 'done': threading.Event()}
+        self.queue.put(request)
+        request['done'].wait()
+        if 'error' in request:
+            raise request['error']
+        return request['menu_items']
+
+    def run(self):
+        while True:
+            # Wait for the first request, then for up to max_wait seconds for more
+            batch = [self.queue.get()]
+            deadline = time.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except Queue.Empty:
+                    break
+            try:
+                results = extract_menu_items([request['review'] for request in batch], self.clf, self.feature_names, self.use_rules, self.candidate_fn)
+                for request, menu_items in zip(batch, results):
+                    request['menu_items'] = menu_items
+            except Exception as e:
+                if len(batch) == 1:
+                    batch[0]['error'] = e
+                else:
+                    # Retry one review at a time, so that only the reviews that fail get an error
+                    for request in batch:
+                        self.process_one(request)
+            for request in batch:
+                request['done'].set()
+
+    def process_one(self, request):
+        try:
+            request['menu_items'] = extract_menu_items([request['review']], self.clf, self.feature_names, self.use_rules, self.candidate_fn)[0]
+        except Exception as e:
+            request['error'] = e
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    # Length of the listen() backlog. The default of 5 makes connections beyond it wait for TCP retransmits (1 s and more)
+    # when many clients connect at once, which is exactly when batching helps
+    request_queue_size = 128
+
+class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_POST(self):
+        if self.path != '/extract':
+            self.send_error(404)
+            return
+        try:
+            review = json.loads(self.rfile.read(int(self.headers.getheader('content-length', 0))))
+            assert isinstance(review['text'], unicode)
+            assert isinstance(review['restaurant']['name'], unicode)
+        except (ValueError, KeyError, TypeError, AssertionError):
+            self.send_error(400)
+            return
+        try:
+            menu_items = self.server.batcher.extract(review)
+        except Exception:
+            self.send_error(500)
+            return
+        body = json.dumps({'menu_items': menu_items})
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Logging every request would dominate the latency
+        pass
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('models', help='model store with the classifier saved by debugM.py')
+    parser.add_argument('--port', type=int, default=8838)
+    parser.add_argument('--rules', action='store_true', help='apply the rules in debugM.py to the positive predictions')
+    parser.add_argument('--all-candidates', action='store_true', help='score every span, without pruning')
+    parser.add_argument('--max-batch-size', type=int, default=64)
+    parser.add_argument('--max-wait-ms', type=float, default=2.0)
+    args = parser.parse_args()
+
+    loaded = model_store.load_model(args.models, debugM.MODEL_NAME)
+    assert loaded is not None, 'no classifier saved by debugM.py in ' + args.models
+    clf, feature_names = loaded
+    assert all(name in gfv.FEATURE_NAMES for name in feature_names)
+    candidate_fn = gfv.all_candidates if args.all_candidates else candidates.pruned_candidates
+    batcher = Batcher(clf, feature_names, args.rules, candidate_fn, args.max_batch_size, args.max_wait_ms / 1000.0)
+    # Load NLTK and the classifier's code before the first request
+    batcher.extract({'text': u'The cheese pizza was great.', 'restaurant': {'name': u''}})
+
+    server = ThreadingHTTPServer(('localhost', args.port), RequestHandler)
+    server.batcher = batcher
+    server.serve_forever()
+
+if __name__ == '__main__':
+    main()
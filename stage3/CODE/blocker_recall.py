@@ -0,0 +1,247 @@
+'''
+Sampled replacement for em.debug_blocker(), used by stage3.py and
+stage4/match_magellan.py.
+
+em.debug_blocker() searches all of A x B minus the candidate set for likely
+matches, which takes too long on large tables. debug_blocker() instead looks
+at a stratified random sample of the tuples of A, where the strata are the
+tuples for which the blocker kept no candidate pair, and the others. For each
+sampled tuple, a similarity join finds its top_k most similar tuples of B,
+among those that share at least one rare character 3-gram with it (one that at
+most max_postings tuples of B have). Pairs with a similarity of at least
+threshold are likely matches, and the fraction of them that the blocker kept
+is its "recall" on likely matches.
+
+This is a proxy for the recall of the blocker on true matches, not an
+estimate of it: likely matches are pairs with similar 3-grams, so blockers
+that keep such pairs (such as canopies of similar values) do better on the
+proxy than on true matches, and blockers that keep dissimilar true matches
+do worse. The confidence interval only covers the sampling of the tuples of
+A. On the stage3 samples, the proxy and the recall on G.csv rank sorted
+neighborhood and canopy blocking differently, and none of the recalls on
+G.csv is in its interval. Use the proxy to compare runs of the same blocker,
+and the missed pairs to find what it misses.
+
+Tuples are sampled in batches until time_budget runs out, in the order of
+stratified_order(): the first batch has a tuple of each non-empty stratum, and
+later tuples are drawn from the strata in proportion to their sizes. Each
+lookup only touches the rare 3-grams of the tuple, so its cost does not grow
+with |B|. The first batch has 10 tuples, and the size of each later batch is
+chosen so that it ends within the budget. Only the TF-IDF vectors, which are
+computed before sampling, take time linear in |A| + |B|.
+'''
+
+import py_entitymatching as em
+import numpy as np
+import pandas as pd
+import time
+from collections import OrderedDict
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+def as_text(value):
+    ''' Returns value as unicode text, with '' for a missing value '''
+    if isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+    if isinstance(value, unicode):
+        return value
+    if pd.isnull(value):
+        return u''
+    return unicode(value)
+
+def attr_vectors(A, B, attr_corres):
+    '''
+    Returns a list with, for each (A attribute, B attribute) of attr_corres,
+    the TF-IDF vectors (CSR matrices) of the character 3-grams of the
+    attribute values of A and of B. The dot product of two rows is the cosine
+    similarity of the attribute values.
+    '''
+    vectors = []
+    for l_attr, r_attr in attr_corres:
+        l_text = [as_text(v) for v in A[l_attr]]
+        r_text = [as_text(v) for v in B[r_attr]]
+        vectorizer = TfidfVectorizer(analyzer='char_wb', ngram_range=(3, 3), lowercase=True)
+        vectorizer.fit(l_text + r_text)
+        vectors.append((vectorizer.transform(l_text).tocsr(), vectorizer.transform(r_text).tocsr()))
+    return vectors
+
+def rare_gram_index(vectors, max_postings):
+    '''
+    Returns a list with, for each attribute of vectors (see attr_vectors()),
+    (the 3-grams that at most max_postings tuples of B have, the transposed
+    0/1 matrix of which tuples of B have them).
+    '''
+    index = []
+    for _, r_vectors in vectors:
+        rare = np.flatnonzero(np.bincount(r_vectors.indices, minlength=r_vectors.shape[1]) <= max_postings)
+        postings = r_vectors[:, rare]
+        postings.data[:] = 1
+        index.append((rare, postings.T.tocsr()))
+    return index
+
+def top_pairs(rows, vectors, index, top_k):
+    '''
+    Returns (l_rows, r_rows, similarities) of the top_k most similar tuples of
+    B for each tuple of A in rows, among those that share a rare 3-gram with
+    it (see rare_gram_index()). The similarity is the average cosine
+    similarity of the attributes.
+    '''
+    shared = None
+    for (l_vectors, _), (rare, postings) in zip(vectors, index):
+        grams = l_vectors[rows][:, rare]
+        grams.data[:] = 1
+        found = grams.dot(postings)
+        shared = found if shared is None else shared + found
+    shared = shared.tocoo()
+    l_rows = rows[shared.row]
+    r_rows = shared.col.astype(np.int64)
+    similarities = np.zeros(len(l_rows), dtype=np.float64)
+    for l_vectors, r_vectors in vectors:
+        similarities += np.asarray(l_vectors[l_rows].multiply(r_vectors[r_rows]).sum(axis=1)).ravel()
+    similarities /= len(vectors)
+    # top_k per tuple of A: sort by tuple, then by decreasing similarity
+    order = np.lexsort((-similarities, l_rows))
+    l_rows, r_rows, similarities = l_rows[order], r_rows[order], similarities[order]
+    starts = np.searchsorted(l_rows, l_rows, side='left')
+    keep = np.arange(len(l_rows)) - starts < top_k
+    return l_rows[keep], r_rows[keep], similarities[keep]
+
+def stratified_order(strata, rng):
+    '''
+    Returns the positions of the tuples in the order in which they are
+    sampled: a random permutation of each stratum, interleaved so that the
+    first tuple of every non-empty stratum comes first, and each later prefix
+    has tuples of the strata in proportion to their sizes.
+    strata: stratum of each tuple
+    '''
+    keys = np.zeros(len(strata), dtype=np.float64)
+    for stratum in np.unique(strata):
+        members = rng.permutation(np.flatnonzero(strata == stratum))
+        # The i-th tuple of a stratum of n tuples is sampled at about i / n of the way
+        keys[members] = np.arange(len(members)) / float(len(members))
+    # Ties, such as the first tuples of the strata, are broken by stratum
+    return np.lexsort((strata, keys))
+
+def estimate_recall(kept, missed, strata, strata_sizes):
+    '''
+    Returns the stratified estimate of kept / (kept + missed) over all tuples
+    of A, from the likely matches of each sampled tuple that the blocker
+    kept and missed, or NaN if a non-empty stratum has no sampled tuples,
+    since its recall is unknown.
+    strata: stratum of each sampled tuple
+    strata_sizes: number of tuples of A in each stratum
+    '''
+    total_kept = 0.0
+    total_missed = 0.0
+    for stratum, size in enumerate(strata_sizes):
+        in_stratum = strata == stratum
+        if size > 0 and not in_stratum.any():
+            return np.nan
+        if in_stratum.any():
+            total_kept += size * kept[in_stratum].mean()
+            total_missed += size * missed[in_stratum].mean()
+    if total_kept + total_missed == 0:
+        return np.nan
+    return total_kept / (total_kept + total_missed)
+
+def debug_blocker(C, A, B, attr_corres, time_budget=60, top_k=10, threshold=0.6, max_postings=50,
+                  output_size=200, batch_size=100, confidence=0.95, n_bootstrap=1000, random_state=0):
+    '''
+    Returns (summary, missed) for the candidate set C of A and B, as described
+    at the top of this file.
+    summary: OrderedDict with the recall of C on the likely matches found
+        (proxy_recall), its bootstrap confidence interval over the sampling
+        of A (proxy_recall_low, proxy_recall_high), the number of sampled
+        tuples of A, and the numbers of likely matches that were kept and
+        missed among them; the recall and its interval are NaN if the budget
+        ran out before a tuple of each stratum was sampled
+    missed: DataFrame of the output_size most similar likely matches that
+        are not in C, like the output of em.debug_blocker()
+    attr_corres: list of (A attribute, B attribute); the similarity of a pair
+        is the average cosine similarity of these attributes
+    time_budget: seconds after which no more tuples of A are sampled
+    batch_size: maximum number of tuples of A looked up at a time
+    '''
+    start = time.time()
+    l_key = em.get_key(A)
+    r_key = em.get_key(B)
+    l_positions = pd.Series(np.arange(len(A)), index=A[l_key].values)
+    r_positions = pd.Series(np.arange(len(B)), index=B[r_key].values)
+    candidates = (l_positions[C[em.get_fk_ltable(C)].values].values * len(B)
+                  + r_positions[C[em.get_fk_rtable(C)].values].values)
+    candidates = np.unique(candidates)
+    # Stratum 0: tuples of A without any candidate pair, 1: the others
+    has_candidates = np.zeros(len(A), dtype=np.int64)
+    has_candidates[np.unique(candidates // len(B))] = 1
+    strata_sizes = np.bincount(has_candidates, minlength=2)
+
+    vectors = attr_vectors(A, B, attr_corres)
+    index = rare_gram_index(vectors, max_postings)
+    rng = np.random.RandomState(random_state)
+    order = stratified_order(has_candidates, rng)
+    kept = np.zeros(len(A), dtype=np.float64)
+    missed = np.zeros(len(A), dtype=np.float64)
+    missed_pairs = []
+    sampled = 0
+    # Start with a small batch, to measure the time per tuple
+    size = min(batch_size, 10)
+    while sampled < len(A):
+        batch_start = time.time()
+        rows = order[sampled:sampled + size]
+        l_rows, r_rows, similarities = top_pairs(rows, vectors, index, top_k)
+        likely = similarities >= threshold
+        pairs = l_rows[likely] * len(B) + r_rows[likely]
+        in_candidates = np.in1d(pairs, candidates)
+        np.add.at(kept, l_rows[likely][in_candidates], 1)
+        np.add.at(missed, l_rows[likely][~in_candidates], 1)
+        missed_pairs.extend(zip(similarities[likely][~in_candidates], pairs[~in_candidates]))
+        sampled += len(rows)
+        # Only start a batch that is expected to end within the time budget
+        remaining = time_budget - (time.time() - start)
+        seconds_per_tuple = max(time.time() - batch_start, 1e-6) / len(rows)
+        size = min(batch_size, int(remaining / seconds_per_tuple))
+        if size < 1:
+            break
+
+    kept = kept[order[:sampled]]
+    missed = missed[order[:sampled]]
+    strata = has_candidates[order[:sampled]]
+    recall = estimate_recall(kept, missed, strata, strata_sizes)
+    # Stratified bootstrap over the sampled tuples
+    estimates = []
+    for _ in xrange(n_bootstrap if sampled > 0 else 0):
+        sample = np.concatenate([rng.choice(np.flatnonzero(strata == s), (strata == s).sum())
+                                 for s in range(len(strata_sizes)) if (strata == s).any()])
+        estimates.append(estimate_recall(kept[sample], missed[sample], strata[sample], strata_sizes))
+    estimates = np.array(estimates, dtype=np.float64)
+    estimates = estimates[~np.isnan(estimates)]
+    if len(estimates) > 0:
+        recall_low, recall_high = np.percentile(estimates, [50 * (1 - confidence), 50 * (1 + confidence)])
+    else:
+        recall_low = recall_high = np.nan
+
+    summary = OrderedDict([
+        ('proxy_recall', recall),
+        ('proxy_recall_low', recall_low),
+        ('proxy_recall_high', recall_high),
+        ('sampled_tuples', sampled),
+        ('total_tuples', len(A)),
+        ('likely_matches_kept', int(kept.sum())),
+        ('likely_matches_missed', int(missed.sum())),
+        ('seconds', time.time() - start),
+    ])
+
+    missed_pairs = sorted(missed_pairs, reverse=True)[:output_size]
+    l_rows = np.array([pair // len(B) for _, pair in missed_pairs], dtype=np.int64)
+    r_rows = np.array([pair % len(B) for _, pair in missed_pairs], dtype=np.int64)
+    columns = OrderedDict()
+    columns['_id'] = np.arange(len(missed_pairs))
+    columns['similarity'] = [similarity for similarity, _ in missed_pairs]
+    columns['ltable_' + l_key] = A[l_key].values[l_rows]
+    columns['rtable_' + r_key] = B[r_key].values[r_rows]
+    for l_attr, _ in attr_corres:
+        if l_attr != l_key:
+            columns['ltable_' + l_attr] = A[l_attr].values[l_rows]
+    for _, r_attr in attr_corres:
+        if r_attr != r_key:
+            columns['rtable_' + r_attr] = B[r_attr].values[r_rows]
+    return summary, pd.DataFrame(columns)
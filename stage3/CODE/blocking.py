@@ -0,0 +1,297 @@
+'''
+Overlap blocking on two attributes at once, with an inverted index instead of
+a black-box function called on every pair. A pair of tuples survives blocking
+if the tuples share at least one token of the first attribute and at least one
+token of the second attribute. Used by stage3.py and stage4/match_magellan.py.
+
+radius_overlap_pairs() also requires the tuples to be near each other, and
+only looks up the tuples in nearby cells of a grid. sorted_neighborhood_pairs() and canopy_pairs()
+are alternatives to overlap blocking that are not affected by very common
+tokens, and rare_token_functions() restricts overlap blocking to rare tokens.
+'''
+
+import py_entitymatching as em
+import numpy as np
+import pandas as pd
+
+from collections import Counter, OrderedDict
+
+# Mean radius of the Earth
+EARTH_RADIUS_KM = 6371.0088
+
+def get_tokens(value, stopwords):
+    '''
+    Returns the set of lowercase whitespace-delimited words of value,
+    excluding stop words. Byte strings are decoded as UTF-8 first, so that
+    non-ASCII words are lowercased and compared correctly. A missing value
+    (None or NaN) has no words.
+    '''
+    if pd.isnull(value):
+        return set()
+    if isinstance(value, str):
+        value = value.decode('utf-8', 'replace')
+    else:
+        value = unicode(value)
+    return set(w for w in value.lower().split() if w not in stopwords)
+
+def token_pair_keys(tokens1, tokens2, ids1, ids2, add_tokens):
+    '''
+    Returns (keys, rows): one int key for each (attribute 1 token, attribute 2
+    token) combination of each tuple, and the index of the tuple.
+    tokens1, tokens2: lists of token sets, as returned by get_tokens()
+    ids1, ids2: dictionaries from each token to its id
+    add_tokens: if True, new tokens are added to ids1 and ids2; otherwise
+        tokens without ids are skipped, since they have no matches
+    '''
+    keys = []
+    rows = []
+    for row, (t1, t2) in enumerate(zip(tokens1, tokens2)):
+        if add_tokens:
+            for w in t1:
+                ids1.setdefault(w, len(ids1))
+            for w in t2:
+                ids2.setdefault(w, len(ids2))
+        t1_ids = [ids1[w] for w in t1 if w in ids1]
+        t2_ids = [ids2[w] for w in t2 if w in ids2]
+        for t1_id in t1_ids:
+            for t2_id in t2_ids:
+                keys.append(t1_id << 32 | t2_id)
+                rows.append(row)
+    return np.array(keys, dtype=np.int64), np.array(rows, dtype=np.int64)
+
+def overlap_pairs(A, B, l_tokens, r_tokens, chunk_size=100000):
+    '''
+    Returns (l_rows, r_rows), the positions in A and B of the pairs that
+    survive blocking, sorted by A position and then B position (the order of
+    BlackBoxBlocker.block_tables()).
+
+    B is indexed by each (attribute 1 token, attribute 2 token) combination of
+    each tuple, and each tuple of A is looked up by each of its combinations.
+    A is looked up chunk_size tuples at a time, which bounds the memory used
+    by the lookups.
+    l_tokens, r_tokens: functions from a DataFrame of tuples of A or B to
+        (list of attribute 1 token sets, list of attribute 2 token sets)
+    '''
+    ids1 = {}
+    ids2 = {}
+
+    # Sorted index of B
+    r_keys, r_rows = token_pair_keys(*(r_tokens(B) + (ids1, ids2, True)))
+    order = np.argsort(r_keys, kind='mergesort')
+    r_keys = r_keys[order]
+    r_rows = r_rows[order]
+
+    pairs = [np.zeros(0, dtype=np.int64)]
+    for chunk_start in xrange(0, len(A), chunk_size):
+        chunk = A.iloc[chunk_start:chunk_start + chunk_size]
+        l_keys, l_rows = token_pair_keys(*(l_tokens(chunk) + (ids1, ids2, False)))
+        lo = np.searchsorted(r_keys, l_keys, side='left')
+        counts = np.searchsorted(r_keys, l_keys, side='right') - lo
+        # Every (tuple of A, index entry) with the same key, as A position * |B| + B position
+        l_matches = np.repeat(l_rows + chunk_start, counts)
+        r_matches = r_rows[np.repeat(lo - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())]
+        # A pair that shares several combinations is found several times;
+        # np.unique() also sorts the pairs
+        pairs.append(np.unique(l_matches * len(B) + r_matches))
+    pairs = np.concatenate(pairs)
+    return pairs // len(B), pairs % len(B)
+
+def make_candset(A, B, l_rows, r_rows, l_output_attrs, r_output_attrs):
+    '''
+    Returns a candidate set DataFrame of the pairs (A.iloc[l_rows[i]],
+    B.iloc[r_rows[i]]), with the same columns and metadata as
+    BlackBoxBlocker.block_tables(A, B, l_output_attrs, r_output_attrs).
+    '''
+    l_key = em.get_key(A)
+    r_key = em.get_key(B)
+    columns = OrderedDict()
+    columns['ltable_' + l_key] = A[l_key].values[l_rows]
+    columns['rtable_' + r_key] = B[r_key].values[r_rows]
+    for attr in l_output_attrs:
+        if attr != l_key:
+            columns['ltable_' + attr] = A[attr].values[l_rows]
+    for attr in r_output_attrs:
+        if attr != r_key:
+            columns['rtable_' + attr] = B[attr].values[r_rows]
+    C = pd.DataFrame(columns)
+    C.insert(0, '_id', range(len(C)))
+    em.set_key(C, '_id')
+    em.set_ltable(C, A)
+    em.set_rtable(C, B)
+    em.set_fk_ltable(C, 'ltable_' + l_key)
+    em.set_fk_rtable(C, 'rtable_' + r_key)
+    return C
+
+def unit_vectors(latitudes, longitudes):
+    '''
+    Returns the 3D unit vectors of points on a sphere, given in degrees. The
+    straight-line distance between two of them grows with their great-circle
+    distance, so radius checks can use it instead.
+    '''
+    lat = np.radians(np.asarray(latitudes, dtype=np.float64))
+    lon = np.radians(np.asarray(longitudes, dtype=np.float64))
+    return np.column_stack((np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)))
+
+def grid_cells(points, radius_km, neighbors):
+    '''
+    Returns the cells, in a grid of cubes with sides of radius_km, of points
+    on the Earth given as unit vectors, or None for a point with a NaN
+    coordinate. Points at most radius_km apart (great-circle distance) are
+    less than radius_km apart in a straight line, so they are in the same or
+    adjacent cells.
+    neighbors: if True, each point gets the list of its own and its 26
+        adjacent cells, instead of its own cell
+    '''
+    cells = []
+    for point in points:
+        if np.isnan(point).any():
+            cells.append(None)
+            continue
+        x, y, z = (int(c) for c in np.floor(point * EARTH_RADIUS_KM / radius_km))
+        if neighbors:
+            cells.append([(x + dx, y + dy, z + dz) for dx in (-1, 0, 1) for dy in (-1, 0, 1) for dz in (-1, 0, 1)])
+        else:
+            cells.append((x, y, z))
+    return cells
+
+def radius_overlap_pairs(A, B, l_tokens, r_tokens, l_coordinates, r_coordinates, radius_km, chunk_size=100000):
+    '''
+    Returns the pairs of overlap_pairs(A, B, l_tokens, r_tokens, chunk_size)
+    that are at most radius_km apart (great-circle distance), sorted the same
+    way. Tuples with a NaN coordinate are never paired.
+
+    Each attribute 1 token of a tuple of B is indexed together with the tuple's
+    grid cell (see grid_cells()), and each tuple of A is looked up in its own
+    and its adjacent cells, so only pairs that are near each other and share
+    tokens are generated. Those are then checked against the exact distance.
+    l_coordinates, r_coordinates: functions from a DataFrame of tuples of A
+        or B to (latitudes, longitudes), in degrees
+    '''
+    def l_cell_tokens(T):
+        tokens1, tokens2 = l_tokens(T)
+        cells = grid_cells(unit_vectors(*l_coordinates(T)), radius_km, True)
+        return [set() if c is None else set((cell, w) for cell in c for w in t) for t, c in zip(tokens1, cells)], tokens2
+
+    def r_cell_tokens(T):
+        tokens1, tokens2 = r_tokens(T)
+        cells = grid_cells(unit_vectors(*r_coordinates(T)), radius_km, False)
+        return [set() if c is None else set((c, w) for w in t) for t, c in zip(tokens1, cells)], tokens2
+
+    l_rows, r_rows = overlap_pairs(A, B, l_cell_tokens, r_cell_tokens, chunk_size)
+    l_points = unit_vectors(*l_coordinates(A))[l_rows]
+    r_points = unit_vectors(*r_coordinates(B))[r_rows]
+    # Straight-line distance between unit vectors radius_km apart
+    chord = 2 * np.sin(min(radius_km / EARTH_RADIUS_KM, np.pi) / 2)
+    near = ((l_points - r_points) ** 2).sum(axis=1) <= chord ** 2
+    return l_rows[near], r_rows[near]
+
+def sorted_neighborhood_pairs(l_keys, r_keys, window):
+    '''
+    Returns (l_rows, r_rows), the positions of the pairs of tuples of A and B
+    that are less than window positions apart when the tuples of both tables
+    are sorted by key, sorted as in overlap_pairs().
+    l_keys, r_keys: sort key of each tuple of A and B
+    '''
+    keys = list(l_keys) + list(r_keys)
+    # Stable, so that tuples with the same key stay in table order
+    order = np.array(sorted(xrange(len(keys)), key=keys.__getitem__), dtype=np.int64)
+    l_size = len(l_keys)
+    r_size = len(r_keys)
+    pairs = [np.zeros(0, dtype=np.int64)]
+    for distance in xrange(1, window):
+        first = order[:-distance]
+        second = order[distance:]
+        # A tuple of A followed by a tuple of B, or the other way around
+        mask = (first < l_size) & (second >= l_size)
+        pairs.append(first[mask] * r_size + second[mask] - l_size)
+        mask = (first >= l_size) & (second < l_size)
+        pairs.append(second[mask] * r_size + first[mask] - l_size)
+    pairs = np.unique(np.concatenate(pairs))
+    return pairs // r_size, pairs % r_size
+
+def canopy_pairs(l_vectors, r_vectors, loose, tight, random_state=0, chunk_size=1000):
+    '''
+    Returns (l_rows, r_rows), the positions of the pairs of tuples of A and B
+    that are in the same canopy, sorted as in overlap_pairs().
+
+    Canopies are built from the tuples of both tables: a random tuple that is
+    not yet tightly covered is the center of a new canopy, which contains
+    every tuple whose cosine similarity to the center is at least loose (which
+    must be positive). Tuples with a similarity of at least tight are tightly
+    covered, and are never centers.
+    l_vectors, r_vectors: sparse matrices with an L2-normalized row (such as
+        a TF-IDF vector) for each tuple of A and B
+    chunk_size: the similarities of chunk_size potential centers are computed
+        at a time
+    '''
+    from scipy.sparse import vstack
+    vectors = vstack([l_vectors, r_vectors]).tocsr()
+    vectors_t = vectors.T.tocsc()
+    l_size = l_vectors.shape[0]
+    r_size = r_vectors.shape[0]
+    covered = np.zeros(vectors.shape[0], dtype=bool)
+    order = np.random.RandomState(random_state).permutation(vectors.shape[0])
+    pairs = [np.zeros(0, dtype=np.int64)]
+    for chunk_start in xrange(0, len(order), chunk_size):
+        centers = order[chunk_start:chunk_start + chunk_size]
+        centers = centers[~covered[centers]]
+        similarities = vectors[centers].dot(vectors_t).tocsr()
+        for i, center in enumerate(centers):
+            if covered[center]:
+                continue
+            row = slice(similarities.indptr[i], similarities.indptr[i + 1])
+            neighbors = similarities.indices[row]
+            values = similarities.data[row]
+            members = np.union1d(neighbors[values >= loose], [center]).astype(np.int64)
+            covered[neighbors[values >= tight]] = True
+            covered[center] = True
+            l_members = members[members < l_size]
+            r_members = members[members >= l_size] - l_size
+            pairs.append((l_members[:, np.newaxis] * r_size + r_members).ravel())
+    pairs = np.unique(np.concatenate(pairs))
+    return pairs // r_size, pairs % r_size
+
+def rarest_tokens(tokens, doc_freq, max_df=None, top_k=None):
+    '''
+    Returns the set of the top_k tokens of tokens with the lowest document
+    frequencies (ties are broken by token), excluding tokens with a document
+    frequency above max_df.
+    max_df, top_k: if None, no limit
+    '''
+    if max_df is not None:
+        tokens = [w for w in tokens if doc_freq[w] <= max_df]
+    if top_k is not None and len(tokens) > top_k:
+        tokens = sorted(tokens, key=lambda w: (doc_freq[w], w))[:top_k]
+    return set(tokens)
+
+def rare_token_functions(A, B, l_tokens, r_tokens, max_df=None, top_k=None, chunk_size=100000):
+    '''
+    Returns (l_rare_tokens, r_rare_tokens, dropped). l_rare_tokens and
+    r_rare_tokens are versions of the token functions l_tokens and r_tokens
+    of overlap_pairs() that only keep the rarest_tokens() of each attribute.
+    dropped has one dictionary per attribute, from each token with a document
+    frequency above max_df to its document frequency.
+
+    The document frequency of a token is the number of tuples of A and B
+    with the token. Since very common tokens are never indexed, each token
+    pairs a tuple with at most max_df others, and with top_k, each tuple is
+    looked up by at most top_k * top_k combinations, so the number of pairs
+    grows linearly with the size of the tables rather than quadratically.
+    Two matching tuples with different rare tokens are missed, so small
+    values of top_k lower recall.
+    '''
+    doc_freqs = (Counter(), Counter())
+    for T, tokens in ((A, l_tokens), (B, r_tokens)):
+        for chunk_start in xrange(0, len(T), chunk_size):
+            for doc_freq, token_sets in zip(doc_freqs, tokens(T.iloc[chunk_start:chunk_start + chunk_size])):
+                for token_set in token_sets:
+                    doc_freq.update(token_set)
+    dropped = tuple(dict((w, n) for w, n in doc_freq.iteritems() if max_df is not None and n > max_df)
+                    for doc_freq in doc_freqs)
+
+    def rare_tokens(tokens):
+        def get_rare_tokens(T):
+            return tuple([rarest_tokens(token_set, doc_freq, max_df, top_k) for token_set in token_sets]
+                         for doc_freq, token_sets in zip(doc_freqs, tokens(T)))
+        return get_rare_tokens
+    return rare_tokens(l_tokens), rare_tokens(r_tokens), dropped
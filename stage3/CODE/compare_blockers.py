@@ -0,0 +1,44 @@
+# Usage: python compare_blockers.py ./DATA/sample_A.csv ./DATA/sample_B.csv ./DATA/G.csv
+# Prints the number of candidate pairs, the recall of the true matches of
+# G.csv, the interval of the proxy recall of blocker_recall.py (on likely
+# matches, without G), and the runtime of each blocker of stage3.py.
+
+import pandas as pd
+import time
+from sys import argv
+
+import blocker_recall
+import stage3
+
+def get_recall(C, G):
+    '''
+    Returns the fraction of the true matches of the labeled pairs G that are
+    in the candidate set C.
+    '''
+    matches = G[G['gold_labels'] == 1]
+    true_pairs = set(zip(matches['ltable_id'], matches['rtable_id']))
+    pairs = set(zip(C['ltable_id'], C['rtable_id']))
+    return len(true_pairs & pairs) / float(len(true_pairs))
+
+def main():
+    G = pd.read_csv(argv[3])
+    blockers = [
+        ('overlap', stage3.overlap_block),
+        ('rare tokens', stage3.rare_block),
+        ('sorted neighborhood', stage3.sn_block),
+        ('canopy', stage3.canopy_block),
+    ]
+    print '%-20s %10s %8s %18s %10s' % ('blocker', 'pairs', 'recall', 'proxy recall', 'time (s)')
+    for name, block in blockers:
+        # The blockers may modify A and B
+        A, B = stage3.get_tables(argv[1], argv[2])
+        start = time.time()
+        C = block(A, B)
+        seconds = time.time() - start
+        A, B = stage3.get_tables(argv[1], argv[2])
+        summary, _ = blocker_recall.debug_blocker(C, A, B, [('title', 'song'), ('artist_name', 'artists')], time_budget=10)
+        estimate = '%.3f-%.3f' % (summary['proxy_recall_low'], summary['proxy_recall_high'])
+        print '%-20s %10d %8.3f %18s %10.2f' % (name, len(C), get_recall(C, G), estimate, seconds)
+
+if __name__ == "__main__":
+    main()
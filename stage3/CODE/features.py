@@ -0,0 +1,307 @@
+'''
+Chunked, parallel feature extraction for candidate sets, with the same output
+as em.extract_feature_vecs(). Used by stage3.py and stage4.
+
+The candidate set is split into chunks of chunk_size pairs, which are
+processed in parallel by n_jobs processes. Each process tokenizes each
+attribute value once per tokenizer, rather than once per feature and pair.
+For the set similarity features (jaccard, cosine, dice and overlap_coeff of
+two tokenizers), each value's tokens are encoded once as a sorted array of
+integer token ids, and the feature is computed for the whole chunk at once
+from the sizes of the intersections of these arrays.
+With chunk_dir, each chunk's feature vectors are written to chunk_dir as soon
+as they are computed, and a rerun with the same candidate set and features
+only computes the missing chunks.
+'''
+
+import py_entitymatching as em
+import hashlib
+import json
+import numpy as np
+import os
+import pandas as pd
+import sys
+try:
+    from joblib import Parallel, delayed
+except ImportError:
+    from sklearn.externals.joblib import Parallel, delayed
+
+# model_store.py is shared with stage 2
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'stage2', 'code'))
+import model_store
+
+# Maximum number of tokenized values cached by each process
+MAX_TOKEN_CACHE_SIZE = 1000000
+
+TOKEN_CACHE = {}
+
+# Similarity functions that only depend on the sets of tokens
+SET_SIM_FUNCTIONS = ('jaccard', 'cosine', 'dice', 'overlap_coeff')
+
+# Dictionary from each tokenizer name to its dictionary from token to id
+TOKEN_IDS = {}
+
+# Dictionary from (tokenizer name, value) to the output of encode_tokens()
+ENCODED_CACHE = {}
+
+def cached_tokenizer(name, tokenizer):
+    '''
+    Returns a version of tokenizer that caches its output in TOKEN_CACHE.
+    The cached lists are shared, so the similarity functions must not modify
+    them, which em's do not.
+    '''
+    def tokenize(value):
+        try:
+            return TOKEN_CACHE[(name, value)]
+        except KeyError:
+            pass
+        except TypeError:
+            # unhashable value
+            return tokenizer(value)
+        if len(TOKEN_CACHE) >= MAX_TOKEN_CACHE_SIZE:
+            TOKEN_CACHE.clear()
+        tokens = TOKEN_CACHE[(name, value)] = tokenizer(value)
+        return tokens
+    return tokenize
+
+def get_feature_namespace(feature_table):
+    '''
+    Returns (tokenizers, similarity functions) of the feature table: the
+    dictionaries from name to function that em.get_features() compiled the
+    feature functions with.
+    '''
+    tokenizers = {}
+    sim_funcs = {}
+    for _, feature in feature_table.iterrows():
+        namespace = feature['function'].func_globals
+        for attr, functions in (('left_attr_tokenizer', tokenizers), ('right_attr_tokenizer', tokenizers), ('simfunction', sim_funcs)):
+            name = feature[attr]
+            if isinstance(name, basestring) and name in namespace:
+                functions[name] = namespace[name]
+    return tokenizers, sim_funcs
+
+def compile_features(feature_names, function_sources, tokenizers, sim_funcs):
+    '''
+    Returns the feature functions, compiled from their source as in
+    em.get_features(), but with each tokenizer replaced by a cached version.
+    '''
+    namespace = {}
+    namespace.update(tokenizers)
+    namespace.update(sim_funcs)
+    for source in function_sources:
+        exec source in namespace
+    # The feature functions look up the tokenizers in namespace when called
+    for name in tokenizers:
+        namespace[name] = cached_tokenizer(name, namespace[name])
+    return [namespace[feature_name] for feature_name in feature_names]
+
+def get_set_features(feature_table, tokenizers):
+    '''
+    Returns a list with, for each feature, (left attribute, right attribute,
+    left tokenizer, right tokenizer, similarity function name) if it is an
+    automatically generated set similarity feature, and None otherwise.
+    '''
+    set_features = []
+    for _, feature in feature_table.iterrows():
+        if (feature['is_auto_generated'] and feature['simfunction'] in SET_SIM_FUNCTIONS
+                and feature['left_attr_tokenizer'] in tokenizers
+                and feature['right_attr_tokenizer'] in tokenizers):
+            set_features.append((feature['left_attribute'], feature['right_attribute'],
+                                 feature['left_attr_tokenizer'], feature['right_attr_tokenizer'],
+                                 feature['simfunction']))
+        else:
+            set_features.append(None)
+    return set_features
+
+def encode_tokens(name, tokenizer, value):
+    '''
+    Returns (tokens, ids), where tokens is tokenizer(value) and ids is the
+    sorted array of the ids of the distinct tokens, or None if value is null
+    (for which em's similarity functions return NaN).
+    '''
+    try:
+        return ENCODED_CACHE[(name, value)]
+    except KeyError:
+        cacheable = True
+    except TypeError:
+        # unhashable value
+        cacheable = False
+    tokens = tokenizer(value)
+    if isinstance(tokens, list):
+        token_ids = TOKEN_IDS.setdefault(name, {})
+        ids = set(token_ids.setdefault(token, len(token_ids)) for token in tokens)
+        encoded = tokens, np.array(sorted(ids), dtype=np.int64)
+    else:
+        encoded = None
+    if cacheable:
+        ENCODED_CACHE[(name, value)] = encoded
+    return encoded
+
+def set_sim_column(simfunction, l_encoded, r_encoded):
+    '''
+    Returns the list of simfunction(l_tokens, r_tokens) of each pair, equal
+    to the output of em's similarity function of the same name.
+    l_encoded, r_encoded: lists of the output of encode_tokens() of the left
+        and right values of each pair
+    '''
+    column = [np.nan] * len(l_encoded)
+    pairs = [i for i, (l, r) in enumerate(zip(l_encoded, r_encoded)) if l is not None and r is not None]
+    if len(pairs) == 0:
+        return column
+    # The ids of each pair's tokens are offset by its position, so that one
+    # intersection of sorted arrays finds the common tokens of every pair
+    l_keys = np.concatenate([l_encoded[i][1] + (j << 32) for j, i in enumerate(pairs)])
+    r_keys = np.concatenate([r_encoded[i][1] + (j << 32) for j, i in enumerate(pairs)])
+    common = np.bincount(np.intersect1d(l_keys, r_keys, assume_unique=True) >> 32, minlength=len(pairs))
+    l_sizes = np.array([l_encoded[i][1].size for i in pairs], dtype=np.float64)
+    r_sizes = np.array([r_encoded[i][1].size for i in pairs], dtype=np.float64)
+    common = common.astype(np.float64)
+    # Same arithmetic as py_stringmatching, so the results are identical
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if simfunction == 'jaccard':
+            scores = common / (l_sizes + r_sizes - common)
+        elif simfunction == 'cosine':
+            scores = common / (np.sqrt(l_sizes) * np.sqrt(r_sizes))
+        elif simfunction == 'dice':
+            scores = 2.0 * common / (l_sizes + r_sizes)
+        else:
+            scores = common / np.minimum(l_sizes, r_sizes)
+    scores = scores.tolist()
+    for j, i in enumerate(pairs):
+        l_tokens = l_encoded[i][0]
+        r_tokens = r_encoded[i][0]
+        if (l_sizes[j] == r_sizes[j] == common[j]) and l_tokens == r_tokens:
+            # py_stringmatching checks for equal token lists first
+            column[i] = 1.0
+        elif l_sizes[j] == 0 or r_sizes[j] == 0:
+            column[i] = 0
+        else:
+            column[i] = scores[j]
+    return column
+
+def extract_chunk(l_tuples, r_tuples, l_ids, r_ids, index, feature_names, function_sources, set_features, tokenizers, sim_funcs, chunk_file):
+    '''
+    Returns the DataFrame of feature vectors of the pairs (l_tuples[l_ids[i]],
+    r_tuples[r_ids[i]]), with the given index. If chunk_file is not None, the
+    DataFrame is also written to it.
+    l_tuples, r_tuples: dictionaries from each key to its tuple (a Series)
+    set_features: output of get_set_features()
+    '''
+    if len(ENCODED_CACHE) >= MAX_TOKEN_CACHE_SIZE:
+        # Only between chunks, since the token ids of a chunk must agree
+        ENCODED_CACHE.clear()
+        TOKEN_IDS.clear()
+    functions = compile_features(feature_names, function_sources, tokenizers, sim_funcs)
+    l_tuples = [l_tuples[l_id] for l_id in l_ids]
+    r_tuples = [r_tuples[r_id] for r_id in r_ids]
+    columns = []
+    for f, set_feature in zip(functions, set_features):
+        if set_feature is None:
+            columns.append([f(l_tuple, r_tuple) for l_tuple, r_tuple in zip(l_tuples, r_tuples)])
+            continue
+        l_attr, r_attr, l_tokenizer, r_tokenizer, simfunction = set_feature
+        l_encoded = [encode_tokens(l_tokenizer, tokenizers[l_tokenizer], t[l_attr]) for t in l_tuples]
+        r_encoded = [encode_tokens(r_tokenizer, tokenizers[r_tokenizer], t[r_attr]) for t in r_tuples]
+        columns.append(set_sim_column(simfunction, l_encoded, r_encoded))
+    rows = zip(*columns) if len(columns) > 0 else [()] * len(l_ids)
+    fvs = pd.DataFrame(rows, index=index, columns=feature_names)
+    if chunk_file is not None:
+        model_store.atomic_write(chunk_file, fvs.to_pickle)
+    return fvs
+
+def open_chunk_dir(chunk_dir, candset, fk_ltable, fk_rtable, ltable, rtable, feature_table, chunk_size):
+    '''
+    Creates chunk_dir if necessary, and deletes its chunks if they were
+    computed for a different candidate set, ltable, rtable, feature table or
+    chunk size.
+    '''
+    h = hashlib.sha1()
+    h.update(json.dumps([list(feature_table['feature_name']), list(feature_table['function_source']), chunk_size]))
+    for df in (candset[[fk_ltable, fk_rtable]], ltable, rtable):
+        h.update(json.dumps([str(column) for column in df.columns]))
+        h.update(pd.util.hash_pandas_object(df, index=True).values.tobytes())
+    manifest = {'hash': h.hexdigest()}
+    manifest_file = os.path.join(chunk_dir, 'manifest.json')
+    if not os.path.exists(chunk_dir):
+        os.makedirs(chunk_dir)
+    elif os.path.exists(manifest_file):
+        with open(manifest_file, 'r') as f:
+            if json.load(f) == manifest:
+                return
+    for name in os.listdir(chunk_dir):
+        if name.startswith('chunk_'):
+            os.remove(os.path.join(chunk_dir, name))
+    with open(manifest_file, 'w') as f:
+        json.dump(manifest, f)
+
+def as_list(attrs):
+    ''' attrs_before and attrs_after may be None, an attribute, or a list '''
+    if attrs is None:
+        return []
+    if isinstance(attrs, basestring):
+        return [attrs]
+    return list(attrs)
+
+def extract_feature_vecs(candset, feature_table, attrs_before=None, attrs_after=None,
+                         chunk_size=1000, n_jobs=-1, chunk_dir=None):
+    '''
+    Same as em.extract_feature_vecs(candset, attrs_before, feature_table,
+    attrs_after), but computed in parallel chunks as described at the top of
+    this file.
+    chunk_size: number of pairs per chunk
+    n_jobs: number of processes (by default, one per core)
+    chunk_dir: if not None, directory in which finished chunks are kept
+    '''
+    key = em.get_key(candset)
+    fk_ltable = em.get_fk_ltable(candset)
+    fk_rtable = em.get_fk_rtable(candset)
+    ltable = em.get_ltable(candset)
+    rtable = em.get_rtable(candset)
+    l_df = ltable.set_index(em.get_key(ltable), drop=False)
+    r_df = rtable.set_index(em.get_key(rtable), drop=False)
+
+    feature_names = list(feature_table['feature_name'])
+    function_sources = list(feature_table['function_source'])
+    tokenizers, sim_funcs = get_feature_namespace(feature_table)
+    set_features = get_set_features(feature_table, tokenizers)
+    if chunk_dir is not None:
+        open_chunk_dir(chunk_dir, candset, fk_ltable, fk_rtable, ltable, rtable, feature_table, chunk_size)
+
+    chunks = []
+    tasks = []
+    for chunk_start in xrange(0, len(candset), chunk_size):
+        chunk = candset.iloc[chunk_start:chunk_start + chunk_size]
+        chunk_file = None
+        if chunk_dir is not None:
+            chunk_file = os.path.join(chunk_dir, 'chunk_%08d.pkl' % chunk_start)
+            if os.path.exists(chunk_file):
+                chunks.append(pd.read_pickle(chunk_file))
+                continue
+        # Only send each process the tuples that its chunk refers to
+        l_ids = list(chunk[fk_ltable])
+        r_ids = list(chunk[fk_rtable])
+        l_tuples = dict((l_id, l_df.loc[l_id]) for l_id in set(l_ids))
+        r_tuples = dict((r_id, r_df.loc[r_id]) for r_id in set(r_ids))
+        chunks.append(len(tasks))
+        tasks.append((l_tuples, r_tuples, l_ids, r_ids, chunk.index.values, feature_names, function_sources, set_features, tokenizers, sim_funcs, chunk_file))
+
+    results = Parallel(n_jobs=n_jobs if len(tasks) > 1 else 1)(delayed(extract_chunk)(*task) for task in tasks)
+    chunks = [results[chunk] if isinstance(chunk, int) else chunk for chunk in chunks]
+    if len(chunks) > 0:
+        fvs = pd.concat(chunks)
+    else:
+        fvs = pd.DataFrame(columns=feature_names, index=candset.index)
+
+    # Same columns as em.extract_feature_vecs()
+    before = [key, fk_ltable, fk_rtable] + [a for a in as_list(attrs_before) if a not in (key, fk_ltable, fk_rtable)]
+    after = [a for a in as_list(attrs_after) if a not in (key, fk_ltable, fk_rtable)]
+    for i, a in enumerate(before):
+        fvs.insert(i, a, candset[a])
+    for a in after:
+        fvs[a] = candset[a]
+    em.set_key(fvs, key)
+    em.set_ltable(fvs, ltable)
+    em.set_rtable(fvs, rtable)
+    em.set_fk_ltable(fvs, fk_ltable)
+    em.set_fk_rtable(fvs, fk_rtable)
+    return fvs
@@ -0,0 +1,157 @@
+'''
+Cross-validation of several matchers on several metrics at once, with the
+same output as em.select_matcher(). Used by stage3.py and
+stage4/match_magellan.py.
+
+em.select_matcher() fits every matcher on every fold once per metric.
+compare_matchers() fits each (matcher, fold) once, in parallel, keeps the
+predictions for the fold's test set, and computes every metric from them.
+With cache_dir, the predictions are saved, and a rerun on the same feature
+vectors only fits the (matcher, fold) pairs that are missing.
+
+evaluate_matchers() trains each matcher on the development set and evaluates
+it on the test set, as em's fit(), predict() and eval_matches() would, with
+all matchers in parallel.
+'''
+
+import os
+import sys
+import numpy as np
+import pandas as pd
+from collections import OrderedDict
+from sklearn.base import clone
+from sklearn.metrics import f1_score, precision_score, recall_score
+from sklearn.model_selection import KFold
+try:
+    from joblib import Parallel, delayed
+except ImportError:
+    from sklearn.externals.joblib import Parallel, delayed
+
+# model_store.py is shared with stage 2
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'stage2', 'code'))
+import model_store
+
+# Same as the scoring names of em.select_matcher()
+METRICS = OrderedDict([
+    ('precision', precision_score),
+    ('recall', recall_score),
+    ('f1', f1_score),
+])
+
+def save_array(filename, a):
+    ''' Same as np.save(filename, a), but without adding .npy to filename '''
+    with open(filename, 'wb') as f:
+        np.save(f, a)
+
+def fold_predictions(clf, x, y, train_i, test_i, cache_file):
+    '''
+    Fits a copy of clf on the training rows of the fold, and returns its
+    predictions for the test rows. If cache_file is not None, the predictions
+    are loaded from it if it exists, and saved to it otherwise.
+    '''
+    if cache_file is not None and os.path.exists(cache_file):
+        return np.load(cache_file)
+    clf = clone(clf)
+    clf.fit(x[train_i], y[train_i])
+    predictions = clf.predict(x[test_i])
+    if cache_file is not None:
+        model_store.atomic_write(cache_file, lambda filename: save_array(filename, predictions))
+    return predictions
+
+def compare_matchers(matchers, table, exclude_attrs, target_attr, k=10,
+                     random_state=0, n_jobs=-1, cache_dir=None):
+    '''
+    Returns an OrderedDict from each metric of METRICS to its cv_stats, the
+    DataFrame of scores of each matcher on each fold that
+    em.select_matcher(matchers, table=table, exclude_attrs=exclude_attrs,
+    target_attr=target_attr, metric=metric, k=k, random_state=random_state)
+    would return. All metrics use the same folds.
+    n_jobs: number of processes (by default, one per core)
+    cache_dir: if not None, directory in which the fold predictions are kept
+    '''
+    attrs = [attr for attr in table.columns if attr not in exclude_attrs and attr != target_attr]
+    x = table[attrs].values
+    y = table[target_attr].values.ravel()
+    folds = list(KFold(k, shuffle=True, random_state=random_state).split(x, y))
+    if cache_dir is not None and not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+
+    tasks = []
+    for matcher in matchers:
+        for train_i, test_i in folds:
+            cache_file = None
+            if cache_dir is not None:
+                cache_file = os.path.join(cache_dir, model_store.training_hash(
+                        x, y, attrs, train_i, test_i, repr(matcher.clf)) + '.npy')
+            tasks.append((matcher.clf, x, y, train_i, test_i, cache_file))
+    predictions = Parallel(n_jobs=n_jobs)(delayed(fold_predictions)(*task) for task in tasks)
+
+    header = ['Name', 'Matcher', 'Num folds'] + ['Fold ' + str(i + 1) for i in range(k)] + ['Mean score']
+    results = OrderedDict()
+    for metric, score in METRICS.items():
+        rows = []
+        for m, matcher in enumerate(matchers):
+            scores = [score(y[test_i], predictions[m * k + fold])
+                      for fold, (_, test_i) in enumerate(folds)]
+            rows.append(OrderedDict(zip(header, [matcher.get_name(), matcher, k] + scores + [np.mean(scores)])))
+        results[metric] = pd.DataFrame(rows)[header]
+    return results
+
+def fit_and_predict(matcher, x_train, y_train, x_test, models_dir, model_name, schema, data_hash):
+    '''
+    Trains matcher, or loads it from the model store models_dir (see
+    stage2/code/model_store.py), and returns its predictions for x_test.
+    '''
+    matcher = model_store.fit_or_load(models_dir, model_name, matcher, schema, data_hash,
+            lambda m: m.clf.fit(x_train, y_train))
+    return matcher.clf.predict(x_test)
+
+def eval_predictions(gold, predicted):
+    '''
+    Returns an OrderedDict of the same precision, recall, F1 and counts as
+    em.eval_matches().
+    '''
+    true_pos = float(np.sum((gold == 1) & (predicted == 1)))
+    false_pos = float(np.sum((gold == 0) & (predicted == 1)))
+    false_neg = float(np.sum((gold == 1) & (predicted == 0)))
+    true_neg = float(np.sum((gold == 0) & (predicted == 0)))
+    precision = true_pos / (true_pos + false_pos) if true_pos + false_pos > 0 else 0.0
+    recall = true_pos / (true_pos + false_neg) if true_pos + false_neg > 0 else 0.0
+    if precision == 0.0 and recall == 0.0:
+        f1 = 0.0
+    else:
+        f1 = (2.0 * precision * recall) / (precision + recall)
+    return OrderedDict([
+        ('precision', precision),
+        ('recall', recall),
+        ('f1', f1),
+        ('pred_pos_num', true_pos + false_pos),
+        ('false_pos_num', false_pos),
+        ('pred_neg_num', false_neg + true_neg),
+        ('false_neg_num', false_neg),
+    ])
+
+def evaluate_matchers(matchers, H, L, exclude_attrs, target_attr, n_jobs=-1,
+                      models_dir=None, name_prefix=''):
+    '''
+    Returns a DataFrame with one row per matcher, indexed by matcher name, of
+    the output of eval_predictions() for the matcher trained on H and
+    evaluated on L.
+    H, L: development and test set feature vectors, which are converted to
+        NumPy arrays once for all matchers
+    n_jobs: number of processes (by default, one per core)
+    models_dir: if not None, the model store in which each trained matcher is
+        saved as name_prefix + its name, and from which it is loaded if it was
+        already trained on the same H
+    '''
+    attrs = [attr for attr in H.columns if attr not in exclude_attrs and attr != target_attr]
+    x_train = H[attrs].values
+    y_train = H[target_attr].values.ravel()
+    x_test = L[attrs].values
+    gold = L[target_attr].values.ravel()
+    predictions = Parallel(n_jobs=n_jobs)(
+        delayed(fit_and_predict)(matcher, x_train, y_train, x_test, models_dir, name_prefix + matcher.name,
+                                 attrs, model_store.training_hash(H, exclude_attrs, repr(matcher.clf)))
+        for matcher in matchers)
+    rows = [eval_predictions(gold, predicted) for predicted in predictions]
+    return pd.DataFrame(rows, index=[matcher.get_name() for matcher in matchers])
@@ -1,10 +1,19 @@
-# Usage: python stage3.py ./DATA/sample_A.csv ./DATA/sample_B.csv ./DATA/I.csv ./DATA/J.csv
+# Usage: python stage3.py ./DATA/sample_A.csv ./DATA/sample_B.csv ./DATA/I.csv ./DATA/J.csv [models/]
+# With models/, the matchers trained on I.csv are saved to that model store
+# (see stage2/code/model_store.py), and later runs load them instead of retraining.
+# The cross-validation predictions of comp_matchers() are cached in models/cv/.
 
 # -*- coding: utf-8 -*-
 import py_entitymatching as em
+import os
+import re
 from sys import argv
+from sklearn.feature_extraction.text import TfidfVectorizer
 
-import re
+import blocker_recall
+import blocking
+import features
+import selection
 
 def get_tables(A_file, B_file):
     '''
@@ -22,20 +31,34 @@ def downsamp(A, B):
     #sample_B.to_csv('sample_B.csv', index = False, encoding='utf-8')
     return sample_A, sample_B
     
+# Output attributes of the blockers
+L_OUTPUT_ATTRS = ['id', 'title', 'artist_name', 'year']
+R_OUTPUT_ATTRS = ['id', 'title', 'year', 'episode', 'song', 'artists']
+
+def get_tokens(value):
+    '''
+    Returns the set of lowercase words of value, excluding stop words.
+    '''
+    return blocking.get_tokens(value, ('the', 'a'))
+
+def artist_tokens(value):
+    '''
+    Returns the set of lowercase words of the artists of a track, which are
+    separated by "+", excluding stop words.
+    '''
+    if isinstance(value, basestring):
+        value = value.replace('+', ' ')
+    return get_tokens(value)
+
 def match(ltup, rtup):
     '''
     Returns True if (ltup, rtup) should be dropped, or False if (ltup, rtup) is
     a candidate. Called by bb_block().
     '''
-    l_song_withstop = str(ltup['title']).lower().split()
-    r_song_withstop = str(rtup['song']).lower().split()
-    l_artist_withstop = str(ltup['artist_name']).lower().split()
-    r_artist_withstop = str(rtup['artists']).lower().replace('+', ' ').split()
-    stopwords = ('the', 'a')
-    l_song = set(w for w in l_song_withstop if w not in stopwords)
-    r_song = set(w for w in r_song_withstop if w not in stopwords)
-    l_artist = set(w for w in l_artist_withstop if w not in stopwords)
-    r_artist = set(w for w in r_artist_withstop if w not in stopwords)
+    l_song = get_tokens(ltup['title'])
+    r_song = get_tokens(rtup['song'])
+    l_artist = get_tokens(ltup['artist_name'])
+    r_artist = artist_tokens(rtup['artists'])
 
     # If no overlap among artists or no overlap among songs, then drop
     return l_artist.isdisjoint(r_artist) or l_song.isdisjoint(r_song)
@@ -50,46 +73,107 @@ def bb_block(sample_A, sample_B):
     bb = em.BlackBoxBlocker()
     bb.set_black_box_function(match)
     bbC = bb.block_tables(sample_A, sample_B,
-                        l_output_attrs=['id', 'title', 'artist_name', 'year'],
-                        r_output_attrs=['id', 'title', 'year', 'episode', 'song', 'artists'],
+                        l_output_attrs=L_OUTPUT_ATTRS,
+                        r_output_attrs=R_OUTPUT_ATTRS,
     )
 
     return bbC
+
+def song_tokens(A):
+    ''' (title tokens, artist tokens) of each song, as used by match() '''
+    return [get_tokens(v) for v in A['title']], [get_tokens(v) for v in A['artist_name']]
+
+def track_tokens(B):
+    ''' (song tokens, artist tokens) of each track, as used by match() '''
+    return [get_tokens(v) for v in B['song']], [artist_tokens(v) for v in B['artists']]
+
+def index_block(A, B, chunk_size=100000):
+    '''
+    Returns the same DataFrame of candidate pairs as bb_block(), without
+    calling match() on all |A| * |B| pairs, so that it can block the full
+    songs.csv and tracks.csv. match() keeps the pairs that share a title token
+    and an artist token, which blocking.overlap_pairs() finds with an index.
+    '''
+    B['artists'] = B['artists'].str.replace('+', ' + ')
+    l_rows, r_rows = blocking.overlap_pairs(A, B, song_tokens, track_tokens, chunk_size)
+    return blocking.make_candset(A, B, l_rows, r_rows, L_OUTPUT_ATTRS, R_OUTPUT_ATTRS)
     
 def overlap_block(sample_A, sample_B):
     '''
-    Returns a DataFrame of candidate pairs by performing overlap blocking.
-    Performs overlap blocking on title, then overlap blocking on artist, then
-    black-box blocking to guarantee the same results as bb_block().
+    Returns a DataFrame of candidate pairs by performing overlap blocking on
+    title and artist in one indexed pass, with the same results as bb_block().
+    This used to be an OverlapBlocker on title, another on artist, and then a
+    black-box pass, because OverlapBlocker mishandles Unicode words; the index
+    in index_block() tokenizes Unicode correctly, so no black-box pass is needed.
     '''
-    # many artist names in sample_B are something like 
-    # 'budda+wc+ice cube+mack 10+westside connection'
-    # change this to 'budda + wc + ice cube + mack 10 + westside connection'
-    sample_B['artists'] = sample_B['artists'].str.replace('+', ' + ')
+    return index_block(sample_A, sample_B)
     
-    # Create overlap blocker
-    # If no overlap among artists or no overlap among songs, then drop
-    ob = em.OverlapBlocker()
-    ob.stop_words = ['a', 'the']
-    ob.regex_punctuation = re.compile(r'')
-    obC1 = ob.block_tables(sample_A, sample_B, 'title', 'song',
-                        l_output_attrs=['id', 'title', 'artist_name', 'year'],
-                        r_output_attrs=['id', 'title', 'year', 'episode', 'song', 'artists'],
-                        rem_stop_words=True,
-    )
-    ob.regex_punctuation = re.compile(r'\+')
-    obC2 = ob.block_candset(obC1, 'artist_name', 'artists', rem_stop_words=True)
+def rare_block(A, B, max_df=100, top_k=None):
+    '''
+    Returns a DataFrame of candidate pairs by overlap blocking as in
+    index_block(), but never on tokens of more than max_df songs and tracks,
+    and, with top_k, only on the top_k rarest title tokens and artist tokens
+    of each song and track (see blocking.rare_token_functions()). Prints the
+    tokens that are dropped because of max_df.
+    '''
+    B['artists'] = B['artists'].str.replace('+', ' + ')
+    l_tokens, r_tokens, dropped = blocking.rare_token_functions(A, B, song_tokens, track_tokens, max_df, top_k)
+    for attr, tokens in zip(('title', 'artist'), dropped):
+        tokens = sorted(tokens.iteritems(), key=lambda (w, n): (-n, w))
+        print 'Dropped %d %s tokens:' % (len(tokens), attr), ', '.join(u'%s (%d)' % (w, n) for w, n in tokens).encode('utf-8')
+    l_rows, r_rows = blocking.overlap_pairs(A, B, l_tokens, r_tokens)
+    return blocking.make_candset(A, B, l_rows, r_rows, L_OUTPUT_ATTRS, R_OUTPUT_ATTRS)
 
-    # Create black box blocker
-    # Necessary because overlap blocker behaves incorrectly when words contain Unicode characters
-    bb = em.BlackBoxBlocker()
-    bb.set_black_box_function(match)
-    bbC = bb.block_candset(obC2)
+def title_key(value):
+    '''
+    Returns the sort key of a title or song for sn_block(): its lowercase
+    words, without punctuation, remarks in brackets such as "(Club Mix)", or a
+    leading "the".
+    '''
+    if isinstance(value, str):
+        value = value.decode('utf-8', 'replace')
+    else:
+        value = unicode(value)
+    value = re.sub(r'\([^)]*\)|\[[^\]]*\]', ' ', value.lower())
+    value = re.sub(r'[^\w\s]', ' ', value, flags=re.UNICODE)
+    words = value.split()
+    if len(words) > 1 and words[0] == 'the':
+        words = words[1:]
+    return ' '.join(words)
 
-    return bbC
-    
-def debug_block(C, sample_A, sample_B):
-    return em.debug_blocker(C,sample_A, sample_B, attr_corres=[('title', 'song'),('artist_name', 'artists')])
+def sn_block(A, B, window=10):
+    '''
+    Returns a DataFrame of candidate pairs by sorted-neighborhood blocking:
+    the songs and tracks are sorted together by title_key() of title and song,
+    and each song is paired with the tracks less than window positions away.
+    Unlike overlap_block(), common words such as "love" or "remix" do not
+    increase the number of pairs.
+    '''
+    l_rows, r_rows = blocking.sorted_neighborhood_pairs(
+            [title_key(v) for v in A['title']], [title_key(v) for v in B['song']], window)
+    return blocking.make_candset(A, B, l_rows, r_rows, L_OUTPUT_ATTRS, R_OUTPUT_ATTRS)
+
+def canopy_block(A, B, loose=0.5, tight=0.8):
+    '''
+    Returns a DataFrame of candidate pairs by canopy clustering of the TF-IDF
+    vectors of the artist tokens of match(), with the cosine similarity
+    thresholds loose and tight (see blocking.canopy_pairs()). A song and a
+    track are paired if they are in the same canopy.
+    '''
+    l_artists = song_tokens(A)[1]
+    r_artists = track_tokens(B)[1]
+    # The tokens are already computed, so each document is its list of tokens
+    vectorizer = TfidfVectorizer(analyzer=list).fit(l_artists + r_artists)
+    l_rows, r_rows = blocking.canopy_pairs(vectorizer.transform(l_artists), vectorizer.transform(r_artists), loose, tight)
+    return blocking.make_candset(A, B, l_rows, r_rows, L_OUTPUT_ATTRS, R_OUTPUT_ATTRS)
+
+def debug_block(C, sample_A, sample_B, time_budget=60):
+    ''' Prints the recall of C on likely matches, and returns its likely missed matches (see blocker_recall.py) '''
+    summary, missed = blocker_recall.debug_blocker(C, sample_A, sample_B,
+            attr_corres=[('title', 'song'),('artist_name', 'artists')], time_budget=time_budget)
+    for name, value in summary.items():
+        print name, value
+    return missed
     
 def samp_label_split(C):
     S = em.sample_table(C, 500)
@@ -115,10 +199,10 @@ def get_feats(sample_A, sample_B):
     
 def train_fvs(dev_set, match_f):
     ''' get feature vectors for train set '''
-    H = em.extract_feature_vecs(dev_set, feature_table=match_f, attrs_before = ['_id', 'ltable_id', 'rtable_id'], attrs_after='gold_labels')
+    H = features.extract_feature_vecs(dev_set, match_f, attrs_before = ['_id', 'ltable_id', 'rtable_id'], attrs_after='gold_labels')
     return H
 
-def comp_matchers(H, attrs_from_table, attrs_to_be_excluded):
+def comp_matchers(H, attrs_from_table, attrs_to_be_excluded, cache_dir=None):
     # Create set of ML matchers
     dt = em.DTMatcher(name='DecisionTree', random_state=4)
     svm = em.SVMMatcher(name='SVM', random_state=12)
@@ -127,22 +211,15 @@ def comp_matchers(H, attrs_from_table, attrs_to_be_excluded):
     ln = em.LinRegMatcher(name='LinReg')
     nb = em.NBMatcher(name='NaiveBayes')
 
-    # Select best ML matcher using CV
-    # precision
-    presult = em.select_matcher([dt, rf, svm, ln, lg, nb], table=H, 
-            exclude_attrs=attrs_to_be_excluded, k=10, 
-            target_attr='gold_labels', metric='precision', random_state=0)
-    # recall
-    rresult = em.select_matcher([dt, rf, svm, ln, lg, nb], table=H, 
-            exclude_attrs=attrs_to_be_excluded, k=10,
-            target_attr='gold_labels', metric='recall', random_state=1)
-    # F1
-    f1result = em.select_matcher([dt, rf, svm, ln, lg, nb], table=H, 
-            exclude_attrs=attrs_to_be_excluded, k=10,
-            target_attr='gold_labels', metric='f1', random_state=2)
-    print 'precision: ', '\n', presult['cv_stats']
-    print 'recall: ', '\n', rresult['cv_stats']
-    print 'F1: ', '\n', f1result['cv_stats']
+    # Select best ML matcher using CV: each (matcher, fold) is fitted once,
+    # and precision, recall and F1 are computed from the same predictions
+    # (see selection.py)
+    results = selection.compare_matchers([dt, rf, svm, ln, lg, nb], table=H,
+            exclude_attrs=attrs_to_be_excluded, target_attr='gold_labels', k=10,
+            random_state=0, cache_dir=cache_dir)
+    print 'precision: ', '\n', results['precision']
+    print 'recall: ', '\n', results['recall']
+    print 'F1: ', '\n', results['f1']
     
 def debug_rf(H):
     # using GUI    
@@ -151,9 +228,9 @@ def debug_rf(H):
     train, test = train_test['train'], train_test['test']
     em.vis_debug_rf(rf, train, test, exclude_attrs=['_id', 'ltable_id', 'rtable_id'], target_attr='gold_labels')
 
-def use_test_set(H, test_set, match_f, attrs_from_table, attrs_to_be_excluded):
+def use_test_set(H, test_set, match_f, attrs_from_table, attrs_to_be_excluded, models_dir=None):
     # test set to feature vectors 
-    L = em.extract_feature_vecs(test_set, feature_table=match_f,
+    L = features.extract_feature_vecs(test_set, match_f,
                                  attrs_before= ['_id', 'ltable_id', 'rtable_id'],
                                  attrs_after='gold_labels')
     
@@ -165,47 +242,11 @@ def use_test_set(H, test_set, match_f, attrs_from_table, attrs_to_be_excluded):
     ln = em.LinRegMatcher(name='LinReg')
     nb = em.NBMatcher(name='NaiveBayes')
     
-    # Train using feature vectors from dev set 
-    dt.fit(table=H, exclude_attrs=attrs_to_be_excluded, target_attr='gold_labels')
-    svm.fit(table=H, exclude_attrs=attrs_to_be_excluded, target_attr='gold_labels')
-    rf.fit(table=H, exclude_attrs=attrs_to_be_excluded, target_attr='gold_labels')
-    lg.fit(table=H, exclude_attrs=attrs_to_be_excluded, target_attr='gold_labels')
-    ln.fit(table=H, exclude_attrs=attrs_to_be_excluded, target_attr='gold_labels')
-    nb.fit(table=H, exclude_attrs=attrs_to_be_excluded, target_attr='gold_labels')
-    
-    # Predict on test set L
-    dtpred = dt.predict(table=L, exclude_attrs=attrs_to_be_excluded, 
-                  append=True, target_attr='predicted', inplace=False)
-    svmpred = svm.predict(table=L, exclude_attrs=attrs_to_be_excluded, 
-                  append=True, target_attr='predicted', inplace=False)
-    rfpred = rf.predict(table=L, exclude_attrs=attrs_to_be_excluded, 
-              append=True, target_attr='predicted', inplace=False)
-    lgpred = lg.predict(table=L, exclude_attrs=attrs_to_be_excluded, 
-                  append=True, target_attr='predicted', inplace=False)
-    lnpred = ln.predict(table=L, exclude_attrs=attrs_to_be_excluded, 
-              append=True, target_attr='predicted', inplace=False)
-    nbpred = nb.predict(table=L, exclude_attrs=attrs_to_be_excluded, 
-              append=True, target_attr='predicted', inplace=False)
-    
-    # Evaluate predictions
-    dteval = em.eval_matches(dtpred, 'gold_labels', 'predicted')
-    svmeval = em.eval_matches(svmpred, 'gold_labels', 'predicted')
-    rfeval = em.eval_matches(rfpred, 'gold_labels', 'predicted')
-    lgeval = em.eval_matches(lgpred, 'gold_labels', 'predicted')
-    lneval = em.eval_matches(lnpred, 'gold_labels', 'predicted')
-    nbeval = em.eval_matches(nbpred, 'gold_labels', 'predicted')
-    print 'DT:'
-    em.print_eval_summary(dteval)
-    print 'RF:'
-    em.print_eval_summary(rfeval)
-    print 'SVM:'
-    em.print_eval_summary(svmeval)
-    print 'LinReg:'
-    em.print_eval_summary(lneval)
-    print 'LogReg:'
-    em.print_eval_summary(lgeval)
-    print 'NaiveBayes:'
-    em.print_eval_summary(nbeval)
+    # Train each matcher on the dev set and evaluate it on the test set L, all
+    # in parallel (see selection.py)
+    summary = selection.evaluate_matchers([dt, rf, svm, ln, lg, nb], H, L,
+            attrs_to_be_excluded, 'gold_labels', models_dir=models_dir, name_prefix='stage3-')
+    print summary.to_string()
     
 def main():
     sample_A = em.read_csv_metadata(argv[1], key='id')
@@ -223,12 +264,15 @@ def main():
 
     H = train_fvs(dev_set, match_f)
     #em.to_csv_metadata(H, './H.csv')
+    models_dir = argv[5] if len(argv) > 5 else None
     print 'Comparing Matchers:'
-    comp_matchers(H, attrs_from_table, attrs_to_be_excluded)
+    # The cross-validation predictions are cached next to the models
+    cv_dir = os.path.join(models_dir, 'cv') if models_dir is not None else None
+    comp_matchers(H, attrs_from_table, attrs_to_be_excluded, cv_dir)
 
     print
     print 'Metrics on Test Set:'
-    use_test_set(H, test_set, match_f, attrs_from_table, attrs_to_be_excluded)
+    use_test_set(H, test_set, match_f, attrs_from_table, attrs_to_be_excluded, models_dir)
 
 
 if __name__ == "__main__":
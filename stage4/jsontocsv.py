@@ -9,13 +9,15 @@ reload(sys)
 sys.setdefaultencoding('utf-8')
 from collections import OrderedDict
 
-def json_to_csv(in_json, out_csv, iszomato):
+def write_csv(in_json, output_file, iszomato):
+    '''
+    Writes the JSON lines of in_json as CSV to output_file, a file object.
+    '''
     with open(in_json, 'r') as f:
         first_line = json.loads(f.readline(), object_pairs_hook=OrderedDict)
     header = first_line.keys()
     if iszomato == "y":
         header.extend(first_line['location'].keys())
-    output_file = open(out_csv, 'w')
     csvwriter = csv.DictWriter(output_file, fieldnames = header)
     csvwriter.writeheader()
     with open(in_json) as f:
@@ -25,7 +27,10 @@ def json_to_csv(in_json, out_csv, iszomato):
                 location = json_line['location']
                 json_line.update(location)
             csvwriter.writerow(json_line)
-    output_file.close()
+
+def json_to_csv(in_json, out_csv, iszomato):
+    with open(out_csv, 'w') as output_file:
+        write_csv(in_json, output_file, iszomato)
     
 def main():
     input_json = sys.argv[1]
@@ -1,6 +1,15 @@
 # -*- coding: utf-8 -*-
 import py_entitymatching as em
-import re
+import numpy as np
+import os
+import sys
+
+# blocker_recall.py, blocking.py, features.py and selection.py are shared with stage 3
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'stage3', 'CODE'))
+import blocker_recall
+import blocking
+import features
+import selection
 
 def get_tables(A_file, B_file):
     '''
@@ -29,18 +38,60 @@ def match(ltup, rtup):
         return True
 
     # check for overlap in restaurant name and address
-    stopwords = ('&', 'the', 'n', 's', 'e', 'w', 'st', 'st.', 'dr', 'dr.', 'rd', 'rd.', 'ln', 'ln.')
-    l_namewithstop = set(str(ltup['name']).lower().split())
-    r_namewithstop = set(str(rtup['name']).lower().split())
-    l_name = set(w for w in l_namewithstop if w not in stopwords)
-    r_name = set(w for w in r_namewithstop if w not in stopwords)
-    l_addwithstop = set(str(ltup['address']).lower().split())
-    r_addwithstop = set(str(rtup['address']).lower().split())
-    l_add = set(w for w in l_addwithstop if w not in stopwords)
-    r_add = set(w for w in r_addwithstop if w not in stopwords)
+    l_name = get_tokens(ltup['name'])
+    r_name = get_tokens(rtup['name'])
+    l_add = get_tokens(ltup['address'])
+    r_add = get_tokens(rtup['address'])
 
     return l_name.isdisjoint(r_name) or l_add.isdisjoint(r_add)
 
+STOPWORDS = ('&', 'the', 'n', 's', 'e', 'w', 'st', 'st.', 'dr', 'dr.', 'rd', 'rd.', 'ln', 'ln.')
+# Stop words of the OverlapBlocker on names that used to run before match()
+OVERLAP_STOPWORDS = tuple(em.OverlapBlocker().stop_words)
+
+# Default distance for spatial_block(). Matching restaurants are almost
+# always within 1 km of each other, but some of Yelp's or Zomato's locations
+# are several km off.
+RADIUS_KM = 5.0
+
+def get_tokens(value, stopwords=STOPWORDS):
+    '''
+    Returns the set of lowercase words of value, excluding stop words.
+    '''
+    return blocking.get_tokens(value, stopwords)
+
+def restaurant_tokens(T):
+    '''
+    (name tokens, address tokens) of each restaurant, as indexed by
+    overlap_block(). Names exclude OverlapBlocker's stop words, and addresses
+    exclude STOPWORDS, as in match(). Restaurants with a missing latitude or
+    longitude get no tokens, so they are blocked out, as in match().
+    '''
+    missing = (T['latitude'] == 0) | (T['longitude'] == 0)
+    names = [set() if m else get_tokens(v, OVERLAP_STOPWORDS) for v, m in zip(T['name'], missing)]
+    addresses = [set() if m else get_tokens(v) for v, m in zip(T['address'], missing)]
+    return names, addresses
+
+def share_name_word(A, B, l_rows, r_rows):
+    '''
+    Returns a boolean array that is True for the pairs (A.iloc[l_rows[i]],
+    B.iloc[r_rows[i]]) whose names share a word that is not in STOPWORDS, the
+    name check of match().
+    '''
+    l_names = [get_tokens(v) for v in A['name']]
+    r_names = [get_tokens(v) for v in B['name']]
+    return np.array([not l_names[l].isdisjoint(r_names[r]) for l, r in zip(l_rows, r_rows)], dtype=bool)
+
+def coordinates(T):
+    '''
+    (latitudes, longitudes) of each restaurant, as used by spatial_block(),
+    with NaN for a missing (0) latitude or longitude.
+    '''
+    missing = (T['latitude'] == 0) | (T['longitude'] == 0)
+    latitudes = np.where(missing, np.nan, T['latitude'].values.astype(np.float64))
+    longitudes = np.where(missing, np.nan, T['longitude'].values.astype(np.float64))
+    return latitudes, longitudes
+
 def bb_block(A, B):
     '''
     Returns a DataFrame of candidate pairs by performing black-box blocking.
@@ -52,28 +103,51 @@ def bb_block(A, B):
     return bbC
     
 def overlap_block(A, B):
+    '''
+    Returns a DataFrame of candidate pairs by performing overlap blocking on
+    name and address with an index (see stage3/CODE/blocking.py). This used to
+    be an OverlapBlocker on name followed by a black-box pass with match(), and
+    keeps the same pairs: the names share a word that is not one of
+    OverlapBlocker's stop words, the names share a word that is not in
+    STOPWORDS (possibly a different word), and the addresses share a word that
+    is not in STOPWORDS. The index finds the pairs that pass the first and
+    last checks, and share_name_word() applies the second to them.
+    '''
     A['name2'] = A['name'].str.lower()
     B['name2'] = B['name'].str.lower()
-    ob = em.OverlapBlocker()
-    ob.regex_punctuation = re.compile(r'')
-    obC = ob.block_tables(A, B, 'name2', 'name2',
-                        l_output_attrs=['business_id', 'name2', 'address', 'address_num', 'postal_code', 'latitude', 'longitude'],
-                        r_output_attrs=['id', 'name2', 'address', 'address_num', 'zipcode', 'latitude', 'longitude'],
-                        rem_stop_words=True,
-    )
+    l_rows, r_rows = blocking.overlap_pairs(A, B, restaurant_tokens, restaurant_tokens)
+    keep = share_name_word(A, B, l_rows, r_rows)
+    l_rows, r_rows = l_rows[keep], r_rows[keep]
+    return blocking.make_candset(A, B, l_rows, r_rows,
+                        ['business_id', 'name2', 'address', 'address_num', 'postal_code', 'latitude', 'longitude'],
+                        ['id', 'name2', 'address', 'address_num', 'zipcode', 'latitude', 'longitude'])
 
-    bb = em.BlackBoxBlocker()
-    bb.set_black_box_function(match)
-    bbC = bb.block_candset(obC)
-
-    return bbC
+def spatial_block(A, B, radius_km=RADIUS_KM):
+    '''
+    Returns a DataFrame of the candidate pairs of overlap_block() that are at
+    most radius_km apart. Only restaurants in nearby cells of a grid are
+    compared (see stage3/CODE/blocking.py), so unlike overlap_block() this does
+    not rely on every restaurant being in Madison, and whole metro areas can
+    be blocked at once.
+    '''
+    A['name2'] = A['name'].str.lower()
+    B['name2'] = B['name'].str.lower()
+    l_rows, r_rows = blocking.radius_overlap_pairs(A, B, restaurant_tokens, restaurant_tokens,
+                                                   coordinates, coordinates, radius_km)
+    keep = share_name_word(A, B, l_rows, r_rows)
+    l_rows, r_rows = l_rows[keep], r_rows[keep]
+    return blocking.make_candset(A, B, l_rows, r_rows,
+                        ['business_id', 'name2', 'address', 'address_num', 'postal_code', 'latitude', 'longitude'],
+                        ['id', 'name2', 'address', 'address_num', 'zipcode', 'latitude', 'longitude'])
 
-def debug_block(C, A, B):
-    #A['latitude'] = A['latitude'].apply(str)
-    #B['latitude'] = B['latitude'].apply(str)
-    #A['longitude'] = A['longitude'].apply(str)
-    #B['longitude'] = B['longitude'].apply(str)
-    return em.debug_blocker(C, A, B, attr_corres=[('name', 'name'), ('address', 'address'), ('latitude','latitude'), ('longitude','longitude')])
+def debug_block(C, A, B, time_budget=60):
+    ''' Prints the recall of C on likely matches, and returns its likely missed matches (see stage3/CODE/blocker_recall.py) '''
+    summary, missed = blocker_recall.debug_blocker(C, A, B,
+            attr_corres=[('name', 'name'), ('address', 'address'), ('latitude','latitude'), ('longitude','longitude')],
+            time_budget=time_budget)
+    for name, value in summary.items():
+        print name, value
+    return missed
     
 def samp_label_split(C):
     S = em.sample_table(C, 500)
@@ -100,10 +174,10 @@ def get_feats(A, B):
     
 def train_fvs(dev_set, match_f):
     ''' get feature vectors for train set '''
-    H = em.extract_feature_vecs(dev_set, feature_table=match_f, attrs_before = ['_id', 'ltable_business_id', 'rtable_id'], attrs_after='gold_labels')
+    H = features.extract_feature_vecs(dev_set, match_f, attrs_before = ['_id', 'ltable_business_id', 'rtable_id'], attrs_after='gold_labels')
     return H
     
-def comp_matchers(H, attrs_from_table, attrs_to_be_excluded):
+def comp_matchers(H, attrs_from_table, attrs_to_be_excluded, cache_dir=None):
     # Create set of ML matchers
     dt = em.DTMatcher(name='DecisionTree', random_state=4)
     svm = em.SVMMatcher(name='SVM', random_state=12)
@@ -112,22 +186,15 @@ def comp_matchers(H, attrs_from_table, attrs_to_be_excluded):
     ln = em.LinRegMatcher(name='LinReg')
     nb = em.NBMatcher(name='NaiveBayes')
 
-    # Select best ML matcher using CV
-    # precision
-    presult = em.select_matcher([dt, rf, svm, ln, lg, nb], table=H, 
-            exclude_attrs=attrs_to_be_excluded, k=10, 
-            target_attr='gold_labels', metric='precision', random_state=0)
-    # recall
-    rresult = em.select_matcher([dt, rf, svm, ln, lg, nb], table=H, 
-            exclude_attrs=attrs_to_be_excluded, k=10,
-            target_attr='gold_labels', metric='recall', random_state=1)
-    # F1
-    f1result = em.select_matcher([dt, rf, svm, ln, lg, nb], table=H, 
-            exclude_attrs=attrs_to_be_excluded, k=10,
-            target_attr='gold_labels', metric='f1', random_state=2)
-    print 'precision: ', '\n', presult['cv_stats']
-    print 'recall: ', '\n', rresult['cv_stats']
-    print 'F1: ', '\n', f1result['cv_stats']
+    # Select best ML matcher using CV: each (matcher, fold) is fitted once,
+    # and precision, recall and F1 are computed from the same predictions
+    # (see selection.py)
+    results = selection.compare_matchers([dt, rf, svm, ln, lg, nb], table=H,
+            exclude_attrs=attrs_to_be_excluded, target_attr='gold_labels', k=10,
+            random_state=0, cache_dir=cache_dir)
+    print 'precision: ', '\n', results['precision']
+    print 'recall: ', '\n', results['recall']
+    print 'F1: ', '\n', results['f1']
     
 
 def debug_rf(H):
@@ -147,47 +214,11 @@ def use_test_set(H, L, match_f, attrs_from_table, attrs_to_be_excluded):
     ln = em.LinRegMatcher(name='LinReg')
     nb = em.NBMatcher(name='NaiveBayes')
     
-    # Train using feature vectors from dev set 
-    dt.fit(table=H, exclude_attrs=attrs_to_be_excluded, target_attr='gold_labels')
-    svm.fit(table=H, exclude_attrs=attrs_to_be_excluded, target_attr='gold_labels')
-    rf.fit(table=H, exclude_attrs=attrs_to_be_excluded, target_attr='gold_labels')
-    lg.fit(table=H, exclude_attrs=attrs_to_be_excluded, target_attr='gold_labels')
-    ln.fit(table=H, exclude_attrs=attrs_to_be_excluded, target_attr='gold_labels')
-    nb.fit(table=H, exclude_attrs=attrs_to_be_excluded, target_attr='gold_labels')
-    
-    # Predict on test set L
-    dtpred = dt.predict(table=L, exclude_attrs=attrs_to_be_excluded, 
-                  append=True, target_attr='predicted', inplace=False)
-    svmpred = svm.predict(table=L, exclude_attrs=attrs_to_be_excluded, 
-                  append=True, target_attr='predicted', inplace=False)
-    rfpred = rf.predict(table=L, exclude_attrs=attrs_to_be_excluded, 
-              append=True, target_attr='predicted', inplace=False)
-    lgpred = lg.predict(table=L, exclude_attrs=attrs_to_be_excluded, 
-                  append=True, target_attr='predicted', inplace=False)
-    lnpred = ln.predict(table=L, exclude_attrs=attrs_to_be_excluded, 
-              append=True, target_attr='predicted', inplace=False)
-    nbpred = nb.predict(table=L, exclude_attrs=attrs_to_be_excluded, 
-              append=True, target_attr='predicted', inplace=False)
-    
-    # Evaluate predictions
-    dteval = em.eval_matches(dtpred, 'gold_labels', 'predicted')
-    svmeval = em.eval_matches(svmpred, 'gold_labels', 'predicted')
-    rfeval = em.eval_matches(rfpred, 'gold_labels', 'predicted')
-    lgeval = em.eval_matches(lgpred, 'gold_labels', 'predicted')
-    lneval = em.eval_matches(lnpred, 'gold_labels', 'predicted')
-    nbeval = em.eval_matches(nbpred, 'gold_labels', 'predicted')
-    print 'DT:'
-    em.print_eval_summary(dteval)
-    print 'RF:'
-    em.print_eval_summary(rfeval)
-    print 'SVM:'
-    em.print_eval_summary(svmeval)
-    print 'LinReg:'
-    em.print_eval_summary(lneval)
-    print 'LogReg:'
-    em.print_eval_summary(lgeval)
-    print 'NaiveBayes:'
-    em.print_eval_summary(nbeval)
+    # Train each matcher on the dev set and evaluate it on the test set L, all
+    # in parallel (see selection.py)
+    summary = selection.evaluate_matchers([dt, rf, svm, ln, lg, nb], H, L,
+            attrs_to_be_excluded, 'gold_labels')
+    print summary.to_string()
           
 def main():
     ''' Using train & test sets to choose best matcher '''
@@ -220,7 +251,7 @@ def main():
     
     '''
     # test set to feature vectors 
-    L = em.extract_feature_vecs(J, feature_table=match_f,
+    L = features.extract_feature_vecs(J, match_f,
                                  attrs_before= ['_id', 'ltable_business_id', 'rtable_id'],
                                  attrs_after='gold_labels')
     L = L.fillna(1)
@@ -1,46 +1,84 @@
 '''
-Usage: python merge_tables.py
+Usage: python merge_tables.py [models/]
+
+With models/, the matcher trained on G.csv is saved to that model store (see
+stage2/code/model_store.py), and later runs load it instead of retraining.
+
+The feature vectors of C.csv are computed in parallel chunks, which are kept
+in K_chunks/ (see stage3/CODE/features.py), so an interrupted or repeated run
+only computes the chunks that are missing.
 '''
 
 import py_entitymatching as em
 import match_magellan as mm
+import numpy as np
+import os
 import pandas as pd
+import sys
+from sys import argv
 
-def get_all_matches():
-    ''' based on the train & test set, Logistic Regression is the winner '''
-    A = em.read_csv_metadata('A.csv', key='business_id')
-    B = em.read_csv_metadata('B.csv', key='id')
-    C = em.read_csv_metadata('C.csv', key='_id',ltable=A, rtable=B, fk_ltable='ltable_business_id', fk_rtable='rtable_id')
+# model_store.py is shared with stage 2, and features.py with stage 3
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'stage2', 'code'))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'stage3', 'CODE'))
+import features
+import model_store
+
+def get_fvs(A, B, C, G, chunk_dir='K_chunks'):
+    '''
+    Returns (K, Gfvs), the feature vectors of the candidate set C and of the
+    labeled sample G, with missing features set to 1.
+    chunk_dir: passed to features.extract_feature_vecs()
+    '''
     match_f = mm.get_feats(A, B)
-    K = em.extract_feature_vecs(C, feature_table=match_f,
-                                 attrs_before= ['_id', 'ltable_business_id', 'rtable_id'])
-    K = K.fillna(1)
-    attrs_to_exclude = ['_id', 'ltable_business_id', 'rtable_id']
-    G = em.read_csv_metadata('G.csv', key='_id', ltable=A, rtable=B, fk_ltable='ltable_business_id', fk_rtable='rtable_id')
+    K = features.extract_feature_vecs(C, match_f,
+                                 attrs_before= ['_id', 'ltable_business_id', 'rtable_id'],
+                                 chunk_dir=chunk_dir)
+    # fillna() returns a new DataFrame, which the catalog knows nothing about
+    K_filled = K.fillna(1)
+    em.copy_properties(K, K_filled)
     Gfvs = mm.train_fvs(G, match_f)
-    Gfvs = Gfvs.fillna(1)
-    
-    #em.to_csv_metadata(K, './K.csv')
-    K = em.read_csv_metadata('K.csv', key='_id', ltable=A, rtable=B, fk_ltable='ltable_business_id', fk_rtable='rtable_id')
+    Gfvs_filled = Gfvs.fillna(1)
+    em.copy_properties(Gfvs, Gfvs_filled)
+    return K_filled, Gfvs_filled
 
+def predict_matches(K, Gfvs, models_dir=None):
+    ''' based on the train & test set, Logistic Regression is the winner '''
+    attrs_to_exclude = ['_id', 'ltable_business_id', 'rtable_id']
     lg = em.LogRegMatcher(name='LogReg', random_state=77)
-    lg.fit(table=Gfvs, exclude_attrs=attrs_to_exclude, target_attr='gold_labels')
+    schema = [attr for attr in Gfvs.columns if attr not in attrs_to_exclude and attr != 'gold_labels']
+    data_hash = model_store.training_hash(Gfvs, attrs_to_exclude, repr(lg.clf))
+    lg = model_store.fit_or_load(models_dir, 'merge_tables-LogReg', lg, schema, data_hash,
+            lambda lg: lg.fit(table=Gfvs, exclude_attrs=attrs_to_exclude, target_attr='gold_labels'))
     
     predictions = lg.predict(table=K, exclude_attrs=attrs_to_exclude, 
               append=True, target_attr='predicted', inplace=False)
     
     matches = predictions.loc[predictions['predicted'] == 1]
     return matches
+
+def get_all_matches(models_dir=None):
+    A = em.read_csv_metadata('A.csv', key='business_id')
+    B = em.read_csv_metadata('B.csv', key='id')
+    C = em.read_csv_metadata('C.csv', key='_id',ltable=A, rtable=B, fk_ltable='ltable_business_id', fk_rtable='rtable_id')
+    G = em.read_csv_metadata('G.csv', key='_id', ltable=A, rtable=B, fk_ltable='ltable_business_id', fk_rtable='rtable_id')
+    K, Gfvs = get_fvs(A, B, C, G)
+    return predict_matches(K, Gfvs, models_dir)
     
+def merge_with_orig(matches, Y, Z):
+    '''
+    Returns the matches joined with their Yelp (Y) and Zomato (Z) tuples.
+    '''
+    matches_y = matches[['ltable_business_id', 'rtable_id']].merge(Y, left_on='ltable_business_id', right_on='business_id')
+    matches_y_z = matches_y.merge(Z, left_on='rtable_id', right_on='id')   
+    return matches_y_z
+
 def matchesfvs_to_orig(matches):
     ''' output of get_all_matches() is in feature vector form
         merge with original csv files
     '''
     Y = em.read_csv_metadata('yelp_restaurants.csv', key='business_id')
     Z = em.read_csv_metadata('zomato_restaurants.csv', key='id')
-    matches_y = matches[['ltable_business_id', 'rtable_id']].merge(Y, left_on='ltable_business_id', right_on='business_id')
-    matches_y_z = matches_y.merge(Z, left_on='rtable_id', right_on='id')   
-    em.to_csv_metadata(matches_y_z, './matches.csv')
+    em.to_csv_metadata(merge_with_orig(matches, Y, Z), './matches.csv')
     
 def cleanup(M):
     ''' 
@@ -95,73 +133,47 @@ def cleanup(M):
 
     return M
     
-'''
-None of the compute_* functions should perform side effects. See the docs for
-pandas.DataFrame.apply() for more information.
-'''
-
-def compute_name(row):
-    '''
-    Chooses the name with the longer length.
-    '''
-    if len(row['name_x']) < len(row['name_y']):
-        row['name'] = row['name_y']
-    else:
-        row['name'] = row['name_x']
-    return row
+# Conflict resolution for each attribute that both Yelp (attr_x) and Zomato
+# (attr_y) have, in the order of the fused columns of E.csv:
+#     'longer': the value with the longer length, or Yelp's if they are equally
+#         long
+#     'mean': the average (arithmetic mean), assuming that neither value is 0
+FUSION_SPEC = [
+    ('name', 'longer'),
+    ('address', 'longer'),
+    ('latitude', 'mean'),
+    ('longitude', 'mean'),
+]
 
-def compute_address(row):
+def fuse(M, spec=FUSION_SPEC):
     '''
-    Chooses the address with the longer length.
+    Returns M with each attribute of spec resolved from its attr_x and attr_y
+    columns, which are dropped. Each attribute is computed on whole columns,
+    rather than with a DataFrame.apply() per attribute.
+    A missing value counts as shorter than any string.
     '''
-    if len(row['address_x']) < len(row['address_y']):
-        row['address'] = row['address_y']
-    else:
-        row['address'] = row['address_x']
-    return row
-
-def compute_latitude(row):
-    '''
-    Computes the latitude as the average (arithmetic mean) of latitude_x and
-    and latitude_y. Assumes that none of the latitudes are 0.
-    '''
-    row['latitude'] = (row['latitude_x'] + row['latitude_y']) / 2
-    return row
-
-def compute_longitude(row):
-    '''
-    Computes the longitude as the average (arithmetic mean) of longitude_x and
-    longitude_y. Assumes that none of the longitudes are 0.
-    '''
-    row['longitude'] = (row['longitude_x'] + row['longitude_y']) / 2
-    return row
+    fused = pd.DataFrame(index=M.index)
+    for attr, rule in spec:
+        x = M[attr + '_x']
+        y = M[attr + '_y']
+        if rule == 'longer':
+            longer_y = x.str.len().fillna(-1).values < y.str.len().fillna(-1).values
+            fused[attr] = np.where(longer_y, y.values, x.values)
+        elif rule == 'mean':
+            fused[attr] = (x + y) / 2
+        else:
+            raise ValueError('Unknown conflict resolution rule: %s' % rule)
+    sources = [attr + suffix for attr, _ in spec for suffix in ('_x', '_y')]
+    return pd.concat([M.drop(sources, axis=1), fused], axis=1)
 
 def main():
-    matchesfvs_to_orig(get_all_matches())
+    models_dir = argv[1] if len(argv) > 1 else None
+    matchesfvs_to_orig(get_all_matches(models_dir))
     
     uncleanM = em.read_csv_metadata('./matches_cleaned.csv')
     
     M = cleanup(uncleanM)
-    
-    M['name'] = pd.Series()
-    M = M.apply(compute_name, axis=1)
-    M.pop('name_x')
-    M.pop('name_y')
-    
-    M['address'] = pd.Series()
-    M = M.apply(compute_address, axis=1)
-    M.pop('address_x')
-    M.pop('address_y')
-    
-    M['latitude'] = pd.Series()
-    M = M.apply(compute_latitude, axis=1)
-    M.pop('latitude_x')
-    M.pop('latitude_y')
-    
-    M['longitude'] = pd.Series()
-    M = M.apply(compute_longitude, axis=1)
-    M.pop('longitude_x')
-    M.pop('longitude_y')
+    M = fuse(M)
     
     em.to_csv_metadata(M, './E.csv')
 
@@ -0,0 +1,266 @@
+'''
+Usage: python pipeline.py [options]
+
+Runs all of stage 4 in one process, passing DataFrames from each stage to the
+next instead of writing and re-reading A.csv, B.csv, C.csv, K.csv,
+matches.csv and matches_cleaned.csv:
+    load: the Yelp and Zomato restaurants (JSON files are converted as in
+        jsontocsv.py), A and B (the restaurants with address_num, as in
+        match_magellan.get_tables()), and the labeled sample G of C (by
+        default I.csv and J.csv, the development and test sets that G was
+        split into)
+    block: the candidate set C (match_magellan.overlap_block(), or
+        spatial_block() with --radius)
+    features: the feature vectors of C and G (merge_tables.get_fvs())
+    predict: the matches (merge_tables.predict_matches())
+    merge: the matches joined with their restaurants
+        (merge_tables.merge_with_orig())
+    cleanup, fuse: merge_tables.cleanup() and fuse(), after which the merged
+        table is written to E.csv
+The wall time and peak memory of each stage are printed at the end. The peak
+memory is that of this process; the feature extraction processes are not
+included.
+
+matches.csv was checked by hand (as matches_cleaned.csv) before the merge;
+the pipeline merges the predicted matches as they are.
+
+With --checkpoints DIR, the output of each stage is saved to DIR as a pickle,
+and a later run with the same DIR loads it instead of running the stage
+again, unless an argument or input file that the stage depends on (directly,
+or through an earlier stage) has changed. Input files are compared by path,
+size and modification time.
+'''
+
+import argparse
+import hashlib
+import io
+import os
+import time
+import py_entitymatching as em
+import pandas as pd
+import match_magellan as mm
+import merge_tables as mt
+# merge_tables adds stage2/code, with model_store.py, to sys.path
+import model_store
+
+def read_restaurants(filename, iszomato, key):
+    '''
+    Returns the restaurants of a CSV file, or of a JSON file with the same
+    columns and types as its CSV file from jsontocsv.py.
+    '''
+    if filename.endswith('.json'):
+        # jsontocsv changes the default encoding, so only import it if needed
+        import jsontocsv
+        output_file = io.BytesIO()
+        jsontocsv.write_csv(filename, output_file, iszomato)
+        output_file.seek(0)
+        T = pd.read_csv(output_file)
+    else:
+        T = pd.read_csv(filename)
+    em.set_key(T, key)
+    return T
+
+def with_address_num(T, key):
+    '''
+    Returns a copy of T with address_num, as in match_magellan.get_tables().
+    address_num is numeric, as in A.csv and B.csv.
+    '''
+    T = T.copy()
+    T['address_num'] = pd.to_numeric(T['address'].str.extract(r'(\d+)', expand=False))
+    em.set_key(T, key)
+    return T
+
+def set_candset_metadata(T, A, B):
+    ''' Sets the metadata of a candidate set, or of its feature vectors '''
+    em.set_key(T, '_id')
+    em.set_ltable(T, A)
+    em.set_rtable(T, B)
+    em.set_fk_ltable(T, 'ltable_business_id')
+    em.set_fk_rtable(T, 'rtable_id')
+
+def set_metadata(frames):
+    '''
+    Sets the metadata of each DataFrame of frames, which em keeps outside of
+    the DataFrames, so it is lost when they are loaded from a checkpoint.
+    '''
+    for name, key in (('Y', 'business_id'), ('Z', 'id'), ('A', 'business_id'), ('B', 'id')):
+        if name in frames:
+            em.set_key(frames[name], key)
+    for name in ('G', 'C', 'K', 'Gfvs', 'matches'):
+        if name in frames:
+            set_candset_metadata(frames[name], frames['A'], frames['B'])
+
+def read_labels(filenames, A, B):
+    '''
+    Returns the labeled sample G of the candidate set, from one file or from
+    the files that it was split into.
+    '''
+    G = pd.concat([pd.read_csv(filename) for filename in filenames], ignore_index=True)
+    set_candset_metadata(G, A, B)
+    return G
+
+def load(frames, args):
+    Y = read_restaurants(args.yelp, 'n', 'business_id')
+    Z = read_restaurants(args.zomato, 'y', 'id')
+    A = with_address_num(Y, 'business_id')
+    B = with_address_num(Z, 'id')
+    G = read_labels(args.labels, A, B)
+    return {'Y': Y, 'Z': Z, 'A': A, 'B': B, 'G': G}
+
+def block(frames, args):
+    if args.radius is None:
+        C = mm.overlap_block(frames['A'], frames['B'])
+    else:
+        C = mm.spatial_block(frames['A'], frames['B'], args.radius)
+    return {'C': C}
+
+def extract_features(frames, args):
+    chunk_dir = None
+    if args.checkpoints is not None:
+        chunk_dir = os.path.join(args.checkpoints, 'K_chunks')
+    K, Gfvs = mt.get_fvs(frames['A'], frames['B'], frames['C'], frames['G'], chunk_dir=chunk_dir)
+    return {'K': K, 'Gfvs': Gfvs}
+
+def predict(frames, args):
+    return {'matches': mt.predict_matches(frames['K'], frames['Gfvs'], args.models)}
+
+def merge(frames, args):
+    return {'M': mt.merge_with_orig(frames['matches'], frames['Y'], frames['Z'])}
+
+def cleanup(frames, args):
+    # cleanup() modifies M, which may also be the merge checkpoint
+    return {'M': mt.cleanup(frames['M'].copy())}
+
+def fuse(frames, args):
+    return {'E': mt.fuse(frames['M'])}
+
+# (name, function, names of the arguments that the stage depends on, besides
+# the outputs of the earlier stages)
+STAGES = [
+    ('load', load, ('yelp', 'zomato', 'labels')),
+    ('block', block, ('radius',)),
+    ('features', extract_features, ()),
+    ('predict', predict, ('models',)),
+    ('merge', merge, ()),
+    ('cleanup', cleanup, ()),
+    ('fuse', fuse, ()),
+]
+
+# Arguments that name input files
+FILE_ARGS = ('yelp', 'zomato', 'labels')
+
+def fingerprint(previous, stage, arg_names, args):
+    '''
+    Returns a hash of the fingerprint of the previous stage, and of the
+    arguments that stage depends on, including the path, size and
+    modification time of each input file. A checkpoint is only loaded if its
+    fingerprint is the same.
+    '''
+    h = hashlib.sha1()
+    h.update(previous)
+    h.update(stage)
+    for name in arg_names:
+        value = getattr(args, name)
+        h.update(repr((name, value)))
+        if name in FILE_ARGS:
+            for filename in (value if isinstance(value, list) else [value]):
+                stat = os.stat(filename)
+                h.update(repr((os.path.abspath(filename), stat.st_size, stat.st_mtime)))
+    return h.hexdigest()
+
+def reset_peak_memory():
+    '''
+    Resets the peak resident set size of this process, if the OS allows it
+    (Linux does), so that the peak of each stage can be measured.
+    '''
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except IOError:
+        pass
+
+def peak_memory_mb():
+    ''' Returns the peak resident set size of this process, in MB '''
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.0
+    except IOError:
+        pass
+    import resource
+    # kB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def load_checkpoint(checkpoints, stage, stage_fingerprint):
+    '''
+    Returns the saved output of stage, or None if there is none with the
+    fingerprint stage_fingerprint.
+    '''
+    if checkpoints is None:
+        return None
+    checkpoint_file = os.path.join(checkpoints, stage + '.pkl')
+    if not os.path.exists(checkpoint_file):
+        return None
+    checkpoint = pd.read_pickle(checkpoint_file)
+    if checkpoint.get('fingerprint') != stage_fingerprint:
+        return None
+    return checkpoint['outputs']
+
+def save_checkpoint(checkpoints, stage, stage_fingerprint, outputs):
+    if checkpoints is None:
+        return
+    if not os.path.exists(checkpoints):
+        os.makedirs(checkpoints)
+    checkpoint_file = os.path.join(checkpoints, stage + '.pkl')
+    model_store.atomic_write(checkpoint_file, lambda filename: pd.to_pickle(
+        {'fingerprint': stage_fingerprint, 'outputs': outputs}, filename))
+
+def run(args):
+    '''
+    Runs the stages, and returns (the DataFrames of all stages, a list of
+    (stage, wall time in seconds, peak memory in MB, whether it was loaded
+    from a checkpoint)).
+    '''
+    frames = {}
+    report = []
+    stage_fingerprint = ''
+    for stage, function, arg_names in STAGES:
+        reset_peak_memory()
+        start = time.time()
+        stage_fingerprint = fingerprint(stage_fingerprint, stage, arg_names, args)
+        outputs = load_checkpoint(args.checkpoints, stage, stage_fingerprint)
+        loaded = outputs is not None
+        if loaded:
+            frames.update(outputs)
+            set_metadata(frames)
+        else:
+            outputs = function(frames, args)
+            save_checkpoint(args.checkpoints, stage, stage_fingerprint, outputs)
+            frames.update(outputs)
+        report.append((stage, time.time() - start, peak_memory_mb(), loaded))
+    return frames, report
+
+def print_report(report):
+    print '%-10s %10s %18s' % ('stage', 'time (s)', 'peak memory (MB)')
+    for stage, seconds, memory, loaded in report:
+        print '%-10s %10.2f %18.1f%s' % (stage, seconds, memory, '  (checkpoint)' if loaded else '')
+    print '%-10s %10.2f %18.1f' % ('total', sum(r[1] for r in report), max(r[2] for r in report))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--yelp', default='yelp_restaurants.csv', help='Yelp restaurants, JSON or CSV (default: yelp_restaurants.csv)')
+    parser.add_argument('--zomato', default='zomato_restaurants.csv', help='Zomato restaurants, JSON or CSV (default: zomato_restaurants.csv)')
+    parser.add_argument('--labels', nargs='+', default=['I.csv', 'J.csv'], help='labeled sample of the candidate set, or the files that it was split into (default: I.csv J.csv)')
+    parser.add_argument('--output', default='./E.csv', help='merged table (default: ./E.csv)')
+    parser.add_argument('--radius', type=float, help='block with spatial_block() and this radius in km')
+    parser.add_argument('--models', help='model store directory in which to save and load the matcher')
+    parser.add_argument('--checkpoints', help='directory in which to save and load the output of each stage')
+    args = parser.parse_args()
+
+    frames, report = run(args)
+    em.to_csv_metadata(frames['E'], args.output)
+    print_report(report)
+
+if __name__ == '__main__':
+    main()